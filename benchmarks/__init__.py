@@ -0,0 +1 @@
+"""Benchmarks of the API, run from the repository root with `python -m benchmarks.<name>`."""
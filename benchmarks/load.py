@@ -0,0 +1,246 @@
+"""Load test of the gateway against mock upstreams: throughput, latency, time to first token and CPU per request.
+
+    python -m benchmarks.load [--requests 400] [--concurrency 32] [--scenarios chat,stream]
+                              [--env SSE_FLUSH_WINDOW=5] [--json results.json]
+                              [--baseline results.json --tolerance 0.2]
+
+Starts `benchmarks.mock_upstream` and the gateway (uvicorn, one worker) as processes on free
+loopback ports, every provider pointed at the mock, so nothing leaves the host. Each scenario
+sends `requests` requests, `concurrency` at a time, after a warm-up. Latencies include the
+mock's own latency and token rate: compare runs made with the same mock options.
+
+CPU per request is the CPU time of the gateway process over a scenario divided by its
+requests (from /proc, Linux only). With `--baseline`, the exit status is 1 if the p50
+latency or the CPU per request of a scenario is over the baseline's by more than `--tolerance`.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from benchmarks.mock_upstream import add_arguments
+
+
+def chat(model: str, stream: bool = False) -> dict:
+    return {'model': model, 'stream': stream, 'messages': [{'role': 'user', 'content': "Say something."}]}
+
+
+# name: (method, path, body, streamed)
+SCENARIOS: Dict[str, Tuple[str, str, Optional[dict], bool]] = {
+    'models': ('GET', '/v1/models', None, False),
+    'chat/openai': ('POST', '/v1/chat/completions', chat('gpt-3.5-turbo'), False),
+    'chat/wenxin': ('POST', '/v1/chat/completions', chat('wenxin/ernie-bot'), False),
+    'chat/minimax': ('POST', '/v1/chat/completions', chat('minimax/abab5.5-chat'), False),
+    'chat/zhipu': ('POST', '/v1/chat/completions', chat('zhipu/chatglm_pro'), False),
+    'stream/openai': ('POST', '/v1/chat/completions', chat('gpt-3.5-turbo', True), True),
+    'stream/wenxin': ('POST', '/v1/chat/completions', chat('wenxin/ernie-bot', True), True),
+    'stream/minimax': ('POST', '/v1/chat/completions', chat('minimax/abab5.5-chat', True), True),
+    'stream/zhipu': ('POST', '/v1/chat/completions', chat('zhipu/chatglm_pro', True), True),
+    'embeddings/openai': ('POST', '/v1/embeddings', {'model': 'text-embedding-ada-002', 'input': ["a", "b"]}, False),
+    'embeddings/wenxin': ('POST', '/v1/embeddings', {'model': 'wenxin/embedding-v1', 'input': ["a", "b"]}, False),
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """User and system CPU time of a process."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(round(p * (len(values) - 1))), len(values) - 1)]
+
+
+async def wait_ready(client: httpx.AsyncClient, url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode}")
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{url} not ready after {timeout}s")
+        await asyncio.sleep(0.1)
+
+
+async def send(client: httpx.AsyncClient, method: str, url: str, body: Optional[dict]) -> Tuple[int, float, float]:
+    """Status code, latency and time to the first body chunk of one request."""
+    start = time.perf_counter()
+    first = None
+    async with client.stream(method, url, json=body) as response:
+        async for _ in response.aiter_raw():
+            if first is None:
+                first = time.perf_counter()
+    end = time.perf_counter()
+    return response.status_code, end - start, (first or end) - start
+
+
+async def run_scenario(client: httpx.AsyncClient, base: str, name: str, requests: int, concurrency: int,
+                       pid: int) -> dict:
+    method, path, body, streamed = SCENARIOS[name]
+    url = base + path
+    # Warm-up: connections, caches of the gateway and of the interpreter.
+    await asyncio.gather(*(send(client, method, url, body) for _ in range(concurrency)))
+
+    latencies: List[float] = []
+    ttfts: List[float] = []
+    errors = 0
+    pending = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in pending:
+            try:
+                status_code, latency, ttft = await send(client, method, url, body)
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            if status_code != 200:
+                errors += 1
+                continue
+            latencies.append(latency)
+            ttfts.append(ttft)
+
+    cpu_start = cpu_seconds(pid)
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    cpu_end = cpu_seconds(pid)
+
+    def ms(value: Optional[float]) -> Optional[float]:
+        return None if value is None else round(value * 1000, 2)
+    cpu = None if cpu_start is None or cpu_end is None else (cpu_end - cpu_start) / requests
+    return {
+        'scenario': name,
+        'requests': requests,
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': ms(percentile(latencies, 0.5)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'ttft_p50_ms': ms(percentile(ttfts, 0.5)) if streamed else None,
+        'ttft_p99_ms': ms(percentile(ttfts, 0.99)) if streamed else None,
+        'cpu_ms_per_request': ms(cpu),
+    }
+
+
+def print_results(results: List[dict]):
+    columns = ['scenario', 'rps', 'p50_ms', 'p99_ms', 'ttft_p50_ms', 'ttft_p99_ms', 'cpu_ms_per_request', 'errors']
+    print(' '.join(f"{column:>18}" for column in columns))
+    for result in results:
+        print(' '.join(f"{'-' if result[column] is None else result[column]:>18}" for column in columns))
+
+
+def regressions(results: List[dict], baseline: List[dict], tolerance: float) -> List[str]:
+    """Scenarios slower or more CPU hungry than the baseline by more than `tolerance`."""
+    previous = {result['scenario']: result for result in baseline}
+    found = []
+    for result in results:
+        base = previous.get(result['scenario'])
+        if base is None:
+            continue
+        for metric in ('p50_ms', 'cpu_ms_per_request'):
+            if result[metric] and base[metric] and result[metric] > base[metric] * (1 + tolerance):
+                found.append(f"{result['scenario']} {metric}: {base[metric]} -> {result[metric]}")
+    return found
+
+
+async def run(args) -> List[dict]:
+    mock_port, gateway_port = free_port(), free_port()
+    mock_base = f"http://127.0.0.1:{mock_port}"
+    env = dict(
+        os.environ,
+        OPENAI_API_BASE=mock_base + "/v1",
+        OPENAI_API_KEY="sk-mock",
+        WENXIN_API_BASE=mock_base,
+        WENXIN_API_KEY="mock",
+        WENXIN_SECRET_KEY="mock",
+        MINIMAX_API_BASE=mock_base,
+        MINIMAX_GROUP_ID="mock",
+        MINIMAX_API_KEY="mock",
+        ZHIPU_API_BASE=mock_base,
+        ZHIPU_API_KEY="mock." + "0" * 32,
+        SECRET_TOKEN="",
+        LOG_LEVEL="WARNING",
+        LOG_SAMPLE_BODIES="0",
+    )
+    for item in args.env:
+        key, _, value = item.partition('=')
+        env[key] = value
+    mock = subprocess.Popen([
+        sys.executable, '-m', 'benchmarks.mock_upstream', '--port', str(mock_port), '--latency', str(args.latency),
+        '--tokens', str(args.tokens), '--tokens-per-second', str(args.tokens_per_second), '--dim', str(args.dim),
+    ])
+    gateway = subprocess.Popen([
+        sys.executable, '-m', 'uvicorn', 'llm_fusion_api.app:app', '--port', str(gateway_port),
+        '--log-level', 'warning', '--no-access-log',
+    ], env=env)
+    base = f"http://127.0.0.1:{gateway_port}"
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+            await wait_ready(client, mock_base + "/v1/models", mock)
+            await wait_ready(client, base + "/health", gateway)
+            results = []
+            for name in args.scenarios:
+                results.append(await run_scenario(client, base, name, args.requests, args.concurrency, gateway.pid))
+            return results
+    finally:
+        for process in (gateway, mock):
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=400, help="requests of each scenario")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--scenarios', default='',
+                        help=f"comma separated names or prefixes, of: {', '.join(SCENARIOS)}")
+    parser.add_argument('--env', action='append', default=[], help="KEY=VALUE setting of the gateway, repeatable")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    add_arguments(parser)
+    args = parser.parse_args()
+    prefixes = [prefix for prefix in args.scenarios.split(',') if prefix]
+    args.scenarios = [name for name in SCENARIOS if not prefixes or any(name.startswith(p) for p in prefixes)]
+
+    results = asyncio.run(run(args))
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print("regression:", regression)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
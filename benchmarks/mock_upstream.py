@@ -0,0 +1,176 @@
+"""Mock upstream speaking the OpenAI, Wenxin, MiniMax and Zhipu wire formats, for benchmarks without network access.
+
+    python -m benchmarks.mock_upstream [--port 9100] [--latency 0.05] [--tokens 64] [--tokens-per-second 0]
+
+One server answers for all providers, at the paths of their APIs: point the API base
+settings of the gateway at it (`benchmarks.load` does). Each completion is `tokens`
+tokens, the first sent after `latency` seconds and the others at `tokens_per_second`
+(all at once when 0), in one response or streamed as each provider does.
+"""
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from typing import AsyncIterator, Callable, List
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+
+class MockOptions(object):
+    def __init__(self, latency: float = 0.05, tokens: int = 64, tokens_per_second: float = 0, dim: int = 256):
+        self.latency = latency
+        self.tokens = tokens
+        self.tokens_per_second = tokens_per_second
+        self.dim = dim
+
+
+def create_app(options: MockOptions) -> Starlette:
+    async def pieces() -> AsyncIterator[str]:
+        """The tokens of a completion, at the configured latency and rate."""
+        await asyncio.sleep(options.latency)
+        interval = 1 / options.tokens_per_second if options.tokens_per_second else 0
+        for i in range(options.tokens):
+            if i and interval:
+                await asyncio.sleep(interval)
+            yield "tok "
+
+    async def text() -> str:
+        return ''.join([piece async for piece in pieces()])
+
+    def usage() -> dict:
+        return {'prompt_tokens': 16, 'completion_tokens': options.tokens, 'total_tokens': 16 + options.tokens}
+
+    def events(render: Callable[[int, str], bytes], last: Callable[[], bytes]) -> StreamingResponse:
+        async def generate():
+            i = 0
+            async for piece in pieces():
+                yield render(i, piece)
+                i += 1
+            yield last()
+        return StreamingResponse(generate(), media_type='text/event-stream')
+
+    def sse(payload: dict) -> bytes:
+        return b'data: ' + json.dumps(payload, ensure_ascii=False).encode() + b'\n\n'
+
+    def embeddings(inputs: List[str]) -> List[dict]:
+        return [{'object': 'embedding', 'index': i, 'embedding': [0.01] * options.dim} for i in range(len(inputs))]
+
+    async def openai_models(request: Request) -> Response:
+        names = ['gpt-3.5-turbo', 'gpt-4', 'text-embedding-ada-002']
+        return JSONResponse({'object': 'list', 'data': [{'id': name, 'object': 'model'} for name in names]})
+
+    async def openai_chat(request: Request) -> Response:
+        body = await request.json()
+        id, created, model = 'chatcmpl-' + uuid.uuid4().hex, int(time.time()), body['model']
+        if not body.get('stream'):
+            return JSONResponse({
+                'id': id, 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': await text()},
+                             'finish_reason': 'stop'}],
+                'usage': usage(),
+            })
+
+        def chunk(delta: dict, finish_reason=None) -> bytes:
+            return sse({'id': id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]})
+        return events(
+            lambda i, piece: chunk({'role': 'assistant', 'content': piece} if i == 0 else {'content': piece}),
+            lambda: chunk({}, 'stop') + b'data: [DONE]\n\n',
+        )
+
+    async def openai_embeddings(request: Request) -> Response:
+        body = await request.json()
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        await asyncio.sleep(options.latency)
+        return JSONResponse({'object': 'list', 'model': body['model'], 'data': embeddings(inputs),
+                             'usage': {'prompt_tokens': len(inputs), 'total_tokens': len(inputs)}})
+
+    async def wenxin_token(request: Request) -> Response:
+        return JSONResponse({'access_token': 'mock-token', 'expires_in': 2592000})
+
+    async def wenxin_chat(request: Request) -> Response:
+        body = await request.json()
+        id, created = 'as-' + uuid.uuid4().hex[:10], int(time.time())
+        if not body.get('stream'):
+            return JSONResponse({'id': id, 'object': 'chat.completion', 'created': created, 'result': await text(),
+                                 'is_truncated': False, 'need_clear_history': False, 'usage': usage()})
+
+        def chunk(i: int, result: str, is_end: bool) -> bytes:
+            return sse({'id': id, 'object': 'chat.completion', 'created': created, 'sentence_id': i,
+                        'is_end': is_end, 'result': result, 'usage': usage()})
+        return events(lambda i, piece: chunk(i, piece, False), lambda: chunk(options.tokens, '', True))
+
+    async def wenxin_embeddings(request: Request) -> Response:
+        body = await request.json()
+        await asyncio.sleep(options.latency)
+        return JSONResponse({'id': 'as-' + uuid.uuid4().hex[:10], 'object': 'embedding_list',
+                             'created': int(time.time()), 'data': embeddings(body['input']),
+                             'usage': {'prompt_tokens': len(body['input']), 'total_tokens': len(body['input'])}})
+
+    async def minimax_chat(request: Request) -> Response:
+        body = await request.json()
+        created = int(time.time())
+        if not body.get('stream'):
+            reply = await text()
+            return JSONResponse({'created': created, 'model': body['model'], 'reply': reply,
+                                 'choices': [{'index': 0, 'text': reply, 'finish_reason': 'stop'}],
+                                 'usage': {'total_tokens': 16 + options.tokens},
+                                 'base_resp': {'status_code': 0, 'status_msg': 'success'}})
+        return events(
+            lambda i, piece: sse({'created': created, 'model': body['model'], 'reply': '',
+                                  'choices': [{'index': 0, 'delta': piece}]}),
+            lambda: sse({'created': created, 'model': body['model'], 'reply': '',
+                         'choices': [{'index': 0, 'delta': '', 'finish_reason': 'stop'}],
+                         'usage': {'total_tokens': 16 + options.tokens},
+                         'base_resp': {'status_code': 0, 'status_msg': 'success'}}),
+        )
+
+    async def zhipu_chat(request: Request) -> Response:
+        request_id = uuid.uuid4().hex
+        if request.path_params['invoke_type'] != 'sse-invoke':
+            return JSONResponse({'code': 200, 'msg': 'success', 'success': True, 'data': {
+                'request_id': request_id, 'task_status': 'SUCCESS',
+                'choices': [{'role': 'assistant', 'content': await text()}], 'usage': usage()}})
+        return events(
+            lambda i, piece: f"event: add\nid: {request_id}\ndata: {piece}\n\n".encode(),
+            lambda: (f"event: finish\nid: {request_id}\ndata: \nmeta: "
+                     + json.dumps({'request_id': request_id, 'usage': usage()}) + "\n\n").encode(),
+        )
+
+    return Starlette(routes=[
+        Route('/v1/models', openai_models, methods=['GET']),
+        Route('/v1/chat/completions', openai_chat, methods=['POST']),
+        Route('/v1/embeddings', openai_embeddings, methods=['POST']),
+        Route('/oauth/2.0/token', wenxin_token, methods=['GET', 'POST']),
+        Route('/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/{endpoint}', wenxin_chat, methods=['POST']),
+        Route('/rpc/2.0/ai_custom/v1/wenxinworkshop/embeddings/{model}', wenxin_embeddings, methods=['POST']),
+        Route('/v1/text/chatcompletion', minimax_chat, methods=['POST']),
+        Route('/api/paas/v3/model-api/{model}/{invoke_type}', zhipu_chat, methods=['POST']),
+    ])
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds to the first token")
+    parser.add_argument('--tokens', type=int, default=64, help="tokens of each completion")
+    parser.add_argument('--tokens-per-second', type=float, default=0, help="0 to send all tokens at once")
+    parser.add_argument('--dim', type=int, default=256, help="dimensions of embeddings")
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    options = MockOptions(args.latency, args.tokens, args.tokens_per_second, args.dim)
+    uvicorn.run(create_app(options), host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
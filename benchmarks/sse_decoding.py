@@ -0,0 +1,71 @@
+"""Throughput of decoding upstream SSE streams: line-based parsing against `SSEDecoder`.
+
+    python -m benchmarks.sse_decoding [--events 20000] [--chunk-size 512]
+
+The line-based path is the previous one of the providers: `response.aiter_lines()`
+(httpx's text and line decoders) then a `data: ` prefix check and `json.loads` per line.
+Both parse the same Wenxin-like stream, cut into chunks of `chunk-size` bytes as they
+come off the socket.
+"""
+import json
+import time
+import random
+import argparse
+
+from httpx._decoders import LineDecoder, TextDecoder
+
+from llm_fusion_api.sse import SSEDecoder
+
+
+def make_stream(n: int) -> bytes:
+    words = ["你好", "世界", "hello", " world", "，", "\n", "\"quoted\"", "的", "模型", "token"]
+    random.seed(0)
+    events = []
+    for i in range(n):
+        text = ''.join(random.choices(words, k=random.randint(1, 3)))
+        payload = {'id': 'as-fp6bcbiv1k', 'object': 'chat.completion', 'created': 1700000000, 'sentence_id': i,
+                   'is_end': False, 'result': text, 'need_clear_history': False}
+        events.append(b'data: ' + json.dumps(payload, ensure_ascii=False).encode() + b'\n\n')
+    return b''.join(events)
+
+
+def parse_lines(chunks):
+    decoder, lines = TextDecoder(), LineDecoder()
+    payloads = []
+    for chunk in chunks:
+        for line in lines.decode(decoder.decode(chunk)):
+            if not line.startswith("data: "):
+                continue
+            payloads.append(json.loads(line[6:].strip()))
+    return payloads
+
+
+def parse_events(chunks):
+    decoder = SSEDecoder()
+    payloads = []
+    for chunk in chunks:
+        for event in decoder.feed(chunk):
+            payloads.append(event.json())
+    return payloads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--chunk-size', type=int, default=512)
+    args = parser.parse_args()
+
+    stream = make_stream(args.events)
+    chunks = [stream[i:i + args.chunk_size] for i in range(0, len(stream), args.chunk_size)]
+    results = {}
+    for label, parse in (("aiter_lines + json.loads", parse_lines), ("SSEDecoder + Event.json", parse_events)):
+        start = time.perf_counter()
+        results[label] = parse(chunks)
+        elapsed = time.perf_counter() - start
+        print(f"{label:>24}: {elapsed / args.events * 1e6:6.2f} us/event, {len(stream) / elapsed / 1e6:6.1f} MB/s")
+    first, second = results.values()
+    assert first == second
+
+
+if __name__ == '__main__':
+    main()
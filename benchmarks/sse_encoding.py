@@ -0,0 +1,93 @@
+"""Per-chunk cost of the SSE output path of converted streams, and writes saved by coalescing.
+
+    python -m benchmarks.sse_encoding [--chunks 20000] [--window 5]
+
+Compares building a chunk dict, `json.dumps` and `EventSourceResponse` framing for every
+chunk (the previous path) with `ChunkEncoder`, then counts the writes of a bursty stream
+with and without a flush window.
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+
+from sse_starlette.event import ensure_bytes
+
+from llm_fusion_api.sse import ChunkEncoder, coalesce
+
+
+def dict_chunk(id: str, created: int, model: str, text: str) -> bytes:
+    response = {
+        'id': id,
+        'object': "chat.completion.chunk",
+        'created': created,
+        'model': model,
+        'choices': [
+            {
+                'index': 0,
+                'delta': {'content': text},
+                'finish_reason': None,
+            }
+        ],
+    }
+    return ensure_bytes(json.dumps(response, ensure_ascii=False), '\r\n')
+
+
+def bench_encoding(texts):
+    id, created, model = 'as-fp6bcbiv1k', 1700000000, 'ernie-bot-4'
+    start = time.perf_counter()
+    for text in texts:
+        dict_chunk(id, created, model, text)
+    baseline = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encoder = ChunkEncoder(id, created, model)
+    for text in texts:
+        encoder.content(text)
+    encoded = time.perf_counter() - start
+    assert json.loads(encoder.content(texts[0])[6:]) == json.loads(dict_chunk(id, created, model, texts[0])[6:])
+
+    n = len(texts)
+    print(f"dict + json.dumps + framing: {baseline / n * 1e6:6.2f} us/chunk")
+    print(f"ChunkEncoder:                {encoded / n * 1e6:6.2f} us/chunk  ({baseline / encoded:.1f}x)")
+
+
+async def bursty_stream(encoder, texts, burst: int, gap: float):
+    """Upstream reads arrive in bursts of `burst` chunks, `gap` seconds apart."""
+    for i, text in enumerate(texts):
+        if i and i % burst == 0:
+            await asyncio.sleep(gap)
+        yield encoder.content(text)
+
+
+async def bench_coalescing(texts, window: float):
+    encoder = ChunkEncoder('id', 0, 'model')
+    for label, events in (
+        ("no flush window", bursty_stream(encoder, texts, 8, 0.02)),
+        (f"{window * 1000:.0f}ms flush window", coalesce(bursty_stream(encoder, texts, 8, 0.02), window)),
+    ):
+        writes = size = 0
+        start = time.perf_counter()
+        async for item in events:
+            writes += 1
+            size += len(item)
+        elapsed = time.perf_counter() - start
+        print(f"{label:>20}: {writes:5d} writes of {size / writes:7.1f} bytes on average, {elapsed:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=20000)
+    parser.add_argument('--window', type=float, default=5, help="flush window, in milliseconds")
+    args = parser.parse_args()
+
+    words = ["你好", "世界", "hello", " world", "，", "\n", "\"quoted\"", "的", "模型", "token"]
+    random.seed(0)
+    texts = [''.join(random.choices(words, k=random.randint(1, 3))) for _ in range(args.chunks)]
+    bench_encoding(texts)
+    asyncio.run(bench_coalescing(texts[:800], args.window / 1000))
+
+
+if __name__ == '__main__':
+    main()
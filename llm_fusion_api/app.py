@@ -1,17 +1,64 @@
+import os
+import asyncio
 import logging
-from typing import List
+import contextlib
+import importlib.util
+from typing import Any, Dict, List, Optional, Tuple
 from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
 from starlette.routing import Route
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse, Response
 from starlette.middleware import Middleware
-from starlette.middleware.base import BaseHTTPMiddleware
-from llm_fusion_api import settings
-from llm_fusion_api.response import ErrorResponse
-from llm_fusion_api.provider import Model, OpenAI, Wenxin, MiniMax, Zhipu
+from llm_fusion_api import settings, log, metrics, streams
+from llm_fusion_api.response import ErrorResponse, APIError
+from llm_fusion_api.schema import ChatCompletionRequest, EmbeddingRequest, decode_body
+from llm_fusion_api.middleware import SecretTokenAuthMiddleware
+from llm_fusion_api.catalog import ModelCatalog
+from llm_fusion_api.registry import CHAT, EMBEDDING, ModelRegistry, parse_aliases, public_id
+from llm_fusion_api.cache import ResponseCache, is_cacheable, make_key
+from llm_fusion_api.embedding_cache import EmbeddingCache
+from llm_fusion_api.batching import CoalescingEmbeddingHandler
+from llm_fusion_api.breaker import CircuitBreakers, STATE_VALUES, OPEN
+from llm_fusion_api.concurrency import AdaptiveLimiters
+from llm_fusion_api.ratelimit import RateLimiter, RateLimited, load_tenants
+from llm_fusion_api.state import MemoryStateStore, SQLiteStateStore, StateStore
+from llm_fusion_api.batches import Batches, FileStore, response_json
+from llm_fusion_api.resilience import (
+    Resilience, discard, error_response, is_failure, is_retryable_error, parse_fallbacks,
+)
+from llm_fusion_api.provider import Model, OpenAI, Wenxin, MiniMax, Zhipu, ProviderPool, make_pool, parse_weighted
+from llm_fusion_api.provider.base import Provider, EmbeddingHandler
 
 
-logging.basicConfig(level=logging.INFO)
+def pooled_secrets(*values: str) -> List[str]:
+    """Credentials of pooled list settings, without their weight, Wenxin `api_key:secret_key` pairs split."""
+    return [secret for value in values for secret in parse_weighted(value)[0].split(':')]
+
+
+# Read before logging is set up, their keys are redacted.
+TENANTS = load_tenants(settings.TENANTS_FILE) if settings.TENANTS_FILE else []
+
+log.setup(
+    settings.LOG_LEVEL,
+    settings.LOG_FORMAT,
+    rates={log.BODY: settings.LOG_SAMPLE_BODIES, log.CHUNK: settings.LOG_SAMPLE_CHUNKS},
+    secrets=[
+        str(secret) for secret in (
+            settings.SECRET_TOKEN, *settings.SECRET_TOKENS, settings.OPENAI_API_KEY, settings.WENXIN_API_KEY,
+            settings.WENXIN_SECRET_KEY, settings.FASTCHAT_OPENAI_API_KEY, settings.MINIMAX_API_KEY,
+            settings.ZHIPU_API_KEY, *(key for tenant in TENANTS for key in tenant.keys),
+            *pooled_secrets(
+                *settings.OPENAI_API_KEYS, *settings.WENXIN_API_KEYS, *settings.MINIMAX_API_KEYS,
+                *settings.ZHIPU_API_KEYS,
+            ),
+        )
+    ],
+)
+logger = logging.getLogger(__name__)
+
+# Starlette parses multipart forms with python-multipart, `python_multipart` in its recent versions.
+HAS_MULTIPART = any(importlib.util.find_spec(name) is not None for name in ('python_multipart', 'multipart'))
 
 
 class App(Starlette):
@@ -22,40 +69,164 @@ class App(Starlette):
         routes = [
             Route("/", endpoint=self.homepage, methods=['GET']),
             Route("/v1/models", endpoint=self.get_models, methods=['GET']),
+            Route("/metrics", endpoint=self.get_metrics, methods=['GET']),
+            Route("/health", endpoint=self.health, methods=['GET']),
             Route("/v1/chat/completions", endpoint=self.chat_completions, methods=['POST']),
             Route("/v1/embeddings", endpoint=self.embeddings, methods=['POST']),
             Route("/v1/engines/{model_name:path}/embeddings", endpoint=self.embeddings, methods=['POST']),
         ]
+        if settings.BATCH_DIR:
+            routes += [
+                Route("/v1/files", endpoint=self.create_file, methods=['POST']),
+                Route("/v1/files", endpoint=self.list_files, methods=['GET']),
+                Route("/v1/files/{file_id}", endpoint=self.get_file, methods=['GET']),
+                Route("/v1/files/{file_id}", endpoint=self.delete_file, methods=['DELETE']),
+                Route("/v1/files/{file_id}/content", endpoint=self.get_file_content, methods=['GET']),
+                Route("/v1/batches", endpoint=self.create_batch, methods=['POST']),
+                Route("/v1/batches", endpoint=self.list_batches, methods=['GET']),
+                Route("/v1/batches/{batch_id}", endpoint=self.get_batch, methods=['GET']),
+                Route("/v1/batches/{batch_id}/cancel", endpoint=self.cancel_batch, methods=['POST']),
+            ]
 
+        self.tenants = TENANTS
         middleware = [
-            Middleware(SecretTokenAuthMiddleware, secret_token=settings.SECRET_TOKEN),
+            Middleware(
+                SecretTokenAuthMiddleware,
+                secret_tokens=[str(settings.SECRET_TOKEN), *settings.SECRET_TOKENS],
+                secret_token_hashes=settings.SECRET_TOKEN_HASHES,
+                tenants=self.tenants,
+            ),
         ]
 
-        super().__init__(debug=settings.DEBUG, routes=routes, middleware=middleware)
+        super().__init__(debug=settings.DEBUG, routes=routes, middleware=middleware, lifespan=self.lifespan)
 
         ## Register global variables
         self.load_variables()
 
     def load_variables(self):
         self.models = []
-        if settings.OPENAI_API_KEY:
-            self.providers['openai'] = OpenAI(settings.OPENAI_API_BASE, str(settings.OPENAI_API_KEY))
+        self.state: StateStore = SQLiteStateStore(settings.STATE_DB) if settings.STATE_DB else MemoryStateStore()
+        # Caches and credentials go through the state store only when the other workers see it.
+        shared = self.state if self.state.shared else None
+        # Each key or base URL is a member, providers with several members are load balanced.
+        members: Dict[str, List[Tuple[Provider, float]]] = {}
+        for key, weight in weighted_values(str(settings.OPENAI_API_KEY), *settings.OPENAI_API_KEYS):
+            members.setdefault('openai', []).append((OpenAI(settings.OPENAI_API_BASE, key), weight))
+        wenxin_keys = list(settings.WENXIN_API_KEYS)
         if settings.WENXIN_API_KEY and settings.WENXIN_SECRET_KEY:
-            self.providers['wenxin'] = Wenxin(str(settings.WENXIN_API_KEY), str(settings.WENXIN_SECRET_KEY))
-        if settings.FASTCHAT_OPENAI_API_BASE:
-            self.providers['fastchat'] = OpenAI(
-                settings.FASTCHAT_OPENAI_API_BASE, str(settings.FASTCHAT_OPENAI_API_KEY), "fastchat")
-        if settings.MINIMAX_GROUP_ID and settings.MINIMAX_API_KEY:
-            self.providers['minimax'] = MiniMax(str(settings.MINIMAX_GROUP_ID), str(settings.MINIMAX_API_KEY))
-        if settings.ZHIPU_API_KEY:
-            self.providers['zhipu'] = Zhipu(str(settings.ZHIPU_API_KEY))
-
-    async def list_models(self) -> List[Model]:
-        """List all models from all providers."""
-        models = []
+            wenxin_keys.insert(0, f"{settings.WENXIN_API_KEY}:{settings.WENXIN_SECRET_KEY}")
+        for pair, weight in weighted_values(*wenxin_keys):
+            api_key, _, secret_key = pair.partition(':')
+            members.setdefault('wenxin', []).append(
+                (Wenxin(api_key, secret_key, settings.WENXIN_API_BASE, shared), weight))
+        for base, weight in weighted_values(settings.FASTCHAT_OPENAI_API_BASE, *settings.FASTCHAT_OPENAI_API_BASES):
+            members.setdefault('fastchat', []).append(
+                (OpenAI(base, str(settings.FASTCHAT_OPENAI_API_KEY), "fastchat"), weight))
+        if settings.MINIMAX_GROUP_ID:
+            for key, weight in weighted_values(str(settings.MINIMAX_API_KEY), *settings.MINIMAX_API_KEYS):
+                members.setdefault('minimax', []).append(
+                    (MiniMax(str(settings.MINIMAX_GROUP_ID), key, settings.MINIMAX_API_BASE), weight))
+        for key, weight in weighted_values(str(settings.ZHIPU_API_KEY), *settings.ZHIPU_API_KEYS):
+            members.setdefault('zhipu', []).append((Zhipu(key, settings.ZHIPU_API_BASE), weight))
+        for name, provider_members in members.items():
+            self.providers[name] = make_pool(
+                name, provider_members,
+                strategy=settings.POOL_STRATEGY,
+                eject_failures=settings.POOL_EJECT_FAILURES,
+                eject_seconds=settings.POOL_EJECT_SECONDS,
+            )
+        # Embedding requests go through a coalescing stage when batching is enabled.
+        self.embedding_handlers: Dict[str, EmbeddingHandler] = {}
+        for name, provider in self.providers.items():
+            if not isinstance(provider, EmbeddingHandler):
+                continue
+            if settings.EMBEDDING_BATCH_WINDOW > 0 and settings.EMBEDDING_BATCH_MAX_SIZE > 1:
+                provider = CoalescingEmbeddingHandler(
+                    provider, settings.EMBEDDING_BATCH_WINDOW / 1000, settings.EMBEDDING_BATCH_MAX_SIZE)
+            self.embedding_handlers[name] = provider
+        # FastChat lists its models without telling chat from embedding models.
+        self.registry = ModelRegistry(self.providers, parse_aliases(settings.MODEL_ALIASES), untyped=['fastchat'])
+        self.catalog = ModelCatalog(
+            self.providers, settings.MODELS_CACHE_TTL, settings.MODELS_FETCH_TIMEOUT, self.registry.update, shared)
+        self.response_cache = None
+        if settings.RESPONSE_CACHE:
+            self.response_cache = ResponseCache(
+                settings.RESPONSE_CACHE_MAX_ENTRIES, settings.RESPONSE_CACHE_TTL, settings.RESPONSE_CACHE_DIR, shared,
+                int(settings.RESPONSE_CACHE_DIR_MAX_MB * 1024 * 1024))
+        self.embedding_cache = None
+        if settings.EMBEDDING_CACHE_MAX_ENTRIES > 0:
+            self.embedding_cache = EmbeddingCache(settings.EMBEDDING_CACHE_MAX_ENTRIES, settings.EMBEDDING_CACHE_DIR)
+        self.breakers = None
+        if settings.BREAKER_WINDOW > 0:
+            self.breakers = CircuitBreakers(
+                window=settings.BREAKER_WINDOW,
+                min_calls=settings.BREAKER_MIN_CALLS,
+                error_rate=settings.BREAKER_ERROR_RATE,
+                slow_seconds=settings.BREAKER_SLOW_SECONDS,
+                open_seconds=settings.BREAKER_OPEN_SECONDS,
+                half_open_calls=settings.BREAKER_HALF_OPEN_CALLS,
+            )
+        self.limiters = None
+        if settings.CONCURRENCY_INITIAL_LIMIT > 0:
+            self.limiters = AdaptiveLimiters(
+                initial_limit=settings.CONCURRENCY_INITIAL_LIMIT,
+                min_limit=settings.CONCURRENCY_MIN_LIMIT,
+                max_limit=settings.CONCURRENCY_MAX_LIMIT,
+                backoff=settings.CONCURRENCY_BACKOFF,
+                latency_tolerance=settings.CONCURRENCY_LATENCY_TOLERANCE,
+                queue_size=settings.CONCURRENCY_QUEUE_SIZE,
+                max_wait=settings.CONCURRENCY_MAX_WAIT,
+            )
+        self.resilience = Resilience(
+            retries=settings.RETRY_ATTEMPTS,
+            base_delay=settings.RETRY_BASE_DELAY,
+            max_delay=settings.RETRY_MAX_DELAY,
+            hedge_percentile=settings.HEDGE_PERCENTILE,
+            hedge_min_samples=settings.HEDGE_MIN_SAMPLES,
+            breakers=self.breakers,
+            limiters=self.limiters,
+        )
+        self.fallbacks = parse_fallbacks(settings.FALLBACK_CHAINS)
+        self.limiter = RateLimiter(self.tenants, self.state, settings.RATE_LIMIT_MAX_WAIT)
+        self.files = self.batches = None
+        if settings.BATCH_DIR:
+            self.files = FileStore(os.path.join(settings.BATCH_DIR, 'files'))
+            self.batches = Batches(
+                os.path.join(settings.BATCH_DIR, 'batches'),
+                self.files,
+                self.dispatch,
+                concurrency=settings.BATCH_CONCURRENCY,
+                requests_per_second=settings.BATCH_REQUESTS_PER_SECOND,
+                checkpoint_seconds=settings.BATCH_CHECKPOINT_SECONDS,
+            )
+
+    @contextlib.asynccontextmanager
+    async def lifespan(self, app):
+        """Start providers, and close their pooled HTTP clients on shutdown."""
         for provider in self.providers.values():
-            models.extend(await provider.list_models())
-        return models
+            await provider.startup()
+        # Routes are checked against the model lists, fetched before serving.
+        await self.catalog.refresh_all()
+        self.catalog.start()
+        if self.batches is not None:
+            self.batches.start()
+        try:
+            yield
+        finally:
+            if self.batches is not None:
+                await self.batches.stop()
+            await self.catalog.stop()
+            for handler in self.embedding_handlers.values():
+                if isinstance(handler, CoalescingEmbeddingHandler):
+                    await handler.aclose()
+            for provider in self.providers.values():
+                await provider.aclose()
+            if self.embedding_cache is not None:
+                self.embedding_cache.close()
+
+    async def list_models(self) -> Tuple[List[Model], Dict[str, str]]:
+        """List all models from all providers, with the errors of providers that failed."""
+        return await self.catalog.list_models()
 
     async def homepage(self, request):
         """GET /"""
@@ -66,11 +237,11 @@ class App(Starlette):
 
         https://platform.openai.com/docs/api-reference/models
         """
-        models = await self.list_models()
+        models, errors = await self.list_models()
         response = [
             {
                 "created": 1677610602,
-                "id": model.name if model.provider == "openai" else model.provider + "/" + model.name,
+                "id": public_id(model),
                 "object": "model",
                 "owned_by": model.provider,
                 "permission": [
@@ -95,55 +266,315 @@ class App(Starlette):
             for model in models
         ]
 
-        return JSONResponse(dict(data=response))
+        content = dict(data=response)
+        if errors:
+            # Partial result, tell the client which providers are missing.
+            content['errors'] = [{'provider': provider, 'message': message} for provider, message in errors.items()]
+        return JSONResponse(content)
+
+    async def get_metrics(self, request: Request) -> PlainTextResponse:
+        """GET /metrics, in the Prometheus text format"""
+        for name, provider in self.providers.items():
+            metrics.set_pool_stats(name, provider.pool.stats())
+            if isinstance(provider, ProviderPool):
+                for index, stats in enumerate(provider.stats()):
+                    metrics.set_member_stats(name, str(index), stats)
+        if self.breakers is not None:
+            for name, breaker in self.breakers.breakers.items():
+                metrics.set_breaker_stats(name, STATE_VALUES[breaker.state], breaker.rejected)
+        if self.limiters is not None:
+            for name, limiter in self.limiters.limiters.items():
+                metrics.set_concurrency_stats(name, limiter.stats())
+        for tenant, rejected in self.limiter.rejected.items():
+            metrics.set_rate_limited(tenant, rejected)
+        if self.response_cache is not None:
+            metrics.set_cache_stats('response', self.response_cache.hits, self.response_cache.misses)
+        if self.embedding_cache is not None:
+            metrics.set_cache_stats('embedding', self.embedding_cache.hits, self.embedding_cache.misses)
+        for namespace in set(self.state.hits) | set(self.state.misses):
+            metrics.set_cache_stats(
+                f"state:{namespace}", self.state.hits.get(namespace, 0), self.state.misses.get(namespace, 0))
+        metrics.set_state_stats(self.state.lock_waits, self.state.lock_wait_seconds, self.state.lease_conflicts)
+        return PlainTextResponse(metrics.REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+    async def health(self, request: Request) -> JSONResponse:
+        """GET /health, degraded while a circuit breaker is open"""
+        breakers = self.breakers.states() if self.breakers is not None else {}
+        status = 'degraded' if OPEN in breakers.values() else 'ok'
+        return JSONResponse({'status': status, 'providers': list(self.providers), 'circuit_breakers': breakers})
 
     async def chat_completions(self, request: Request) -> JSONResponse:
         """POST /v1/chat/completions
 
         https://platform.openai.com/docs/api-reference/chat
         """
-        body = await request.json()
-        model = body.get('model', '')
-        if '/' in model:
-            provider, model = model.split('/')
-        else:
-            # Default to OpenAI
-            provider = 'openai'
+        try:
+            req = ChatCompletionRequest.from_bytes(await request.body())
+            route = self.registry.resolve(req.model, CHAT)
+        except APIError as e:
+            return e.response()
+        provider, model = route.provider, route.model
+        try:
+            lease = await self.limiter.admit(
+                getattr(request.state, 'tenant', None), req.estimate_prompt_tokens(), req.stream)
+        except RateLimited as e:
+            return e.response()
+        priority = lease.tenant.priority if lease is not None else 0
+
+        tracker = metrics.RequestMetrics(provider, model, 'chat', lease.finish if lease is not None else None)
+        try:
+            response = await self._chat_completions(request, req, provider, model, priority)
+        except BaseException:
+            tracker.finish(500)
+            raise
+        return tracker.track(streams.guard(response, tracker, settings.STREAM_IDLE_TIMEOUT))
 
-        if provider not in self.providers:
-            return ErrorResponse(400, f'Provider {provider} not found')
-        return await self.providers[provider].chat_completions(request, model)
+    async def _chat_completions(
+        self, request: Request, req: ChatCompletionRequest, provider: str, model: str, priority: int = 0,
+    ) -> Response:
+        # Cache-Control: no-store skips the response cache, no-cache skips the lookup but refreshes the entry.
+        cache_control = request.headers.get('Cache-Control', '')
+        if self.response_cache is None or not is_cacheable(req.body) or 'no-store' in cache_control:
+            return await self._call_chat(req, provider, model, priority)
+
+        key = make_key(provider, model, req.body)
+        if 'no-cache' not in cache_control:
+            cached = await self.response_cache.get(key)
+            if cached is not None:
+                completion, age = cached
+                return self.response_cache.replay(completion, req.stream, age)
+        response = await self._call_chat(req, provider, model, priority)
+        if 'X-Fallback-Model' in response.headers:
+            # Answered by another model, not cached for this one.
+            return response
+        return await self.response_cache.capture(key, response)
+
+    async def _call_chat(self, req: ChatCompletionRequest, provider: str, model: str, priority: int = 0) -> Response:
+        """Call the provider with retries, then the fallbacks of the model in order while it fails."""
+        response = await self._call_model(req, provider, model, priority)
+        name = req.model
+        for fallback in self.fallbacks.get(req.model.lower(), []):
+            if not is_failure(response):
+                break
+            try:
+                route = self.registry.resolve(fallback, CHAT)
+            except APIError:
+                continue
+            provider, model = route.provider, route.model
+            logger.warning("%s failed: %d, falling back to %s", name, response.status_code, fallback)
+            await discard(response)
+            response = await self._call_model(req, provider, model, priority)
+            response.headers['X-Fallback-Model'] = name = fallback
+        return response
+
+    async def _call_model(self, req: ChatCompletionRequest, provider: str, model: str, priority: int = 0) -> Response:
+        try:
+            return await self.resilience.call(
+                f"{provider}/{model}",
+                lambda: self.providers[provider].chat_completions(req, model),
+                stream=req.stream,
+                priority=priority,
+            )
+        except Exception as e:
+            if not isinstance(e, APIError) and not is_retryable_error(e):
+                raise
+            return error_response(e)
 
     async def embeddings(self, request: Request) -> JSONResponse:
         """POST
             /v1/embeddings
             /v1/engines/{model_name}/embeddings
         """
-        body = await request.json()
-        model = body.get('model', request.path_params.get('model_name'))
-        if '/' in model:
-            provider, model = model.split('/')
+        try:
+            req = EmbeddingRequest.from_bytes(await request.body(), request.path_params.get('model_name'))
+            route = self.registry.resolve(req.model, EMBEDDING)
+        except APIError as e:
+            return e.response()
+        provider, model = route.provider, route.model
+        if provider not in self.embedding_handlers:
+            return ErrorResponse(400, f'Provider {provider} does not support embeddings')
+        try:
+            lease = await self.limiter.admit(getattr(request.state, 'tenant', None), req.estimate_tokens())
+        except RateLimited as e:
+            return e.response()
+        priority = lease.tenant.priority if lease is not None else 0
+        tracker = metrics.RequestMetrics(provider, model, 'embeddings', lease.finish if lease is not None else None)
+        try:
+            response = await self._embeddings(req, provider, model, priority)
+        except BaseException:
+            tracker.finish(500)
+            raise
+        return tracker.track(streams.guard(response, tracker, settings.STREAM_IDLE_TIMEOUT))
+
+    async def _embeddings(self, req: EmbeddingRequest, provider: str, model: str, priority: int = 0) -> Response:
+        handler = self.embedding_handlers[provider]
+        key = f"{provider}/{model}"
+        try:
+            if self.embedding_cache is None or not self.embedding_cache.is_cacheable(req.body):
+                return await self.resilience.call(key, lambda: handler.embeddings(req, model), priority=priority)
+            outcome = await self.resilience.call(
+                key, lambda: self.embedding_cache.embed(provider, handler, model, req.body), priority=priority)
+        except Exception as e:
+            if not isinstance(e, APIError) and not is_retryable_error(e):
+                raise
+            return error_response(e)
+        if isinstance(outcome, Response):
+            # Rejected by a circuit breaker or a concurrency limiter.
+            return outcome
+        result, hits = outcome
+        cache = 'HIT' if hits == len(result['data']) else ('PARTIAL' if hits else 'MISS')
+        return JSONResponse(result, headers={'X-Cache': cache})
+
+    async def dispatch(self, endpoint: str, body: bytes, tenant: Optional[str]) -> Tuple[int, Any]:
+        """Run one request of a batch, without streaming, waiting for the budget of its tenant."""
+        try:
+            if endpoint == '/v1/chat/completions':
+                req = ChatCompletionRequest.from_bytes(body)
+                if req.stream:
+                    raise APIError(400, "Streaming is not supported in batches")
+                tokens = req.estimate_prompt_tokens()
+            else:
+                req = EmbeddingRequest.from_bytes(body)
+                tokens = req.estimate_tokens()
+            route = self.registry.resolve(req.model, CHAT if endpoint == '/v1/chat/completions' else EMBEDDING)
+            provider, model = route.provider, route.model
+            if endpoint == '/v1/embeddings' and provider not in self.embedding_handlers:
+                raise APIError(400, f'Provider {provider} does not support embeddings')
+        except APIError as e:
+            return e.status_code, {'error': {'message': e.message}}
+        while True:
+            try:
+                lease = await self.limiter.admit(tenant, tokens)
+                break
+            except RateLimited as e:
+                await asyncio.sleep(e.retry_after)
+        # Below the interactive requests of the tenant.
+        priority = (lease.tenant.priority if lease is not None else 0) - 1
+        kind = 'chat' if endpoint == '/v1/chat/completions' else 'embeddings'
+        tracker = metrics.RequestMetrics(provider, model, kind, lease.finish if lease is not None else None)
+        try:
+            if kind == 'chat':
+                response = await self._call_chat(req, provider, model, priority)  # type: ignore
+            else:
+                response = await self._embeddings(req, provider, model, priority)  # type: ignore
+        except BaseException:
+            tracker.finish(500)
+            raise
+        response = tracker.track(response)
+        return response.status_code, await response_json(response)
+
+    async def create_file(self, request: Request) -> JSONResponse:
+        """POST /v1/files, as a multipart form (`file` and `purpose`) or with the file as the body
+        (`?purpose=batch&filename=...`)
+
+        https://platform.openai.com/docs/api-reference/files/create
+        """
+        tenant = getattr(request.state, 'tenant', None)
+        if request.headers.get('content-type', '').startswith('multipart/form-data'):
+            if not HAS_MULTIPART:
+                return ErrorResponse(400, "Multipart uploads require python-multipart, send the file as the body")
+            form = await request.form()
+            upload = form.get('file')
+            if not isinstance(upload, UploadFile):
+                return ErrorResponse(400, "'file' is required")
+            purpose = form.get('purpose')
+            filename = upload.filename or 'input.jsonl'
+            chunks = iter_upload(upload)
         else:
-            # Default to OpenAI
-            provider = 'openai'
+            purpose = request.query_params.get('purpose')
+            filename = request.query_params.get('filename', 'input.jsonl')
+            chunks = request.stream()
+        if purpose != 'batch':
+            return ErrorResponse(400, "'purpose' must be batch")
+        return JSONResponse(await self.files.save(chunks, filename, purpose, tenant))
 
-        if provider not in self.providers:
-            return ErrorResponse(400, f'Provider {provider} not found')
-        return await self.providers[provider].embeddings(request, model)
+    async def list_files(self, request: Request) -> JSONResponse:
+        """GET /v1/files"""
+        files = self.files.list(getattr(request.state, 'tenant', None), request.query_params.get('purpose'))
+        return JSONResponse({'object': 'list', 'data': files})
 
+    async def get_file(self, request: Request) -> JSONResponse:
+        """GET /v1/files/{file_id}"""
+        file = self.files.get(request.path_params['file_id'], getattr(request.state, 'tenant', None))
+        if file is None:
+            return ErrorResponse(404, f"File {request.path_params['file_id']} not found")
+        return JSONResponse(file)
 
-class SecretTokenAuthMiddleware(BaseHTTPMiddleware):
-    """Middleware to check for a secret token in the Authorization header"""
-    def __init__(self, app, secret_token=None):
-        super().__init__(app)
-        self.secret_token = secret_token
+    async def get_file_content(self, request: Request) -> Response:
+        """GET /v1/files/{file_id}/content, streamed from disk"""
+        file_id = request.path_params['file_id']
+        if self.files.get(file_id, getattr(request.state, 'tenant', None)) is None:
+            return ErrorResponse(404, f"File {file_id} not found")
+        return FileResponse(self.files.content_path(file_id), media_type='application/jsonl')
 
-    async def dispatch(self, request, call_next):
-        """Check for a secret token in the Authorization header"""
-        if self.secret_token and request.headers.get('Authorization') != f'Bearer {self.secret_token}':
-            return ErrorResponse(401, 'Unauthorized')
-        response = await call_next(request)
-        return response
+    async def delete_file(self, request: Request) -> JSONResponse:
+        """DELETE /v1/files/{file_id}"""
+        file_id = request.path_params['file_id']
+        if not self.files.delete(file_id, getattr(request.state, 'tenant', None)):
+            return ErrorResponse(404, f"File {file_id} not found")
+        return JSONResponse({'id': file_id, 'object': 'file', 'deleted': True})
+
+    async def create_batch(self, request: Request) -> JSONResponse:
+        """POST /v1/batches
+
+        https://platform.openai.com/docs/api-reference/batch/create
+        """
+        try:
+            body = decode_body(await request.body())
+            batch = self.batches.create(
+                str(body.get('input_file_id', '')),
+                str(body.get('endpoint', '')),
+                str(body.get('completion_window', '24h')),
+                body.get('metadata'),
+                getattr(request.state, 'tenant', None),
+            )
+        except APIError as e:
+            return e.response()
+        return JSONResponse(batch)
+
+    async def list_batches(self, request: Request) -> JSONResponse:
+        """GET /v1/batches?after=...&limit=20"""
+        try:
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), 100)
+        except ValueError:
+            return ErrorResponse(400, "'limit' must be an integer")
+        batches, has_more = self.batches.list(
+            getattr(request.state, 'tenant', None), request.query_params.get('after'), limit)
+        return JSONResponse({
+            'object': 'list',
+            'data': batches,
+            'first_id': batches[0]['id'] if batches else None,
+            'last_id': batches[-1]['id'] if batches else None,
+            'has_more': has_more,
+        })
+
+    async def get_batch(self, request: Request) -> JSONResponse:
+        """GET /v1/batches/{batch_id}"""
+        batch = self.batches.get(request.path_params['batch_id'], getattr(request.state, 'tenant', None))
+        if batch is None:
+            return ErrorResponse(404, f"Batch {request.path_params['batch_id']} not found")
+        return JSONResponse(batch)
+
+    async def cancel_batch(self, request: Request) -> JSONResponse:
+        """POST /v1/batches/{batch_id}/cancel"""
+        batch = self.batches.cancel(request.path_params['batch_id'], getattr(request.state, 'tenant', None))
+        if batch is None:
+            return ErrorResponse(404, f"Batch {request.path_params['batch_id']} not found")
+        return JSONResponse(batch)
+
+
+async def iter_upload(upload: UploadFile, chunk_size: int = 1 << 20):
+    """Chunks of an uploaded file, spooled to disk by the form parser when it is large."""
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def weighted_values(*values: str) -> List[Tuple[str, float]]:
+    """Parse the non-empty values of list settings into (value, weight)."""
+    return [parse_weighted(value) for value in values if value]
 
 
 # Starlette app
@@ -0,0 +1,642 @@
+"""Offline batch jobs over JSONL files: OpenAI's `/v1/files` and `/v1/batches`.
+
+Each line of an input file is one request, `{"custom_id": ..., "method": "POST", "url":
+"/v1/chat/completions", "body": {...}}`. A batch runs its requests in the background,
+`concurrency` at a time, within `requests_per_second` and the budget of its tenant, and
+appends their results to an output file (failures to an error file) as they complete.
+
+Files are read and written a chunk at a time, memory does not grow with their size.
+Progress is checkpointed every `checkpoint_seconds`: the line before which all requests
+are done, the lines done after it and the sizes of the output files. A batch interrupted
+by a crash or a restart is resumed from its checkpoint, by this process or another one
+sharing the directory: the output files are truncated to the checkpoint and the requests
+done since then run again. A lock file keeps two processes from running the same batch.
+"""
+import os
+import time
+import uuid
+import tempfile
+import contextlib
+import fcntl
+import asyncio
+import itertools
+import logging
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from starlette.responses import Response, StreamingResponse
+from sse_starlette.sse import EventSourceResponse
+
+from llm_fusion_api import jsonlib
+from llm_fusion_api.response import APIError, aclose_iterator
+from llm_fusion_api.state import MemoryStateStore
+
+
+logger = logging.getLogger(__name__)
+
+ENDPOINTS = ('/v1/chat/completions', '/v1/embeddings')
+COMPLETION_WINDOWS = {'24h': 24 * 3600}
+# Batches in these statuses are over, the others are resumed.
+FINAL_STATUSES = ('completed', 'failed', 'cancelled', 'expired')
+# Errors listed for an invalid input file.
+MAX_ERRORS = 10
+# Lines read from an input file at once.
+READ_LINES = 256
+
+# Runs one request: (endpoint, body, tenant) -> (status code, JSON body)
+Dispatch = Callable[[str, bytes, Optional[str]], Awaitable[Tuple[int, Any]]]
+
+
+class FileStore(object):
+    """Files in a directory: the content in `<id>`, the file object and its owner in `<id>.json`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def content_path(self, file_id: str) -> str:
+        return os.path.join(self.path, file_id)
+
+    def get(self, file_id: str, tenant: Optional[str] = None) -> Optional[dict]:
+        """The file object, None if it does not exist or belongs to another tenant."""
+        if not is_id(file_id, 'file-'):
+            return None
+        record = read_json(os.path.join(self.path, file_id + '.json'))
+        if record is None or record.get('tenant') != tenant:
+            return None
+        file = record['file']
+        try:
+            # Output files grow while their batch runs.
+            file['bytes'] = os.path.getsize(self.content_path(file_id))
+        except OSError:
+            return None
+        return file
+
+    def list(self, tenant: Optional[str] = None, purpose: Optional[str] = None) -> List[dict]:
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                file = self.get(name[:-len('.json')], tenant)
+                if file is not None and (purpose is None or file['purpose'] == purpose):
+                    files.append(file)
+        return sorted(files, key=lambda file: file['created_at'], reverse=True)
+
+    async def save(self, chunks: AsyncIterable[bytes], filename: str, purpose: str, tenant: Optional[str]) -> dict:
+        """Write an uploaded file as it is received."""
+        file_id = new_id('file-')
+        path = self.content_path(file_id)
+        size = 0
+        try:
+            with open(path + '.part', 'wb') as f:
+                async for chunk in chunks:
+                    if chunk:
+                        await asyncio.to_thread(f.write, chunk)
+                        size += len(chunk)
+            os.replace(path + '.part', path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(path + '.part')
+            raise
+        return self._add(file_id, filename, purpose, tenant, size)
+
+    def create(self, filename: str, purpose: str, tenant: Optional[str]) -> dict:
+        """An empty file, written to by its owner."""
+        file_id = new_id('file-')
+        open(self.content_path(file_id), 'wb').close()
+        return self._add(file_id, filename, purpose, tenant, 0)
+
+    def delete(self, file_id: str, tenant: Optional[str] = None) -> bool:
+        if self.get(file_id, tenant) is None:
+            return False
+        os.remove(os.path.join(self.path, file_id + '.json'))
+        with contextlib.suppress(OSError):
+            os.remove(self.content_path(file_id))
+        return True
+
+    def _add(self, file_id: str, filename: str, purpose: str, tenant: Optional[str], size: int) -> dict:
+        file = {
+            'id': file_id,
+            'object': 'file',
+            'bytes': size,
+            'created_at': int(time.time()),
+            'filename': filename,
+            'purpose': purpose,
+        }
+        write_json(os.path.join(self.path, file_id + '.json'), {'file': file, 'tenant': tenant})
+        return file
+
+
+class Batches(object):
+    """Batches of requests run in the background, their state in `<id>.json` files of a directory."""
+
+    def __init__(
+        self,
+        path: str,
+        files: FileStore,
+        dispatch: Dispatch,
+        concurrency: int = 8,
+        requests_per_second: float = 0,
+        checkpoint_seconds: float = 1.0,
+        scan_seconds: float = 30.0,
+    ):
+        self.path = path
+        self.files = files
+        self.dispatch = dispatch
+        self.concurrency = max(concurrency, 1)
+        self.requests_per_second = requests_per_second
+        self.checkpoint_seconds = checkpoint_seconds
+        self.scan_seconds = scan_seconds
+        self.buckets = MemoryStateStore()
+        # Jobs running in this process.
+        self.jobs: Dict[str, 'BatchJob'] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._scan_task: Optional[asyncio.Task] = None
+        os.makedirs(path, exist_ok=True)
+
+    def load(self, batch_id: str) -> Optional[dict]:
+        """The stored record of a batch: the batch object, its tenant and its checkpoint."""
+        if not is_id(batch_id, 'batch_'):
+            return None
+        return read_json(os.path.join(self.path, batch_id + '.json'))
+
+    def save(self, record: dict):
+        write_json(os.path.join(self.path, record['batch']['id'] + '.json'), record)
+
+    def get(self, batch_id: str, tenant: Optional[str] = None) -> Optional[dict]:
+        job = self.jobs.get(batch_id)
+        record = job.record if job is not None else self.load(batch_id)
+        if record is None or record.get('tenant') != tenant:
+            return None
+        return record['batch']
+
+    def list(
+        self, tenant: Optional[str] = None, after: Optional[str] = None, limit: int = 20,
+    ) -> Tuple[List[dict], bool]:
+        """Batches of a tenant, most recent first, after the batch `after` if set, and whether there are more."""
+        batches = []
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                batch = self.get(name[:-len('.json')], tenant)
+                if batch is not None:
+                    batches.append(batch)
+        batches.sort(key=lambda batch: (batch['created_at'], batch['id']), reverse=True)
+        if after is not None:
+            ids = [batch['id'] for batch in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        return batches[:limit], len(batches) > limit
+
+    def create(
+        self,
+        input_file_id: str,
+        endpoint: str,
+        completion_window: str = '24h',
+        metadata: Optional[dict] = None,
+        tenant: Optional[str] = None,
+    ) -> dict:
+        if endpoint not in ENDPOINTS:
+            raise APIError(400, f"Unsupported endpoint {endpoint}, expected one of {', '.join(ENDPOINTS)}")
+        if completion_window not in COMPLETION_WINDOWS:
+            raise APIError(400, f"Unsupported completion_window {completion_window}, expected 24h")
+        if metadata is not None and not isinstance(metadata, dict):
+            raise APIError(400, "'metadata' must be an object")
+        file = self.files.get(input_file_id, tenant)
+        if file is None:
+            raise APIError(404, f"File {input_file_id} not found")
+        if file['purpose'] != 'batch':
+            raise APIError(400, f"File {input_file_id} was not uploaded for the batch purpose")
+        now = int(time.time())
+        batch = {
+            'id': new_id('batch_'),
+            'object': 'batch',
+            'endpoint': endpoint,
+            'errors': None,
+            'input_file_id': input_file_id,
+            'completion_window': completion_window,
+            'status': 'validating',
+            'output_file_id': None,
+            'error_file_id': None,
+            'created_at': now,
+            'in_progress_at': None,
+            'expires_at': now + COMPLETION_WINDOWS[completion_window],
+            'finalizing_at': None,
+            'completed_at': None,
+            'failed_at': None,
+            'expired_at': None,
+            'cancelling_at': None,
+            'cancelled_at': None,
+            'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+            'metadata': metadata,
+        }
+        self.save({'batch': batch, 'tenant': tenant, 'checkpoint': None})
+        self._spawn(batch['id'])
+        return batch
+
+    def cancel(self, batch_id: str, tenant: Optional[str] = None) -> Optional[dict]:
+        job = self.jobs.get(batch_id)
+        if job is not None:
+            if job.record.get('tenant') != tenant:
+                return None
+            job.cancel()
+            return job.record['batch']
+        record = self.load(batch_id)
+        if record is None or record.get('tenant') != tenant:
+            return None
+        batch = record['batch']
+        if batch['status'] not in FINAL_STATUSES and batch['status'] != 'cancelling':
+            batch.update(status='cancelling', cancelling_at=int(time.time()))
+            self.save(record)
+            # Finalized here, or by the process running it at its next checkpoint.
+            self._spawn(batch_id)
+        return batch
+
+    def start(self):
+        """Resume the unfinished batches now and then, those of crashed processes included."""
+        if self._scan_task is None:
+            self._scan_task = asyncio.create_task(self._scan())
+
+    async def stop(self):
+        """Stop the running batches at a checkpoint, they are resumed on the next start."""
+        tasks = list(self._tasks)
+        if self._scan_task is not None:
+            tasks.append(self._scan_task)
+            self._scan_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _scan(self):
+        while True:
+            for name in os.listdir(self.path):
+                if not name.endswith('.json'):
+                    continue
+                batch_id = name[:-len('.json')]
+                record = self.load(batch_id)
+                if record is not None and record['batch']['status'] not in FINAL_STATUSES:
+                    self._spawn(batch_id)
+            await asyncio.sleep(self.scan_seconds)
+
+    def _spawn(self, batch_id: str):
+        if batch_id in self.jobs:
+            return
+        lock = open(os.path.join(self.path, batch_id + '.lock'), 'w')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Run by another process.
+            lock.close()
+            return
+        record = self.load(batch_id)
+        if record is None or record['batch']['status'] in FINAL_STATUSES:
+            lock.close()
+            return
+        job = self.jobs[batch_id] = BatchJob(self, record)
+        task = job.task = asyncio.create_task(job.run())
+        self._tasks.add(task)
+
+        def done(task: asyncio.Task):
+            self._tasks.discard(task)
+            self.jobs.pop(batch_id, None)
+            lock.close()
+            if not task.cancelled() and task.exception() is not None:
+                logger.error("Batch %s stopped: %r", batch_id, task.exception())
+        task.add_done_callback(done)
+
+
+class BatchJob(object):
+    """One run of a batch, from its checkpoint to its end."""
+
+    def __init__(self, batches: Batches, record: dict):
+        self.batches = batches
+        self.record = record
+        self.batch = record['batch']
+        self.tenant: Optional[str] = record.get('tenant')
+        # Line before which all requests are done, its offset in the input file,
+        # and the lines done after it.
+        self.line = 0
+        self.offset = 0
+        self.done: Set[int] = set()
+        # End offsets of the lines read and not checkpointed yet.
+        self.ends: Dict[int, int] = {}
+        self.progress = asyncio.Event()
+        # Final status the job is stopping for: cancelled or expired.
+        self.stopping: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.output = None
+        self.errors = None
+        # Write of the last checkpoint, in a thread that outlives the task awaiting it.
+        self.persisting: Optional[asyncio.Future] = None
+        self.persist_lock = asyncio.Lock()
+        # At most this many lines are read ahead of the checkpoint line.
+        self.window = max(batches.concurrency * 16, READ_LINES)
+
+    def cancel(self):
+        if self.batch['status'] not in FINAL_STATUSES and self.batch['status'] != 'cancelling':
+            self.batch.update(status='cancelling', cancelling_at=int(time.time()))
+        self.stopping = 'cancelled'
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        try:
+            if self.batch['status'] == 'validating' and not await self._validate():
+                return
+            if self.batch['status'] == 'cancelling':
+                self.stopping = 'cancelled'
+            else:
+                await self._run()
+        except asyncio.CancelledError:
+            if self.stopping is None:
+                raise
+        self._finish(self.stopping or 'completed')
+
+    async def _run(self):
+        files = self.batches.files
+        checkpoint = self.record['checkpoint']
+        self.line, self.offset = checkpoint['line'], checkpoint['offset']
+        self.done = set(checkpoint['done'])
+        if self.line or self.done:
+            logger.info("Batch %s resumed at line %d", self.batch['id'], self.line + 1)
+        self.output = open_truncated(files.content_path(self.batch['output_file_id']), checkpoint['output_bytes'])
+        self.errors = open_truncated(files.content_path(self.batch['error_file_id']), checkpoint['error_bytes'])
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.batches.concurrency)
+        workers = [asyncio.create_task(self._work(queue)) for _ in range(self.batches.concurrency)]
+        ticker = asyncio.create_task(self._tick())
+        try:
+            await self._read(queue)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            if self.stopping is None:
+                # Shutdown: the batch is resumed on the next start.
+                await self._checkpoint()
+            raise
+        finally:
+            ticker.cancel()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(ticker, *workers, return_exceptions=True)
+            # The final status is saved after this one, and the files are not closed under it.
+            await self._persisted()
+            for f in (self.output, self.errors):
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+
+    async def _validate(self) -> bool:
+        """Count the requests of the input file, fail the batch if a line is invalid."""
+        path = self.batches.files.content_path(self.batch['input_file_id'])
+        try:
+            total, errors = await asyncio.to_thread(validate_input, path, self.batch['endpoint'])
+        except OSError as e:
+            total, errors = 0, [{'code': 'invalid_file', 'message': f"Input file can not be read: {e}", 'line': None}]
+        if errors:
+            self.batch.update(status='failed', failed_at=int(time.time()), errors={'object': 'list', 'data': errors})
+            self.batches.save(self.record)
+            logger.warning("Batch %s failed validation: %s", self.batch['id'], errors[0]['message'])
+            return False
+        files = self.batches.files
+        batch_id = self.batch['id']
+        self.batch.update(
+            status='in_progress',
+            in_progress_at=int(time.time()),
+            output_file_id=files.create(f"{batch_id}_output.jsonl", 'batch_output', self.tenant)['id'],
+            error_file_id=files.create(f"{batch_id}_error.jsonl", 'batch_output', self.tenant)['id'],
+        )
+        self.batch['request_counts']['total'] = total
+        self.record['checkpoint'] = {'line': 0, 'offset': 0, 'done': [], 'output_bytes': 0, 'error_bytes': 0}
+        self.batches.save(self.record)
+        logger.info("Batch %s started: %d requests to %s", batch_id, total, self.batch['endpoint'])
+        return True
+
+    async def _read(self, queue: asyncio.Queue):
+        """Queue the requests of the input file from the checkpoint, the ones already done excepted."""
+        path = self.batches.files.content_path(self.batch['input_file_id'])
+        with open(path, 'rb') as f:
+            f.seek(self.offset)
+            index, position = self.line, self.offset
+            while True:
+                lines = await asyncio.to_thread(read_lines, f, READ_LINES)
+                if not lines:
+                    return
+                for line in lines:
+                    position += len(line)
+                    self.ends[index] = position
+                    if index in self.done or not line.strip():
+                        self._complete(index)
+                    else:
+                        while index - self.line >= self.window:
+                            self.progress.clear()
+                            await self.progress.wait()
+                        await queue.put((index, line))
+                    index += 1
+
+    async def _work(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, line = item
+            result, failed = await self._call(line)
+            (self.errors if failed else self.output).write(jsonlib.dumps(result) + b'\n')
+            self.batch['request_counts']['failed' if failed else 'completed'] += 1
+            self._complete(index)
+
+    async def _call(self, line: bytes) -> Tuple[dict, bool]:
+        request = jsonlib.loads(line)
+        rate = self.batches.requests_per_second
+        while rate:
+            wait = self.batches.buckets.take(self.batch['id'], rate, max(rate, 1), 1)
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+        try:
+            status_code, body = await self.batches.dispatch(
+                self.batch['endpoint'], jsonlib.dumps(request['body']), self.tenant)
+        except Exception as e:
+            logger.warning("Batch %s request %s failed: %r", self.batch['id'], request.get('custom_id'), e)
+            status_code, body = 500, {'error': {'message': f"Internal error: {e.__class__.__name__}"}}
+        request_id = new_id('batch_req_')
+        result = {
+            'id': request_id,
+            'custom_id': request.get('custom_id'),
+            'response': {'status_code': status_code, 'request_id': request_id, 'body': body},
+            'error': None,
+        }
+        failed = status_code >= 400
+        if failed:
+            error = body.get('error') if isinstance(body, dict) else None
+            message = error.get('message') if isinstance(error, dict) else None
+            result['error'] = {'code': str(status_code), 'message': message or f"Status {status_code}"}
+        return result, failed
+
+    def _complete(self, index: int):
+        """Mark a line done, and move the checkpoint line past the lines done in a row."""
+        self.done.add(index)
+        while self.line in self.done and self.line in self.ends:
+            self.done.remove(self.line)
+            self.offset = self.ends.pop(self.line)
+            self.line += 1
+        self.progress.set()
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(self.batches.checkpoint_seconds)
+            stored = self.batches.load(self.batch['id'])
+            if stored is not None and stored['batch']['status'] == 'cancelling':
+                # Cancelled through another process.
+                self.batch.update(status='cancelling', cancelling_at=stored['batch']['cancelling_at'])
+            if self.batch['status'] == 'cancelling':
+                self.stopping = 'cancelled'
+            elif time.time() > self.batch['expires_at']:
+                self.stopping = 'expired'
+            if self.stopping is not None:
+                self.task.cancel()
+                return
+            await self._checkpoint()
+
+    def _snapshot(self) -> bytes:
+        """Checkpoint consistent with the output files: no result is written between the flush and the sizes."""
+        self.output.flush()
+        self.errors.flush()
+        self.record['checkpoint'] = {
+            'line': self.line,
+            'offset': self.offset,
+            'done': sorted(self.done),
+            'output_bytes': self.output.tell(),
+            'error_bytes': self.errors.tell(),
+        }
+        return jsonlib.dumps(self.record)
+
+    async def _checkpoint(self):
+        async with self.persist_lock:
+            # One write at a time, so an older checkpoint never replaces a newer one.
+            await self._persisted()
+            data = self._snapshot()
+            self.persisting = asyncio.ensure_future(asyncio.to_thread(self._persist, data))
+            await asyncio.shield(self.persisting)
+
+    async def _persisted(self):
+        """Wait for the checkpoint being written, if any, even when the task waiting for it was cancelled."""
+        if self.persisting is not None and not self.persisting.done():
+            await asyncio.wait([self.persisting])
+
+    def _persist(self, data: bytes):
+        os.fsync(self.output.fileno())
+        os.fsync(self.errors.fileno())
+        write_bytes(os.path.join(self.batches.path, self.batch['id'] + '.json'), data)
+
+    def _finish(self, status: str):
+        """Store the final status, once the output files are closed."""
+        now = int(time.time())
+        if status == 'completed':
+            self.batch.update(finalizing_at=now, completed_at=now)
+        else:
+            self.batch[f"{status}_at"] = now
+        self.batch['status'] = status
+        self.batches.save(self.record)
+        counts = self.batch['request_counts']
+        logger.info("Batch %s %s: %d completed, %d failed of %d", self.batch['id'], status,
+                    counts['completed'], counts['failed'], counts['total'])
+
+
+async def response_json(response: Response) -> Any:
+    """The JSON body of a response, read to the end for streaming responses."""
+    if isinstance(response, (StreamingResponse, EventSourceResponse)):
+        parts = []
+        try:
+            async for part in response.body_iterator:
+                parts.append(part.encode() if isinstance(part, str) else part)
+        finally:
+            await aclose_iterator(response.body_iterator)
+            if response.background is not None:
+                await response.background()
+        body = b''.join(parts)
+    else:
+        body = response.body
+    try:
+        return jsonlib.loads(body)
+    except ValueError:
+        return {'error': {'message': body.decode('utf-8', 'replace')[:1000]}}
+
+
+def validate_input(path: str, endpoint: str) -> Tuple[int, List[dict]]:
+    """Number of requests of an input file, and the first errors found in it."""
+    total = 0
+    errors: List[dict] = []
+    with open(path, 'rb') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            total += 1
+            message = check_line(line, endpoint)
+            if message is not None:
+                errors.append({'code': 'invalid_request', 'message': message, 'line': number})
+                if len(errors) >= MAX_ERRORS:
+                    break
+    if not total and not errors:
+        errors.append({'code': 'empty_file', 'message': "The input file has no requests", 'line': None})
+    return total, errors
+
+
+def check_line(line: bytes, endpoint: str) -> Optional[str]:
+    try:
+        request = jsonlib.loads(line)
+    except ValueError:
+        return "Invalid JSON"
+    if not isinstance(request, dict):
+        return "A request must be an object"
+    if not isinstance(request.get('custom_id'), str):
+        return "'custom_id' is required"
+    if request.get('method', 'POST') != 'POST':
+        return "'method' must be POST"
+    if request.get('url') != endpoint:
+        return f"'url' must be the endpoint of the batch, {endpoint}"
+    if not isinstance(request.get('body'), dict):
+        return "'body' must be an object"
+    return None
+
+
+def read_lines(f, count: int) -> List[bytes]:
+    return list(itertools.islice(f, count))
+
+
+def open_truncated(path: str, size: int):
+    """Open a file to append to it, from `size`: what was written after a checkpoint is dropped."""
+    f = open(path, 'r+b')
+    f.truncate(size)
+    f.seek(size)
+    return f
+
+
+def new_id(prefix: str) -> str:
+    return prefix + uuid.uuid4().hex
+
+
+def is_id(value: str, prefix: str) -> bool:
+    """Ids are checked before they are used in paths."""
+    return value.startswith(prefix) and value[len(prefix):].isalnum()
+
+
+def read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path, 'rb') as f:
+            return jsonlib.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def write_json(path: str, data: dict):
+    write_bytes(path, jsonlib.dumps(data))
+
+
+def write_bytes(path: str, data: bytes):
+    """Replace a file at once, readers never see it half written."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set
+
+from starlette.responses import Response, JSONResponse
+
+from llm_fusion_api.provider.base import EmbeddingHandler
+from llm_fusion_api.response import APIError
+from llm_fusion_api.schema import EmbeddingRequest
+from llm_fusion_api.tokens import split_tokens
+
+
+logger = logging.getLogger(__name__)
+
+
+class PendingBatch(object):
+    def __init__(self, model: str, body: dict):
+        self.model = model
+        self.body = body
+        self.inputs: List[str] = []
+        self.futures: List[asyncio.Future] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class CoalescingEmbeddingHandler(EmbeddingHandler):
+    """Wraps an embedding handler to coalesce concurrent single-input requests.
+
+    Single-input requests for the same model are collected for up to `window` seconds,
+    or until `max_batch_size` inputs are pending, then sent upstream as one batch and
+    each vector is routed back to its caller. Other requests go straight to the handler.
+    """
+
+    def __init__(self, handler: EmbeddingHandler, window: float, max_batch_size: int):
+        self.handler = handler
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.pending: Dict[tuple, PendingBatch] = {}
+        self.batches = 0
+        self.coalesced = 0
+        self._tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def single_input(body: dict) -> Optional[str]:
+        inputs = body.get('input')
+        if isinstance(inputs, list) and len(inputs) == 1:
+            inputs = inputs[0]
+        if isinstance(inputs, str) and body.get('encoding_format', 'float') == 'float':
+            return inputs
+        return None
+
+    async def embeddings(self, request: EmbeddingRequest, model: str) -> Response:
+        input = self.single_input(request.body)
+        if input is None:
+            return await self.handler.embeddings(request, model)
+        try:
+            return JSONResponse(await self.create_embeddings(model, [input], request.body))
+        except APIError as e:
+            return e.response()
+
+    async def create_embeddings(self, model: str, inputs: List[str], body: dict) -> dict:
+        if len(inputs) != 1:
+            return await self.handler.create_embeddings(model, inputs, body)
+
+        key = (model, body.get('dimensions'))
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = PendingBatch(model, body)
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, key, batch)
+        future = asyncio.get_running_loop().create_future()
+        batch.inputs.append(inputs[0])
+        batch.futures.append(future)
+        if len(batch.inputs) >= self.max_batch_size:
+            self._flush(key, batch)
+
+        embedding, tokens = await future
+        return {
+            'object': 'list',
+            'model': model,
+            'data': [{'object': 'embedding', 'index': 0, 'embedding': embedding}],
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        }
+
+    def _flush(self, key: tuple, batch: PendingBatch):
+        if self.pending.get(key) is not batch:
+            return
+        del self.pending[key]
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: PendingBatch):
+        self.batches += 1
+        self.coalesced += len(batch.inputs)
+        try:
+            res_body = await self.handler.create_embeddings(batch.model, batch.inputs, batch.body)
+            data = sorted(res_body['data'], key=lambda d: d['index'])
+            if len(data) != len(batch.inputs):
+                raise APIError(502, f"Expected {len(batch.inputs)} embeddings, got {len(data)}")
+        except Exception as e:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        tokens = split_tokens(batch.inputs, res_body.get('usage', {}).get('prompt_tokens', 0))
+        for future, item, n in zip(batch.futures, data, tokens):
+            if not future.done():
+                future.set_result((item['embedding'], n))
+
+    def stats(self) -> Dict[str, int]:
+        return {"batches": self.batches, "inputs": self.coalesced}
+
+    async def aclose(self):
+        for key, batch in list(self.pending.items()):
+            self._flush(key, batch)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,128 @@
+import time
+import logging
+from collections import deque
+from typing import Deque, Dict
+
+from llm_fusion_api.response import ErrorResponse
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+# Numeric values of the states on /metrics.
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker(object):
+    """Circuit breaker of one provider/model.
+
+    Closed, it keeps the outcomes of the last `window` calls and opens once at least
+    `min_calls` were made and `error_rate` of them failed. Calls slower than
+    `slow_seconds` (time to the first chunk for streams) count as failures. Open, calls
+    are rejected for `open_seconds`, then it is half-open: `half_open_calls` probes are
+    let through, it closes if they all succeed and opens again on the first failure.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        window: int = 20,
+        min_calls: int = 10,
+        error_rate: float = 0.5,
+        slow_seconds: float = 0,
+        open_seconds: float = 30,
+        half_open_calls: int = 3,
+    ):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+        self.failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probes = 0
+        self.probe_successes = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        """Whether a call may go upstream, call `record` or `release` once it is done."""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                self.rejected += 1
+                return False
+            self.state = HALF_OPEN
+            self.probes = self.probe_successes = 0
+            logger.info("Circuit breaker of %s half-open", self.name)
+        if self.state == HALF_OPEN:
+            if self.probes >= self.half_open_calls:
+                self.rejected += 1
+                return False
+            self.probes += 1
+        return True
+
+    def record(self, failed: bool, latency: float = 0):
+        if self.slow_seconds and latency > self.slow_seconds:
+            failed = True
+        if self.state == HALF_OPEN:
+            if failed:
+                self._open()
+            else:
+                self.probe_successes += 1
+                if self.probe_successes >= self.half_open_calls:
+                    self._close()
+            return
+        if self.state == OPEN:
+            # Late outcome of a call started before the breaker opened.
+            return
+        if len(self.outcomes) == self.outcomes.maxlen:
+            self.failures -= self.outcomes[0]
+        self.outcomes.append(failed)
+        self.failures += failed
+        if len(self.outcomes) >= self.min_calls and self.failures >= self.error_rate * len(self.outcomes):
+            self._open()
+
+    def release(self):
+        """The call ended without an outcome (e.g. the client went away), free its probe slot."""
+        if self.state == HALF_OPEN and self.probes > self.probe_successes:
+            self.probes -= 1
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        logger.warning("Circuit breaker of %s open for %.0fs", self.name, self.open_seconds)
+
+    def _close(self):
+        self.state = CLOSED
+        self.outcomes.clear()
+        self.failures = 0
+        logger.info("Circuit breaker of %s closed", self.name)
+
+    def retry_after(self) -> int:
+        return max(int(self.opened_at + self.open_seconds - time.monotonic()) + 1, 1)
+
+    def reject(self) -> ErrorResponse:
+        response = ErrorResponse(503, f"{self.name} is unavailable, circuit breaker {self.state}")
+        response.headers['Retry-After'] = str(self.retry_after())
+        return response
+
+
+class CircuitBreakers(object):
+    """Circuit breakers by provider/model, created on first use with the same settings."""
+
+    def __init__(self, **options):
+        self.options = options
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            breaker = self.breakers[name] = CircuitBreaker(name, **self.options)
+        return breaker
+
+    def states(self) -> Dict[str, str]:
+        return {name: breaker.state for name, breaker in self.breakers.items()}
@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from starlette.responses import Response, JSONResponse, StreamingResponse
+from sse_starlette.sse import EventSourceResponse
+
+from llm_fusion_api.response import aclose_iterator
+from llm_fusion_api.sse import ChunkEncoder, DONE, event_source, iter_data
+from llm_fusion_api.state import StateStore
+
+
+logger = logging.getLogger(__name__)
+
+# A sweep of the directory over its size cap removes files down to this fraction of the cap.
+SWEEP_TARGET = 0.9
+
+# Request fields that change the completion and therefore are part of the cache key.
+KEY_FIELDS = (
+    'messages', 'temperature', 'top_p', 'n', 'stop', 'max_tokens', 'presence_penalty', 'frequency_penalty',
+    'logit_bias', 'functions', 'function_call', 'tools', 'tool_choice', 'response_format', 'seed',
+)
+
+
+def is_cacheable(body: dict) -> bool:
+    """Only deterministic requests (temperature 0) are cached."""
+    return body.get('temperature') == 0
+
+
+def make_key(provider: str, model: str, body: dict) -> str:
+    """Canonical hash of provider, model, messages and sampling params."""
+    key = {field: body[field] for field in KEY_FIELDS if field in body}
+    key['provider'] = provider
+    key['model'] = model
+    canonical = json.dumps(key, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResponseCache(object):
+    """Exact-match cache of chat completions.
+
+    Entries live in an in-memory LRU with TTL eviction, and optionally in a shared state
+    `store` (shared by the workers) and in a directory of JSON files (shared by restarts).
+    The directory is swept of its expired files on startup, and of its oldest files when
+    it grows over `max_bytes`. Completions are always stored in the non-stream shape and
+    replayed as SSE chunks for stream requests.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float,
+        directory: str = '',
+        store: Optional[StateStore] = None,
+        max_bytes: int = 0,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.store = store
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, Tuple[float, dict]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Size of the directory, as of the last sweep plus the files written since.
+        self.disk_bytes = 0
+        self.sweep_lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.sweep()
+
+    async def get(self, key: str) -> Optional[Tuple[dict, float]]:
+        """Return the cached completion and its age in seconds."""
+        now = time.time()
+        item = self.entries.get(key)
+        if item is not None and item[0] <= now:
+            del self.entries[key]
+            item = None
+        if item is None and self.store is not None:
+            data = await self.store.call(self.store.get, 'responses', key)
+            if data is not None:
+                expires_at, completion = json.loads(data)
+                item = (expires_at, completion)
+                self._put(key, item)
+        if item is None and self.directory:
+            item = await asyncio.to_thread(self._read, key, now)
+            if item is not None:
+                self._put(key, item)
+        if item is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        expires_at, completion = item
+        return completion, now - (expires_at - self.ttl)
+
+    async def set(self, key: str, completion: dict):
+        item = (time.time() + self.ttl, completion)
+        self._put(key, item)
+        if self.store is not None:
+            data = json.dumps(item, ensure_ascii=False).encode()
+            await self.store.call(self.store.set, 'responses', key, data, self.ttl)
+        if self.directory:
+            await asyncio.to_thread(self._write, key, item)
+
+    def _put(self, key: str, item: Tuple[float, dict]):
+        self.entries[key] = item
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def _read(self, key: str, now: float) -> Optional[Tuple[float, dict]]:
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data['expires_at'] <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return data['expires_at'], data['completion']
+
+    def _write(self, key: str, item: Tuple[float, dict]):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'expires_at': item[0], 'completion': item[1]}, f, ensure_ascii=False)
+            self.disk_bytes += f.tell()
+        os.replace(tmp, path)
+        if self.max_bytes and self.disk_bytes > self.max_bytes:
+            self.sweep()
+
+    def sweep(self):
+        """Remove the expired files of the directory, then the oldest ones while it is over `max_bytes`.
+
+        Files are dated by their modification time, the other workers may be sweeping too.
+        """
+        if not self.sweep_lock.acquire(blocking=False):
+            return
+        try:
+            now = time.time()
+            files = []
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    if not name.endswith('.json'):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in files)
+            target = self.max_bytes * SWEEP_TARGET if self.max_bytes else float('inf')
+            removed = 0
+            for mtime, size, path in sorted(files):
+                if mtime + self.ttl > now and total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+                removed += 1
+            self.disk_bytes = total
+            if removed:
+                logger.info("Response cache: removed %d files from %s, %d bytes left", removed, self.directory, total)
+        finally:
+            self.sweep_lock.release()
+
+    def replay(self, completion: dict, stream: bool, age: float) -> Response:
+        """Build the response of a cache hit."""
+        headers = {'X-Cache': 'HIT', 'Age': str(int(age))}
+        if not stream:
+            return JSONResponse(completion, headers=headers)
+        return event_source(replay_sse(completion), headers=headers)
+
+    async def capture(self, key: str, response: Response) -> Response:
+        """Store the completion of a successful upstream response once it has been sent."""
+        response.headers['X-Cache'] = 'MISS'
+        if response.status_code != 200:
+            return response
+        if isinstance(response, JSONResponse):
+            await self._store_completion(key, json.loads(response.body))
+        elif isinstance(response, EventSourceResponse):
+            # Our providers yield framed chunk events.
+            response.body_iterator = self._capture_events(key, response.body_iterator)
+        elif isinstance(response, StreamingResponse):
+            # Proxied upstream body, either a JSON completion or raw SSE text.
+            response.body_iterator = self._capture_body(key, response.body_iterator)
+        return response
+
+    async def _capture_events(self, key: str, iterator) -> AsyncIterator:
+        chunks = []
+        try:
+            async for item in iterator:
+                chunks.extend(data for data in iter_data(item) if data != '[DONE]')
+                yield item
+        finally:
+            await aclose_iterator(iterator)
+        try:
+            await self._store_chunks(key, [json.loads(chunk) for chunk in chunks])
+        except ValueError as e:
+            logger.warning("Response not cached, invalid chunk: %s", e)
+
+    async def _capture_body(self, key: str, iterator) -> AsyncIterator:
+        parts = []
+        try:
+            async for part in iterator:
+                parts.append(part.encode() if isinstance(part, str) else part)
+                yield part
+        finally:
+            await aclose_iterator(iterator)
+        text = b''.join(parts).decode()
+        try:
+            if not text.lstrip().startswith('data:'):
+                await self._store_completion(key, json.loads(text))
+                return
+            chunks = []
+            for line in text.splitlines():
+                if line.startswith('data:') and line[5:].strip() != '[DONE]':
+                    chunks.append(json.loads(line[5:]))
+            await self._store_chunks(key, chunks)
+        except ValueError as e:
+            logger.warning("Response not cached, invalid body: %s", e)
+
+    async def _store_completion(self, key: str, completion: dict):
+        if is_replayable(completion):
+            await self.set(key, completion)
+
+    async def _store_chunks(self, key: str, chunks: List[dict]):
+        completion = assemble_chunks(chunks)
+        if completion is not None:
+            await self.set(key, completion)
+
+
+def is_replayable(completion: dict) -> bool:
+    """Whether a completion can be replayed in both shapes: text answers only, as for streamed chunks."""
+    choices = completion.get('choices')
+    if not choices:
+        return False
+    for choice in choices:
+        message = choice.get('message') or {}
+        if message.get('tool_calls') or message.get('function_call') or not isinstance(message.get('content'), str):
+            # Function and tool calls are not cached.
+            return False
+    return True
+
+
+def assemble_chunks(chunks: List[dict]) -> Optional[dict]:
+    """Assemble streamed chunks into a completion, None if they can not be cached."""
+    if not chunks:
+        return None
+    choices: Dict[int, dict] = {}
+    usage = None
+    for chunk in chunks:
+        for choice in chunk.get('choices', []):
+            delta = choice.get('delta') or {}
+            if set(delta) - {'role', 'content'}:
+                # Function and tool calls are not cached.
+                return None
+            c = choices.setdefault(choice.get('index', 0), {'content': '', 'finish_reason': None})
+            c['content'] += delta.get('content') or ''
+            c['finish_reason'] = choice.get('finish_reason') or c['finish_reason']
+        usage = chunk.get('usage') or usage
+    if not choices or any(c['finish_reason'] is None for c in choices.values()):
+        # Incomplete stream
+        return None
+
+    first = chunks[0]
+    completion = {
+        'id': first.get('id'),
+        'object': "chat.completion",
+        'created': first.get('created'),
+        'model': first.get('model'),
+        'choices': [
+            {
+                'finish_reason': c['finish_reason'],
+                'index': index,
+                'message': {
+                    'role': "assistant",
+                    'content': c['content'],
+                },
+            }
+            for index, c in sorted(choices.items())
+        ],
+    }
+    if usage:
+        completion['usage'] = usage
+    return completion
+
+
+async def replay_sse(completion: dict):
+    """Replay a cached completion as SSE chunks, in the shape of the providers' streams."""
+    for choice in completion['choices']:
+        encoder = ChunkEncoder(completion['id'], completion['created'], completion['model'], choice['index'])
+        yield encoder.role()
+        yield encoder.content(choice['message']['content'])
+        yield encoder.finish(choice['finish_reason'], usage=completion.get('usage'))
+    yield DONE
@@ -0,0 +1,148 @@
+import json
+import time
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from llm_fusion_api.provider import Model
+from llm_fusion_api.state import StateStore, fetch_once
+
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogEntry(object):
+    models: List[Model]
+    fetched_at: float
+    expires_at: float
+    error: Optional[str]
+
+    def __init__(self, models: List[Model], expires_at: float, error: Optional[str] = None):
+        self.models = models
+        self.fetched_at = time.monotonic()
+        self.expires_at = expires_at
+        self.error = error
+
+
+class ModelCatalog(object):
+    """Cached model list of all providers.
+
+    Providers are queried concurrently. Results are cached for `ttl` seconds, expired
+    entries are served stale while a background task refreshes them, and a provider
+    that fails only contributes an error marker instead of failing the whole listing.
+    `on_update` is called with the name, models and error of a provider after each refresh.
+    With a shared `store`, a list fetched by another process and not expired yet is reused.
+    """
+    # Failed providers without any cached models are retried sooner than `ttl`.
+    error_ttl: float = 10
+
+    def __init__(self, providers: Dict, ttl: float, timeout: float,
+                 on_update: Optional[Callable[[str, List[Model], Optional[str]], None]] = None,
+                 store: Optional[StateStore] = None):
+        self.providers = providers
+        self.ttl = ttl
+        self.timeout = timeout
+        self.on_update = on_update
+        self.store = store
+        self.entries: Dict[str, CatalogEntry] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self._loop_task: Optional[asyncio.Task] = None
+
+    async def list_models(self) -> Tuple[List[Model], Dict[str, str]]:
+        """Return all known models and the errors of providers that failed to list them."""
+        now = time.monotonic()
+        missing = []
+        for name in self.providers:
+            entry = self.entries.get(name)
+            if entry is None:
+                missing.append(name)
+            elif entry.expires_at <= now:
+                # Serve stale and refresh in the background.
+                self._refresh_task(name)
+        if missing:
+            await asyncio.gather(*[asyncio.shield(self._refresh_task(name)) for name in missing])
+
+        models: List[Model] = []
+        errors: Dict[str, str] = {}
+        for name in self.providers:
+            entry = self.entries.get(name)
+            if entry is None:
+                continue
+            models.extend(entry.models)
+            if entry.error:
+                errors[name] = entry.error
+        return models, errors
+
+    def _refresh_task(self, name: str) -> asyncio.Task:
+        """Return the in-flight refresh of a provider, starting one if needed."""
+        task = self._refreshing.get(name)
+        if task is None:
+            task = asyncio.create_task(self._refresh(name))
+            self._refreshing[name] = task
+            task.add_done_callback(lambda t: self._forget(name, t))
+        return task
+
+    def _forget(self, name: str, task: asyncio.Task):
+        if self._refreshing.get(name) is task:
+            del self._refreshing[name]
+
+    async def _refresh(self, name: str):
+        provider = self.providers[name]
+        try:
+            if self.store is None:
+                models = await asyncio.wait_for(provider.list_models(), timeout=self.timeout)
+                expires_at = time.time() + self.ttl
+            else:
+                models, expires_at = await fetch_once(
+                    self.store, f"models:{name}", lambda: self._load(name), lambda: self._fetch(name), self.timeout)
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            logger.warning("List models from %s failed: %s", name, error)
+            previous = self.entries.get(name)
+            if previous is not None and previous.models:
+                # Keep serving the last good list, but mark it.
+                previous.error = error
+                previous.expires_at = time.monotonic() + self.error_ttl
+            else:
+                self.entries[name] = CatalogEntry([], time.monotonic() + self.error_ttl, error)
+        else:
+            self.entries[name] = CatalogEntry(models, time.monotonic() + expires_at - time.time())
+        if self.on_update is not None:
+            entry = self.entries[name]
+            self.on_update(name, entry.models, entry.error)
+
+    async def _fetch(self, name: str) -> Tuple[List[Model], float]:
+        models = await asyncio.wait_for(self.providers[name].list_models(), timeout=self.timeout)
+        expires_at = time.time() + self.ttl
+        data = {'expires_at': expires_at, 'models': [[model.name, model.type] for model in models]}
+        await self.store.call(self.store.set, 'models', name, json.dumps(data).encode(), self.ttl)
+        return models, expires_at
+
+    async def _load(self, name: str) -> Optional[Tuple[List[Model], float]]:
+        data = await self.store.call(self.store.get, 'models', name)
+        if data is None:
+            return None
+        data = json.loads(data)
+        return [Model(name, model, type) for model, type in data['models']], data['expires_at']
+
+    async def refresh_all(self):
+        await asyncio.gather(*[asyncio.shield(self._refresh_task(name)) for name in self.providers])
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            await self.refresh_all()
+
+    def start(self):
+        """Keep the catalog fresh in the background, after `refresh_all` warmed it."""
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        tasks = list(self._refreshing.values())
+        if self._loop_task is not None:
+            tasks.append(self._loop_task)
+            self._loop_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
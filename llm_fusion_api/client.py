@@ -0,0 +1,126 @@
+import logging
+from typing import Dict, List, Optional
+
+import httpx
+
+from llm_fusion_api import settings, metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class CountingTransport(httpx.AsyncBaseTransport):
+    """Transport counting the requests waiting for their response, and the ones that failed before it."""
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport):
+        self.transport = transport
+        self.in_flight = 0
+        self.errors = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        try:
+            return await self.transport.handle_async_request(request)
+        except BaseException:
+            # Transport errors, timeouts and cancellations.
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class ClientPool(object):
+    """Long-lived pooled `httpx.AsyncClient` owned by one provider.
+
+    The client is created lazily on first use and closed by `aclose()`, which the
+    app calls on shutdown. Keep-alive connections are reused across requests so
+    only the first call to an upstream pays the TCP/TLS handshake.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_connections: Optional[int] = None,
+        max_keepalive_connections: Optional[int] = None,
+        keepalive_expiry: Optional[float] = None,
+        timeout: Optional[float] = None,
+        http2: Optional[bool] = None,
+    ):
+        self.name = name
+        self.limits = httpx.Limits(
+            max_connections=max_connections or settings.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=max_keepalive_connections or settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=keepalive_expiry if keepalive_expiry is not None else settings.HTTP_KEEPALIVE_EXPIRY,
+        )
+        self.timeout = timeout if timeout is not None else settings.HTTP_TIMEOUT
+        self.http2 = settings.HTTP2 if http2 is None else http2
+        self.requests = 0
+        self.responses = 0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._transport: Optional[CountingTransport] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = self._create_client()
+        return self._client
+
+    def _create_client(self) -> httpx.AsyncClient:
+        try:
+            transport = httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2)
+        except ImportError:
+            logger.warning("HTTP/2 is not available for %s, install httpx[http2]. Falling back to HTTP/1.1", self.name)
+            self.http2 = False
+            transport = httpx.AsyncHTTPTransport(limits=self.limits)
+        # Counters of a previous client carry over.
+        previous = self._transport
+        self._transport = CountingTransport(transport)
+        if previous is not None:
+            self._transport.errors = previous.errors
+        return httpx.AsyncClient(
+            transport=self._transport,
+            timeout=self.timeout,
+            event_hooks={"request": [self._on_request], "response": [self._on_response]},
+        )
+
+    async def _on_request(self, request: httpx.Request):
+        self.requests += 1
+
+    async def _on_response(self, response: httpx.Response):
+        self.responses += 1
+        metrics.observe_upstream(self.name, response.status_code)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _connections(self) -> Optional[List[bool]]:
+        """Whether each connection of the pool is idle, None if the pool can not be inspected."""
+        if self._transport is None:
+            return []
+        # httpx does not expose the pool publicly, read it from httpcore and give up if its internals changed.
+        try:
+            return [conn.is_idle() for conn in self._transport.transport._pool.connections]
+        except AttributeError:
+            return None
+
+    def stats(self) -> Dict[str, int]:
+        """Pool metrics: requests sent, responses received, requests failed or waiting, and connections held."""
+        stats = {
+            "requests": self.requests,
+            "responses": self.responses,
+            "errors": self._transport.errors if self._transport is not None else 0,
+            "in_flight": self._transport.in_flight if self._transport is not None else 0,
+            "max_connections": self.limits.max_connections or 0,
+        }
+        connections = self._connections()
+        if connections is not None:
+            idle = sum(connections)
+            stats["connections"] = len(connections)
+            stats["idle_connections"] = idle
+            stats["active_connections"] = len(connections) - idle
+        return stats
@@ -0,0 +1,215 @@
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import httpx
+from starlette.responses import Response, StreamingResponse
+from sse_starlette.sse import EventSourceResponse
+
+from llm_fusion_api.response import ErrorResponse, APIError, aclose_iterator
+
+
+logger = logging.getLogger(__name__)
+
+# Upstream status codes telling that it is over capacity.
+OVERLOAD_STATUS_CODES = (429, 503)
+
+
+def is_overload_error(e: BaseException) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in OVERLOAD_STATUS_CODES
+    if isinstance(e, APIError):
+        return e.status_code in OVERLOAD_STATUS_CODES
+    return isinstance(e, httpx.TimeoutException)
+
+
+class Overloaded(APIError):
+    """The queue of a limiter is full or the wait for a slot timed out, rendered as a 503 with `Retry-After`"""
+    def __init__(self, message: str):
+        super().__init__(503, message)
+
+    def response(self) -> ErrorResponse:
+        response = super().response()
+        response.headers['Retry-After'] = '1'
+        return response
+
+
+class AdaptiveLimiter(object):
+    """Adaptive cap on the concurrent calls to one provider/model (AIMD).
+
+    Each call is a sample: its latency (to the first chunk for streams) and whether the
+    upstream was overloaded (429, 503 or a timeout). Overload, or a latency over
+    `latency_tolerance` times the median of the recent ones, multiplies the limit by
+    `backoff`, only for calls started after the last decrease so a burst of failures of
+    calls made under the previous limit counts once. Successful calls made at the limit
+    raise it by `1 / limit`, about one per round of calls. Calls over the limit wait in a
+    priority queue of at most `queue_size` calls for up to `max_wait` seconds.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial_limit: int = 16,
+        min_limit: int = 1,
+        max_limit: int = 256,
+        backoff: float = 0.7,
+        latency_tolerance: float = 2.0,
+        queue_size: int = 100,
+        max_wait: float = 10.0,
+        window: int = 100,
+    ):
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.last_decrease = 0.0
+        # Recent latencies of non-stream calls and of streams, which are not comparable.
+        self.latencies: Dict[bool, Deque[float]] = {False: deque(maxlen=window), True: deque(maxlen=window)}
+        self._medians: Dict[bool, Optional[float]] = {False: None, True: None}
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority: int = 0) -> bool:
+        """Take a slot, waiting in the queue if needed, higher priorities first. False if there is none."""
+        if self.in_flight < self.limit and not self.waiting:
+            self.in_flight += 1
+            return True
+        if self.waiting >= self.queue_size:
+            self.rejected += 1
+            return False
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (-priority, next(self._counter), future))
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+            return True
+        except BaseException as e:
+            if future.done():
+                # Granted while giving up.
+                self.release()
+            else:
+                future.cancel()
+                self.waiting -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                return False
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._queue and self.in_flight < self.limit:
+            _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            future.set_result(True)
+            self.waiting -= 1
+            self.in_flight += 1
+
+    def median(self, stream: bool) -> Optional[float]:
+        median = self._medians[stream]
+        if median is None and self.latencies[stream]:
+            samples = sorted(self.latencies[stream])
+            median = self._medians[stream] = samples[len(samples) // 2]
+        return median
+
+    def sample(self, start: float, overloaded: bool, stream: bool = False):
+        """Adjust the limit with the outcome of a call started at `start` (time.monotonic)."""
+        latency = time.monotonic() - start
+        median = self.median(stream)
+        slow = bool(self.latency_tolerance and median and latency > median * self.latency_tolerance)
+        if not overloaded:
+            self.latencies[stream].append(latency)
+            self._medians[stream] = None
+        if overloaded or slow:
+            if start >= self.last_decrease:
+                self.last_decrease = time.monotonic()
+                limit = max(self.limit * self.backoff, self.min_limit)
+                if int(limit) != int(self.limit):
+                    logger.debug("%s concurrency limit %d -> %d (%s)", self.name, self.limit, limit,
+                                'overloaded' if overloaded else f'latency {latency:.2f}s')
+                self.limit = limit
+        elif self.in_flight >= self.limit - 1:
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self._wake()
+
+    def wrap(self, call: Callable[[], Awaitable[Any]], priority: int = 0, stream: bool = False):
+        """Limit the calls of `call`, raising `Overloaded` when no slot is available in time."""
+        async def limited():
+            if not await self.acquire(priority):
+                raise Overloaded(f"{self.name} is overloaded, try again later")
+            start = time.monotonic()
+            try:
+                result = await call()
+            except Exception as e:
+                self.sample(start, is_overload_error(e), stream)
+                self.release()
+                raise
+            except BaseException:
+                self.release()
+                raise
+            return self._track(result, start, stream)
+        return limited
+
+    def _track(self, result: Any, start: float, stream: bool) -> Any:
+        """Release the slot once the response is complete, after the end of streams."""
+        if isinstance(result, Response) and result.status_code in OVERLOAD_STATUS_CODES:
+            self.sample(start, True, stream)
+            self.release()
+        elif isinstance(result, (StreamingResponse, EventSourceResponse)):
+            result.body_iterator = self._iterate(result.body_iterator, start, stream)
+        else:
+            self.sample(start, False, stream)
+            self.release()
+        return result
+
+    async def _iterate(self, iterator, start: float, stream: bool) -> AsyncIterator:
+        first = True
+        try:
+            async for item in iterator:
+                if first:
+                    first = False
+                    self.sample(start, False, stream)
+                yield item
+        except Exception as e:
+            if first:
+                self.sample(start, is_overload_error(e), stream)
+            raise
+        finally:
+            self.release()
+            await aclose_iterator(iterator)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'queued': self.waiting,
+            'rejected': self.rejected,
+        }
+
+
+class AdaptiveLimiters(object):
+    """Adaptive limiters by provider/model, created on first use with the same settings."""
+
+    def __init__(self, **options):
+        self.options = options
+        self.limiters: Dict[str, AdaptiveLimiter] = {}
+
+    def get(self, name: str) -> AdaptiveLimiter:
+        limiter = self.limiters.get(name)
+        if limiter is None:
+            limiter = self.limiters[name] = AdaptiveLimiter(name, **self.options)
+        return limiter
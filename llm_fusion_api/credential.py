@@ -0,0 +1,144 @@
+import json
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, Tuple
+
+from llm_fusion_api.state import StateStore, fetch_once
+
+
+logger = logging.getLogger(__name__)
+
+
+class Credential(object):
+    """Cached credential (e.g. an access token) with single-flight refresh.
+
+    `fetch` returns the new value and its expiry as a unix timestamp. Concurrent
+    callers share one in-flight fetch, and once started a background task refreshes
+    the value `refresh_ahead` seconds before it expires so requests never wait for it.
+
+    With a shared `store`, the value is shared under `key` by the processes using the
+    store: one of them fetches it, holding a lease, while the others wait for its value.
+    """
+    # Delay before retrying a failed background refresh.
+    retry_interval: float = 30
+    # Longest wait for another process to fetch the value, before fetching it anyway.
+    lease_seconds: float = 10
+    poll_interval: float = 0.1
+
+    def __init__(self, name: str, fetch: Callable[[], Awaitable[Tuple[str, float]]], refresh_ahead: float = 0,
+                 store: Optional[StateStore] = None, key: str = ''):
+        self.name = name
+        self.fetch = fetch
+        self.refresh_ahead = refresh_ahead
+        self.store = store
+        self.key = key or name
+        self.value: str = ""
+        self.expires_at: float = 0
+        # Value rejected upstream, not to be taken back from the store.
+        self._rejected: str = ""
+        self._inflight: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def is_valid(self) -> bool:
+        return bool(self.value) and self.expires_at > time.time()
+
+    async def get(self) -> str:
+        """Return the cached value, fetching it only if there is none or it has expired."""
+        if self.is_valid():
+            if self.expires_at - self.refresh_ahead <= time.time():
+                # Still valid, refresh without making the caller wait.
+                self._refresh_task()
+            return self.value
+        return await self.refresh()
+
+    async def refresh(self) -> str:
+        """Fetch a new value, joining the in-flight fetch if there is one."""
+        return await asyncio.shield(self._refresh_task())
+
+    def invalidate(self, value: Optional[str] = None):
+        """Drop the cached value, unless it was already replaced by a newer one than `value`."""
+        if value is None or value == self.value:
+            if self.store is not None and self.value:
+                self._rejected = self.value
+                self.store.call_soon(
+                    self.store.delete, 'credentials', self.key, self._encode(self.value, self.expires_at))
+            self.value = ""
+            self.expires_at = 0
+
+    def _refresh_task(self) -> asyncio.Task:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._fetch())
+            # Background refreshes may have no waiter, retrieve the exception so it is not reported as lost.
+            self._inflight.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return self._inflight
+
+    async def _fetch(self) -> str:
+        if self.store is None:
+            value, expires_at = await self.fetch()
+        else:
+            value, expires_at = await self._fetch_shared()
+        self.value, self.expires_at = value, expires_at
+        logger.info("%s credential refreshed, expires at %.0f", self.name, expires_at)
+        return value
+
+    async def _fetch_shared(self) -> Tuple[str, float]:
+        async def fetch() -> Tuple[str, float]:
+            value, expires_at = await self.fetch()
+            await self.store.call(self.store.set, 'credentials', self.key, self._encode(value, expires_at),
+                                  max(expires_at - time.time(), 1))
+            return value, expires_at
+        return await fetch_once(
+            self.store, f"credentials:{self.key}", self._load, fetch, self.lease_seconds, self.poll_interval)
+
+    async def _load(self) -> Optional[Tuple[str, float]]:
+        """The value in the store, if another process fetched a new one that is not due for refresh."""
+        data = await self.store.call(self.store.get, 'credentials', self.key)
+        if data is None:
+            return None
+        value, expires_at = json.loads(data)
+        if value == self._rejected or value == self.value or expires_at - self.refresh_ahead <= time.time():
+            return None
+        return value, expires_at
+
+    @staticmethod
+    def _encode(value: str, expires_at: float) -> bytes:
+        return json.dumps([value, expires_at]).encode()
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                if not self.is_valid() or self.expires_at - self.refresh_ahead <= time.time():
+                    await self.refresh()
+                delay = max(self.expires_at - self.refresh_ahead - time.time(), self.retry_interval)
+            except Exception as e:
+                logger.error("%s credential refresh failed: %s", self.name, e)
+                delay = self.retry_interval
+            await asyncio.sleep(delay)
+
+    def start(self):
+        """Fetch the credential now and keep refreshing it ahead of expiry in the background."""
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        tasks = [task for task in (self._loop_task, self._inflight) if task is not None and not task.done()]
+        self._loop_task = None
+        self._inflight = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class SignedCredential(Credential):
+    """Credential signed locally (e.g. a JWT), reused until shortly before it expires.
+
+    `sign` returns the signed value and its expiry as a unix timestamp.
+    """
+
+    def __init__(self, name: str, sign: Callable[[], Tuple[str, float]], refresh_ahead: float = 0):
+        self.sign = sign
+        super().__init__(name, self._sign, refresh_ahead=refresh_ahead)
+
+    async def _sign(self) -> Tuple[str, float]:
+        return self.sign()
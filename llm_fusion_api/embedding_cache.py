@@ -0,0 +1,239 @@
+import os
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import hashlib
+import logging
+from array import array
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from llm_fusion_api.provider.base import EmbeddingHandler
+from llm_fusion_api.response import APIError
+from llm_fusion_api.tokens import split_tokens
+
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 32
+# Slot header: sha256 digest of the text, number of tokens of the text, crc32 of the vector, time it was written.
+HEADER = struct.Struct(f"{DIGEST_SIZE}sIIQ")
+EMPTY_DIGEST = b"\0" * DIGEST_SIZE
+# Slots a text can be stored in.
+WAYS = 8
+
+
+class EmbeddingStore(object):
+    """Fixed-capacity store of float32 vectors of one model, in a memory-mapped file.
+
+    Each slot holds the text digest, its token count, the checksum of the vector and the
+    vector. A text can only be in the `WAYS` slots of the set picked by its digest, so no
+    index is kept in memory: the workers mapping the same file see each other's vectors,
+    and a store on disk survives restarts. When a set is full, its oldest slot is
+    overwritten. Writes hold an exclusive lock on the file, reads take none and check the
+    vector against its checksum instead, so a slot read while being rewritten is a miss.
+    Without a path the mapping is anonymous.
+    """
+
+    def __init__(self, dim: int, capacity: int, path: str = ''):
+        self.dim = dim
+        self.ways = max(1, min(WAYS, capacity))
+        self.sets = max(1, capacity // self.ways)
+        self.capacity = self.sets * self.ways
+        self.slot_size = HEADER.size + dim * 4
+        size = self.slot_size * self.capacity
+        self.fd = -1
+        if path:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT)
+            try:
+                with self._locked():
+                    if os.fstat(self.fd).st_size != size:
+                        # New file, or the capacity changed: start over.
+                        os.ftruncate(self.fd, 0)
+                        os.ftruncate(self.fd, size)
+                    self.mm = mmap.mmap(self.fd, size)
+            except BaseException:
+                os.close(self.fd)
+                raise
+        else:
+            self.mm = mmap.mmap(-1, size)
+
+    def __len__(self) -> int:
+        return sum(
+            1 for slot in range(self.capacity)
+            if HEADER.unpack_from(self.mm, slot * self.slot_size)[0] != EMPTY_DIGEST
+        )
+
+    @contextmanager
+    def _locked(self):
+        if self.fd < 0:
+            yield
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _slots(self, digest: bytes) -> range:
+        first = int.from_bytes(digest[:8], 'little') % self.sets * self.ways
+        return range(first, first + self.ways)
+
+    def get(self, digest: bytes) -> Optional[Tuple[List[float], int]]:
+        for slot in self._slots(digest):
+            offset = slot * self.slot_size
+            stored, tokens, crc, _ = HEADER.unpack_from(self.mm, offset)
+            if stored == digest:
+                data = self.mm[offset + HEADER.size:offset + self.slot_size]
+                if zlib.crc32(data) != crc or HEADER.unpack_from(self.mm, offset)[0] != digest:
+                    # Rewritten by another worker while being read.
+                    return None
+                vector = array("f")
+                vector.frombytes(data)
+                return vector.tolist(), tokens
+        return None
+
+    def put(self, digest: bytes, vector: List[float], tokens: int):
+        if len(vector) != self.dim:
+            return
+        data = array("f", vector).tobytes()
+        with self._locked():
+            target = oldest = None
+            for slot in self._slots(digest):
+                stored, _, _, written = HEADER.unpack_from(self.mm, slot * self.slot_size)
+                if stored == digest or stored == EMPTY_DIGEST:
+                    target = slot
+                    break
+                if oldest is None or written < oldest:
+                    target, oldest = slot, written
+            offset = target * self.slot_size
+            # Cleared first: a reader never pairs the new digest with the old vector.
+            HEADER.pack_into(self.mm, offset, EMPTY_DIGEST, 0, 0, 0)
+            self.mm[offset + HEADER.size:offset + self.slot_size] = data
+            HEADER.pack_into(self.mm, offset, digest, tokens, zlib.crc32(data), time.time_ns())
+
+    def close(self):
+        self.mm.close()
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class EmbeddingCache(object):
+    """Content-addressed embedding cache keyed by (provider, model, text).
+
+    Requests are split into cached and missing inputs, only the missing ones are sent
+    upstream, and the response is rebuilt in the original order with the usage of all inputs.
+    """
+
+    def __init__(self, capacity: int, directory: str = ''):
+        self.capacity = capacity
+        self.directory = directory
+        self.stores: Dict[str, EmbeddingStore] = {}
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def is_cacheable(body: dict) -> bool:
+        """Only text inputs with float vectors are cached."""
+        inputs = body.get('input')
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        return (
+            isinstance(inputs, list)
+            and all(isinstance(input, str) for input in inputs)
+            and body.get('encoding_format', 'float') == 'float'
+        )
+
+    @staticmethod
+    def namespace(provider: str, model: str, body: dict) -> str:
+        namespace = f"{provider}/{model}"
+        if body.get('dimensions'):
+            namespace += f"@{body['dimensions']}"
+        return namespace
+
+    def _store_path(self, namespace: str, dim: int) -> str:
+        if not self.directory:
+            return ''
+        name = hashlib.sha1(namespace.encode()).hexdigest()[:16]
+        return os.path.join(self.directory, f"{name}-{dim}.f32")
+
+    def _find_store(self, namespace: str) -> Optional[EmbeddingStore]:
+        store = self.stores.get(namespace)
+        if store is None and self.directory:
+            # Reopen a store persisted by a previous run, its dimension is in the file name.
+            prefix = hashlib.sha1(namespace.encode()).hexdigest()[:16] + "-"
+            for filename in os.listdir(self.directory):
+                if filename.startswith(prefix) and filename.endswith(".f32"):
+                    dim = int(filename[len(prefix):-4])
+                    store = EmbeddingStore(dim, self.capacity, os.path.join(self.directory, filename))
+                    self.stores[namespace] = store
+                    break
+        return store
+
+    def _get_store(self, namespace: str, dim: int) -> EmbeddingStore:
+        store = self._find_store(namespace)
+        if store is None or store.dim != dim:
+            if store is not None:
+                store.close()
+            store = EmbeddingStore(dim, self.capacity, self._store_path(namespace, dim))
+            self.stores[namespace] = store
+        return store
+
+    async def embed(self, provider: str, handler: EmbeddingHandler, model: str, body: dict) -> Tuple[dict, int]:
+        """Return the embeddings response body and the number of inputs served from the cache."""
+        inputs = [body['input']] if isinstance(body['input'], str) else body['input']
+        namespace = self.namespace(provider, model, body)
+        digests = [hashlib.sha256(input.encode()).digest() for input in inputs]
+
+        found: Dict[bytes, Tuple[List[float], int]] = {}
+        store = self._find_store(namespace)
+        if store is not None:
+            for digest in digests:
+                if digest not in found:
+                    item = store.get(digest)
+                    if item is not None:
+                        found[digest] = item
+        hits = sum(1 for digest in digests if digest in found)
+        self.hits += hits
+        self.misses += len(digests) - hits
+
+        # Send each missing text upstream once.
+        missing: Dict[bytes, str] = {}
+        for digest, input in zip(digests, inputs):
+            if digest not in found and digest not in missing:
+                missing[digest] = input
+        if missing:
+            res_body = await handler.create_embeddings(model, list(missing.values()), body)
+            data = sorted(res_body['data'], key=lambda d: d['index'])
+            if len(data) != len(missing):
+                raise APIError(502, f"Expected {len(missing)} embeddings from {provider}, got {len(data)}")
+            texts = list(missing.values())
+            tokens = split_tokens(texts, res_body.get('usage', {}).get('prompt_tokens', 0))
+            # Only float vectors are stored, whatever the upstream answered to a float request.
+            vectors = all(isinstance(item['embedding'], list) for item in data)
+            store = self._get_store(namespace, len(data[0]['embedding'])) if vectors else None
+            for digest, item, n in zip(missing, data, tokens):
+                if store is not None:
+                    store.put(digest, item['embedding'], n)
+                found[digest] = (item['embedding'], n)
+
+        prompt_tokens = sum(found[digest][1] for digest in digests)
+        return {
+            'object': 'list',
+            'model': model,
+            'data': [
+                {'object': 'embedding', 'index': i, 'embedding': found[digest][0]}
+                for i, digest in enumerate(digests)
+            ],
+            'usage': {'prompt_tokens': prompt_tokens, 'total_tokens': prompt_tokens},
+        }, hits
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+        self.stores = {}
@@ -0,0 +1,149 @@
+"""Logging setup: records are handed to a queue and written by a background thread.
+
+Request/response bodies and stream chunks are logged by category, each with a
+sampling rate, so hot paths can skip building messages nobody reads:
+
+    if log.sampled(log.CHUNK):
+        logger.info("Stream chunk: %s", payload)
+
+Messages are formatted with %-style arguments, and secrets (bearer tokens, access
+tokens, API keys) are redacted in the writer thread before they are emitted.
+"""
+import re
+import sys
+import copy
+import time
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from typing import Dict, Iterable, Optional
+
+from llm_fusion_api import jsonlib
+
+
+# Sampling categories.
+BODY = 'body'
+CHUNK = 'chunk'
+
+# Sampling rate of each category, 1.0 logs everything and 0.0 nothing. Unknown categories are always logged.
+sample_rates: Dict[str, float] = {}
+
+REDACTED = '***'
+SECRET_PATTERNS = [
+    re.compile(r'(?i)(bearer\s+)[\w\-.~+/=]+'),
+    re.compile(r'(?i)((?:access_token|client_secret|api_key)=)[^&\s\'"]+'),
+    re.compile(r'(?i)([\'"](?:authorization|access_token|client_secret|api_key|x-api-key)[\'"]\s*:\s*[\'"])[^\'"]+'),
+]
+# Attributes of every LogRecord, the others were passed in `extra` and are added to JSON records.
+RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def sampled(category: str) -> bool:
+    """Whether to log this occurrence of `category`."""
+    rate = sample_rates.get(category, 1.0)
+    return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+
+class RedactFilter(logging.Filter):
+    """Mask secrets in formatted messages and tracebacks.
+
+    Known secret values (e.g. configured API keys) are masked as well as common patterns.
+    """
+
+    def __init__(self, secrets: Iterable[str] = ()):
+        super().__init__()
+        # Longest first so a secret containing another one is fully masked.
+        secrets = sorted({secret for secret in secrets if len(secret) >= 4}, key=len, reverse=True)
+        self.secrets_re = re.compile('|'.join(re.escape(secret) for secret in secrets)) if secrets else None
+
+    def redact(self, text: str) -> str:
+        if self.secrets_re is not None:
+            text = self.secrets_re.sub(REDACTED, text)
+        for pattern in SECRET_PATTERNS:
+            text = pattern.sub(rf'\g<1>{REDACTED}', text)
+        return text
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = self.redact(record.getMessage())
+        record.args = None
+        if record.exc_text:
+            record.exc_text = self.redact(record.exc_text)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, with the fields passed in `extra` and the traceback formatted by `QueueHandler`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return jsonlib.dumps(entry).decode()
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread with their traceback formatted apart from the message.
+
+    The stock handler merges the traceback into the message and drops `exc_info`, the
+    JSON format keeps it in its own field.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or _formatter.formatException(record.exc_info)
+            # Tracebacks hold frames alive, they do not cross to the writer thread.
+            record.exc_info = None
+        return record
+
+
+_formatter = logging.Formatter()
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup(level: str = 'INFO', format: str = 'text', rates: Optional[Dict[str, float]] = None,
+          secrets: Iterable[str] = ()):
+    """Route the root logger through a queue to a stderr handler running in a background thread."""
+    global _listener
+    if rates is not None:
+        sample_rates.update(rates)
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stderr)
+    if format == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    handler.addFilter(RedactFilter(secrets))
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(QueueHandler(records))
+    root.setLevel(level.upper())
+
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Flush the queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
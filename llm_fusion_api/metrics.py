@@ -0,0 +1,341 @@
+"""In-process metrics, exposed in the Prometheus text format on GET /metrics.
+
+Label values are resolved once per request with `labels()`, which returns a child
+holding the counts, so recording a value on the hot path is an index lookup and
+an increment.
+"""
+import re
+import time
+import asyncio
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+from starlette.responses import Response, JSONResponse, StreamingResponse
+from sse_starlette.sse import EventSourceResponse
+
+from llm_fusion_api.response import aclose_iterator
+
+
+class Metric(ABC):
+    type: str = ''
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_child()
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        pass
+
+    def _label_str(self, values: Tuple[str, ...], extra: str = '') -> str:
+        pairs = [f'{name}="{escape(str(value))}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for values, child in list(self.children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values: Tuple[str, ...], child) -> List[str]:
+        return [f'{self.name}{self._label_str(values)} {format_value(child.value)}']
+
+
+class Value(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self) -> Value:
+        return Value()
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_child(self) -> Value:
+        return Value()
+
+
+class HistogramValue(object):
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # One count per bucket, and a last one for +Inf.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = ()):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def _render_child(self, values: Tuple[str, ...], child: HistogramValue) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+            cumulative += count
+            le = 'le="+Inf"' if bound == float('inf') else f'le="{format_value(bound)}"'
+            lines.append(f'{self.name}_bucket{self._label_str(values, le)} {cumulative}')
+        lines.append(f'{self.name}_sum{self._label_str(values)} {format_value(child.sum)}')
+        lines.append(f'{self.name}_count{self._label_str(values)} {cumulative}')
+        return lines
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    'llm_request_duration_seconds', 'Duration of API requests, until the last byte of streams.',
+    ('provider', 'model', 'endpoint', 'status'),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+))
+TIME_TO_FIRST_TOKEN = REGISTRY.register(Histogram(
+    'llm_time_to_first_token_seconds', 'Time from the request to the first streamed chunk.',
+    ('provider', 'model'),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+))
+INTER_CHUNK = REGISTRY.register(Histogram(
+    'llm_inter_chunk_seconds', 'Time between consecutive streamed chunks.',
+    ('provider', 'model'),
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+))
+TOKENS_PER_SECOND = REGISTRY.register(Histogram(
+    'llm_completion_tokens_per_second', 'Completion tokens per second, from the usage of responses.',
+    ('provider', 'model'),
+    buckets=(1, 5, 10, 20, 50, 100, 200, 500),
+))
+TOKENS = REGISTRY.register(Counter(
+    'llm_tokens_total', 'Tokens reported in the usage of responses.', ('provider', 'model', 'type'),
+))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    'llm_requests_in_flight', 'API requests being processed or streamed.', ('provider', 'endpoint'),
+))
+UPSTREAM_RESPONSES = REGISTRY.register(Counter(
+    'llm_upstream_responses_total', 'Responses received from upstream APIs.', ('provider', 'status_code'),
+))
+POOL = REGISTRY.register(Gauge(
+    'llm_upstream_pool', 'Upstream HTTP connection pool stats.', ('provider', 'stat'),
+))
+POOL_MEMBERS = REGISTRY.register(Gauge(
+    'llm_provider_pool_member', 'Load and health of each key/base URL of a provider.', ('provider', 'member', 'stat'),
+))
+BREAKER_STATE = REGISTRY.register(Gauge(
+    'llm_circuit_breaker_state', 'Circuit breaker state per provider/model: 0 closed, 1 half-open, 2 open.', ('model',),
+))
+BREAKER_REJECTED = REGISTRY.register(Counter(
+    'llm_circuit_breaker_rejected_total', 'Calls rejected by open or half-open circuit breakers.', ('model',),
+))
+CONCURRENCY = REGISTRY.register(Gauge(
+    'llm_upstream_concurrency', 'Adaptive concurrency limiter per provider/model: limit, in-flight, queued, rejected.',
+    ('model', 'stat'),
+))
+RATE_LIMITED = REGISTRY.register(Counter(
+    'llm_rate_limited_total', 'Requests rejected for being over the budget of their tenant.', ('tenant',),
+))
+STREAM_ABORTS = REGISTRY.register(Counter(
+    'llm_stream_aborts_total', 'Streams ended early: client_disconnect or idle_timeout of the upstream.',
+    ('provider', 'model', 'reason'),
+))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    'llm_cache_lookups_total', 'Lookups of the caches and of the shared state namespaces, by result: hit or miss.',
+    ('cache', 'result'),
+))
+STATE_LOCK_WAITS = REGISTRY.register(Counter(
+    'llm_state_lock_waits_total', 'Writes to the shared state that waited for another worker.', (),
+))
+STATE_LOCK_WAIT_SECONDS = REGISTRY.register(Counter(
+    'llm_state_lock_wait_seconds_total', 'Seconds waited for the lock of the shared state.', (),
+))
+STATE_LEASE_CONFLICTS = REGISTRY.register(Counter(
+    'llm_state_lease_conflicts_total', 'Leases of the shared state (e.g. credential fetches) held by another worker.',
+    (),
+))
+
+USAGE_RE = re.compile(r'"(prompt_tokens|completion_tokens|total_tokens)"\s*:\s*(\d+)')
+USAGE_BYTES_RE = re.compile(USAGE_RE.pattern.encode())
+
+
+class RequestMetrics(object):
+    """Records one API request: duration, in-flight gauge, stream timings and token usage.
+
+    Usage is scanned from the response text, only in pieces containing a token count.
+    `on_finish` is called with the usage once the request is complete.
+    """
+    __slots__ = ('provider', 'model', 'endpoint', 'start', 'first', 'last', 'usage', 'in_flight', 'on_finish')
+
+    def __init__(
+        self, provider: str, model: str, endpoint: str, on_finish: Optional[Callable[[Dict[str, int]], None]] = None,
+    ):
+        self.provider = provider
+        self.model = model
+        self.endpoint = endpoint
+        self.on_finish = on_finish
+        self.start = time.perf_counter()
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self.usage: Dict[str, int] = {}
+        self.in_flight = IN_FLIGHT.labels(provider, endpoint)
+        self.in_flight.inc()
+
+    def track(self, response: Response) -> Response:
+        """Record the response when it is complete, after the stream ends for streaming responses."""
+        if isinstance(response, (StreamingResponse, EventSourceResponse)):
+            response.body_iterator = self._iterate(response.body_iterator, response.status_code)
+            return response
+        if isinstance(response, JSONResponse) and b'_tokens"' in response.body:
+            for name, value in USAGE_BYTES_RE.findall(response.body):
+                self.usage[name.decode()] = int(value)
+        self.finish(response.status_code)
+        return response
+
+    async def _iterate(self, iterator, status_code: int) -> AsyncIterator:
+        ttft = TIME_TO_FIRST_TOKEN.labels(self.provider, self.model)
+        inter_chunk = INTER_CHUNK.labels(self.provider, self.model)
+        try:
+            async for item in iterator:
+                now = time.perf_counter()
+                if self.last is None:
+                    self.first = now
+                    ttft.observe(now - self.start)
+                else:
+                    inter_chunk.observe(now - self.last)
+                self.last = now
+                if isinstance(item, str) and '_tokens"' in item:
+                    for name, value in USAGE_RE.findall(item):
+                        self.usage[name] = int(value)
+                elif isinstance(item, bytes) and b'_tokens"' in item:
+                    for name, value in USAGE_BYTES_RE.findall(item):
+                        self.usage[name.decode()] = int(value)
+                yield item
+        except (asyncio.CancelledError, GeneratorExit):
+            # The client went away before the end of the stream.
+            self.finish(499)
+            raise
+        except BaseException:
+            self.finish(500)
+            raise
+        finally:
+            await aclose_iterator(iterator)
+        self.finish(status_code)
+
+    def finish(self, status_code: int):
+        if self.in_flight is None:
+            return
+        self.in_flight.dec()
+        self.in_flight = None
+        end = time.perf_counter()
+        REQUEST_DURATION.labels(self.provider, self.model, self.endpoint, str(status_code)).observe(end - self.start)
+        for name, value in self.usage.items():
+            TOKENS.labels(self.provider, self.model, name[:-len('_tokens')]).inc(value)
+        # Some providers only report the total.
+        tokens = self.usage.get('completion_tokens', self.usage.get('total_tokens', 0))
+        # Generation rate of streams from the first chunk, of other responses over the whole request.
+        elapsed = end - (self.first if self.first is not None and self.last != self.first else self.start)
+        if tokens and elapsed > 0 and self.endpoint == 'chat':
+            TOKENS_PER_SECOND.labels(self.provider, self.model).observe(tokens / elapsed)
+        if self.on_finish is not None:
+            self.on_finish(self.usage)
+
+
+def observe_upstream(provider: str, status_code: int):
+    UPSTREAM_RESPONSES.labels(provider, str(status_code)).inc()
+
+
+def set_pool_stats(provider: str, stats: Dict[str, int]):
+    for stat, value in stats.items():
+        POOL.labels(provider, stat).set(value)
+
+
+def set_member_stats(provider: str, member: str, stats: Dict[str, float]):
+    for stat, value in stats.items():
+        POOL_MEMBERS.labels(provider, member, stat).set(value)
+
+
+def set_breaker_stats(model: str, state: int, rejected: int):
+    BREAKER_STATE.labels(model).set(state)
+    BREAKER_REJECTED.labels(model).set(rejected)
+
+
+def set_concurrency_stats(model: str, stats: Dict[str, float]):
+    for stat, value in stats.items():
+        CONCURRENCY.labels(model, stat).set(value)
+
+
+def set_rate_limited(tenant: str, rejected: int):
+    RATE_LIMITED.labels(tenant).set(rejected)
+
+
+def observe_stream_abort(provider: str, model: str, reason: str):
+    STREAM_ABORTS.labels(provider, model, reason).inc()
+
+
+def set_cache_stats(cache: str, hits: int, misses: int):
+    CACHE_LOOKUPS.labels(cache, 'hit').set(hits)
+    CACHE_LOOKUPS.labels(cache, 'miss').set(misses)
+
+
+def set_state_stats(lock_waits: int, lock_wait_seconds: float, lease_conflicts: int):
+    STATE_LOCK_WAITS.labels().set(lock_waits)
+    STATE_LOCK_WAIT_SECONDS.labels().set(lock_wait_seconds)
+    STATE_LEASE_CONFLICTS.labels().set(lease_conflicts)
@@ -0,0 +1,79 @@
+import hmac
+import hashlib
+from typing import Dict, Iterable, List, Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from llm_fusion_api.response import ErrorResponse
+from llm_fusion_api.ratelimit import Tenant
+
+
+# Tenant of the tokens of SECRET_TOKEN, SECRET_TOKENS and SECRET_TOKEN_HASHES.
+DEFAULT_TENANT = 'default'
+
+
+def hash_token(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+class SecretTokenAuthMiddleware(object):
+    """Middleware to check for a secret token in the Authorization header
+
+    A pure ASGI middleware, so responses (including SSE streams) pass through untouched.
+    Tokens are kept as sha256 digests, given in plain text or already hashed, and the
+    presented token is compared to all of them in constant time.
+
+    The tokens of `tenants` identify their tenant, the other tokens the "default" tenant,
+    its name is put in `request.state.tenant`.
+    """
+    def __init__(
+        self,
+        app: ASGIApp,
+        secret_tokens: Iterable[str] = (),
+        secret_token_hashes: Iterable[str] = (),
+        tenants: Iterable[Tenant] = (),
+    ):
+        self.app = app
+        self.digests: List[bytes] = [hash_token(token) for token in secret_tokens if token]
+        self.digests.extend(bytes.fromhex(digest) for digest in secret_token_hashes if digest)
+        self.tenants: Dict[bytes, str] = {digest: DEFAULT_TENANT for digest in self.digests}
+        for tenant in tenants:
+            digests = [hash_token(token) for token in tenant.keys if token]
+            digests.extend(bytes.fromhex(digest) for digest in tenant.key_hashes if digest)
+            for digest in digests:
+                self.digests.append(digest)
+                self.tenants[digest] = tenant.name
+
+    def check(self, authorization: bytes) -> bool:
+        return self.authenticate(authorization) is not None
+
+    def authenticate(self, authorization: bytes) -> Optional[str]:
+        """Tenant of the token of an Authorization header, None if it is not valid."""
+        if not authorization.startswith(b'Bearer '):
+            return None
+        digest = hashlib.sha256(authorization[7:]).digest()
+        matched = None
+        for expected in self.digests:
+            # Do not stop at the first match, to not leak which key matched.
+            if hmac.compare_digest(expected, digest):
+                matched = expected
+        if matched is None:
+            return None
+        return self.tenants[matched]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or not self.digests:
+            await self.app(scope, receive, send)
+            return
+        authorization = b''
+        for name, value in scope['headers']:
+            if name == b'authorization':
+                authorization = value
+                break
+        tenant = self.authenticate(authorization)
+        if tenant is None:
+            response = ErrorResponse(401, 'Unauthorized')
+            await response(scope, receive, send)
+            return
+        scope.setdefault('state', {})['tenant'] = tenant
+        await self.app(scope, receive, send)
@@ -2,4 +2,5 @@ from .base import Model # noqa: F401
 from .openai import OpenAI  # noqa: F401
 from .wenxin import Wenxin  # noqa: F401
 from .minimax import MiniMax  # noqa: F401
-from .zhipu import Zhipu  # noqa: F401
\ No newline at end of file
+from .zhipu import Zhipu  # noqa: F401
+from .pool import ProviderPool, make_pool, parse_weighted  # noqa: F401
@@ -1,7 +1,21 @@
+import json
 from abc import ABC, abstractmethod
+from typing import List
+
+from starlette.responses import Response, JSONResponse
+
+from llm_fusion_api.client import ClientPool
+from llm_fusion_api.response import APIError
+from llm_fusion_api.schema import ChatCompletionRequest, EmbeddingRequest
+
+def loads_or_empty(content: bytes) -> dict:
+    """The JSON object of an upstream error body, empty if it is not one."""
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
 
-from starlette.requests import Request
-from starlette.responses import Response
 
 class Model(object):
     provider: str
@@ -14,9 +28,26 @@ class Model(object):
         self.type = type
 
 
+class Provider(object):
+    """Base class of all providers, owns the pooled HTTP client to the upstream."""
+    provider: str
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.pool = ClientPool(provider)
+
+    async def startup(self):
+        """Called once when the app starts."""
+        pass
+
+    async def aclose(self):
+        """Called once when the app shuts down."""
+        await self.pool.aclose()
+
+
 class ChatHandler(ABC):
     @abstractmethod
-    async def chat_completions(self, request: Request, model: str) -> Response:
+    async def chat_completions(self, request: ChatCompletionRequest, model: str) -> Response:
         """POST /v1/chat/completions
 
         https://platform.openai.com/docs/api-reference/chat
@@ -25,10 +56,20 @@ class ChatHandler(ABC):
 
 
 class EmbeddingHandler(ABC):
-    @abstractmethod
-    async def embeddings(self, request: Request, model: str) -> Response:
+    async def embeddings(self, request: EmbeddingRequest, model: str) -> Response:
         """POST /v1/embeddings
 
         https://platform.openai.com/docs/api-reference/embeddings
         """
+        try:
+            return JSONResponse(await self.create_embeddings(model, request.inputs, request.body))
+        except APIError as e:
+            return e.response()
+
+    @abstractmethod
+    async def create_embeddings(self, model: str, inputs: List[str], body: dict) -> dict:
+        """Embed `inputs` and return the response body in OpenAI format.
+
+        `body` is the original request, for the other parameters. Raises `APIError` on failure.
+        """
         pass
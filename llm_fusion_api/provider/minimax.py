@@ -1,23 +1,35 @@
-import json
 import uuid
 import httpx
 import logging
 from typing import List
 
-from starlette.requests import Request
 from starlette.responses import Response, JSONResponse
-from sse_starlette.sse import EventSourceResponse
 
-from llm_fusion_api.provider.base import ChatHandler, Model
-from llm_fusion_api.response import ErrorResponse
+from llm_fusion_api.provider.base import ChatHandler, Model, Provider, loads_or_empty
+from llm_fusion_api.response import APIError
+from llm_fusion_api.schema import ChatCompletionRequest
+from llm_fusion_api import log
+from llm_fusion_api.sse import ChunkEncoder, DONE, aiter_events, event_source
 
 
 logger = logging.getLogger(__name__)
 
-class MiniMax(ChatHandler):
-    chat_completion_url: str = "https://api.minimax.chat/v1/text/chatcompletion"
-
-    def __init__(self, minimax_group_id: str, minimax_api_key: str):
+# HTTP status of the error codes caused by the request, or asking to slow down. Other codes are upstream faults.
+ERROR_STATUS = {
+    1001: 504,  # timeout
+    1002: 429,  # RPM limit reached
+    1026: 400,  # sensitive input
+    1027: 400,  # sensitive output
+    1039: 429,  # TPM limit reached
+    2013: 400,  # invalid parameters
+}
+
+class MiniMax(Provider, ChatHandler):
+    chat_completion_path: str = "/v1/text/chatcompletion"
+
+    def __init__(self, minimax_group_id: str, minimax_api_key: str, api_base: str = "https://api.minimax.chat"):
+        super().__init__("minimax")
+        self.chat_completion_url = api_base.rstrip("/") + self.chat_completion_path
         self.minimax_group_id = minimax_group_id
         self.minimax_api_key = minimax_api_key
 
@@ -29,13 +41,11 @@ class MiniMax(ChatHandler):
             # Model(provider="minimax", name="embo-01", type="embedding"),
         ]
 
-    async def chat_completions(self, request: Request, model: str) -> Response:
+    async def chat_completions(self, request: ChatCompletionRequest, model: str) -> Response:
         """https://api.minimax.chat/document/guides/chat?id=6433f37294878d408fc82953
         """
-        body = await request.json()
-        new_body = convert_request(body)
+        new_body = convert_request(request, model)
 
-        stream = body.get('stream', False)
         kwargs = dict(
             url=self.chat_completion_url,
             headers={
@@ -45,45 +55,58 @@ class MiniMax(ChatHandler):
             params={"GroupId": self.minimax_group_id},
             json=new_body
         )
-        logger.info(f"MiniMax request to {kwargs}")
+        log_body = log.sampled(log.BODY)
+        if log_body:
+            logger.info("MiniMax request to %s: %s", self.chat_completion_url, new_body)
 
-        if not stream:
-            async with httpx.AsyncClient() as client:
-                response: httpx.Response = await client.post(**kwargs) # type: ignore
+        if not request.stream:
+            response: httpx.Response = await self.pool.client.post(**kwargs) # type: ignore
 
             response.raise_for_status()
             res_body = response.json()
-            error_code = res_body.get("base_resp", {}).get("status_code", 0)
-            if error_code:
-                logger.error(f"MiniMax error: {error_code}")
-                return ErrorResponse(500, f"MiniMax error: {error_code}")
-            logger.info(f"MiniMax response: {res_body}")
+            if res_body.get("base_resp", {}).get("status_code", 0):
+                return minimax_error(res_body).response()
+            if log_body:
+                logger.info("MiniMax response: %s", res_body)
             return JSONResponse(convert_response(res_body, model))
 
         # stream mode
         async def stream_generator():
-            id = uuid.uuid4().hex
-            client = httpx.AsyncClient()
-            first = True
-            async with client.stream(method='POST', **kwargs) as response: # type: ignore
-                async for line in response.aiter_lines():
-                    if not line.startswith("data: "):
-                        continue
-                    payload = json.loads(line[6:].strip())
-                    logger.info(f"MiniMax stream response: {payload}")
-                    if first:
-                        first = False
-                        first_payload = {
-                            "created": payload["created"],
-                        }
-                        yield convert_sse_response(first_payload, model, id=id)
-                    yield convert_sse_response(payload, model, id=id)
-            yield "[DONE]"
-
-        return EventSourceResponse(stream_generator())
-
-
-def convert_request(body):
+            encoder = None
+            async with self.pool.client.stream(method='POST', **kwargs) as response: # type: ignore
+                response.raise_for_status()
+                if response.headers.get("content-type", "").startswith("application/json"):
+                    # Errors are returned as a plain JSON body instead of events.
+                    raise minimax_error(loads_or_empty(await response.aread()))
+                async for event in aiter_events(response):
+                    payload = event.json()
+                    if log.sampled(log.CHUNK):
+                        logger.info("MiniMax stream response: %s", payload)
+                    if payload.get("base_resp", {}).get("status_code", 0):
+                        raise minimax_error(payload)
+                    if encoder is None:
+                        encoder = ChunkEncoder(uuid.uuid4().hex, payload["created"], model)
+                        yield encoder.role()
+                    yield convert_sse_response(payload, encoder)
+            yield DONE
+
+        return event_source(stream_generator())
+
+
+def minimax_error(res_body: dict) -> APIError:
+    """Error of a MiniMax response body, 4xx if the request is at fault."""
+    base_resp = res_body.get("base_resp", {})
+    error_code = base_resp.get("status_code")
+    error_msg = base_resp.get("status_msg", "unexpected response")
+    status_code = ERROR_STATUS.get(error_code, 500)
+    if status_code >= 500:
+        logger.error("MiniMax error: %s %s", error_code, error_msg)
+    else:
+        logger.warning("MiniMax error: %s %s", error_code, error_msg)
+    return APIError(status_code, f"MiniMax error: {error_code} - {error_msg}")
+
+
+def convert_request(request: ChatCompletionRequest, model: str):
     """Convert OpenAI request body to MiniMax format"""
     mm_body =  {
         'use_standard_sse': True,
@@ -93,10 +116,10 @@ def convert_request(body):
             'user_name': '用户',
             'bot_name': 'MM 智能助理',
         },
-        'stream': body.get('stream', False),
-        'model': body.get('model', '').split('/')[-1],
+        'stream': request.stream,
+        'model': model,
     }
-    for msg in body['messages']:
+    for msg in request.messages:
         if msg['role'] == 'system' and msg['content'].strip() != '':
             # 根据 system message 修改预设 Prompt
             mm_body['prompt'] += msg['content'] + '\n\n'
@@ -113,18 +136,18 @@ def convert_request(body):
     if mm_body['prompt'] == '':
         mm_body['prompt'] = ("MM 智能助理是一款由 MiniMax 自研的，没有调用其他产品的接口的大型语言模型。"
                              "MiniMax 是一家中国科技公司，一直致力于进行大模型相关的研究。")
-    if 'max_tokens' in body:
-        mm_body['tokens_to_generate'] = body['max_tokens']
-    if body['messages'][0]['role'] == 'system' and body['messages'][0]['content'].strip() != '':
+    if request.max_tokens is not None:
+        mm_body['tokens_to_generate'] = request.max_tokens
+    if request.messages[0]['role'] == 'system' and request.messages[0]['content'].strip() != '':
         # 根据 system message 修改预设 Prompt
-        mm_body['prompt'] = body['messages'][0]['content']
-    if "temperature" in body:
+        mm_body['prompt'] = request.messages[0]['content']
+    if request.temperature is not None:
         # MiniMax temperature is between 0.001 and 1
-        mm_body["temperature"] = min(max(body["temperature"], 0.001), 1)
-    if "n" in body:
-        mm_body["beam_width"] = max(min(body["n"], 4), 1)
-    if "top_p" in body:
-        mm_body["top_p"] = body["top_p"]
+        mm_body["temperature"] = min(max(request.temperature, 0.001), 1)
+    if request.n is not None:
+        mm_body["beam_width"] = max(min(request.n, 4), 1)
+    if request.top_p is not None:
+        mm_body["top_p"] = request.top_p
     return mm_body
 
 def convert_response(body, model):
@@ -154,22 +177,8 @@ def convert_response(body, model):
     return r
 
 
-def convert_sse_response(body, model, id=None):
-    """Convert MiniMax SSE response to OpenAI format"""
-    response =  {
-        'id': id,
-        'object': "chat.completion.chunk",
-        'created': body['created'],
-        'model': model,
-        'choices': [
-            {
-                'index': 0,
-                'delta': {},
-                'finish_reason': None,
-            }
-        ],
-    }
-
+def convert_sse_response(body, encoder: ChunkEncoder) -> bytes:
+    """Convert MiniMax SSE response to an OpenAI chunk event"""
     if 'base_resp' in body:
         # stream end
         minimax_finish_reason = body['choices'][0]['finish_reason']
@@ -178,17 +187,7 @@ def convert_sse_response(body, model, id=None):
             finish_reason = 'length'
         if body.get('output_sensitive') or body.get('input_sensitive'):
             finish_reason = 'content_filter'
-        response['choices'][0]['finish_reason'] = finish_reason
-        response['choices'][0]['delta'] = {
-            'content': body['choices'][0]['delta'],
-        }
-    elif 'choices' not in body:
-        response['choices'][0]['delta'] = {
-            'role': "assistant",
-            "content": "",
-        }
-    else:
-        response['choices'][0]['delta'] = {
-            'content': body['choices'][0]['delta'],
-        }
-    return json.dumps(response, ensure_ascii=False)
+        return encoder.finish(finish_reason, body['choices'][0]['delta'], body.get('usage'))
+    if 'choices' not in body:
+        return encoder.role()
+    return encoder.content(body['choices'][0]['delta'])
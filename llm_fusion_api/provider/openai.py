@@ -1,20 +1,21 @@
-import httpx
 import logging
 from typing import List, Dict
 
-from starlette.requests import Request
 from starlette.background import BackgroundTask
 from starlette.responses import Response, StreamingResponse
-from .base import Model, ChatHandler, EmbeddingHandler
+from .base import Model, Provider, ChatHandler, EmbeddingHandler
+from llm_fusion_api.response import APIError
+from llm_fusion_api.schema import ChatCompletionRequest, EmbeddingRequest
+from llm_fusion_api import jsonlib, log
 
 
 logger = logging.getLogger(__name__)
 
-class OpenAI(ChatHandler, EmbeddingHandler):
+class OpenAI(Provider, ChatHandler, EmbeddingHandler):
     def __init__(self, openai_api_base: str, openai_api_key: str, provider: str = "openai"):
+        super().__init__(provider)
         self.openai_api_base = openai_api_base
         self.openai_api_key = openai_api_key
-        self.provider = provider
 
     def get_headers(self) -> Dict[str, str]:
         headers = {
@@ -27,80 +28,87 @@ class OpenAI(ChatHandler, EmbeddingHandler):
     async def list_models(self) -> List[Model]:
         """List all models from OpenAI API"""
         headers = self.get_headers()
-        async with httpx.AsyncClient() as client:
-            response = await client.request(
-                'GET',
-                self.openai_api_base + '/models',
-                headers=headers
-            )
-            data = response.json()
+        response = await self.pool.client.request(
+            'GET',
+            self.openai_api_base + '/models',
+            headers=headers
+        )
+        data = response.json()
 
+        # Every listed model is routed, including o-series and fine-tuned ones, whatever their prefix.
         result = []
         for model in data["data"]:
-            if self.provider == "openai":
-                if model["id"].startswith("gpt"):
-                    result.append(Model(
-                        provider=self.provider,
-                        name=model["id"],
-                        type="chat"
-                    ))
-                elif model["id"].startswith("text-embedding"):
-                    result.append(Model(
-                        provider=self.provider,
-                        name=model["id"],
-                        type="embedding"
-                    ))
-            else:
-                if "embedding" in model["id"]:
-                    result.append(Model(
-                        provider=self.provider,
-                        name=model["id"],
-                        type="embedding"
-                    ))
-                else:
-                    result.append(Model(
-                        provider=self.provider,
-                        name=model["id"],
-                        type="chat"
-                    ))
+            result.append(Model(
+                provider=self.provider,
+                name=model["id"],
+                type="embedding" if "embedding" in model["id"] else "chat"
+            ))
         return result
 
-    async def proxy(self, path, body, request: Request) -> Response:
-        """Proxy to OpenAI API"""
+    async def proxy(self, path: str, content: bytes) -> Response:
+        """Proxy a POST request with an already serialized JSON body to OpenAI API"""
         headers = self.get_headers()
         url = self.openai_api_base + path
-        logger.info(f"OpenAI Proxying request to {url}, headers: {headers}, body: {body}")
+        if log.sampled(log.BODY):
+            logger.info("OpenAI request to %s: %r", url, content)
 
-        client = httpx.AsyncClient()
+        client = self.pool.client
         req = client.build_request(
-            request.method,
+            'POST',
             url,
             headers=headers,
-            json=body, # type: ignore
+            content=content,
         )
         res = await client.send(req, stream=True)
         res.headers['Access-Control-Allow-Origin'] = '*'
 
+        async def body():
+            # Closing the generator, when the client goes away, aborts the upstream request.
+            try:
+                async for text in res.aiter_text():
+                    yield text
+            finally:
+                await res.aclose()
+
         return StreamingResponse(
-            res.aiter_text(),
+            body(),
             status_code=res.status_code,
             headers=res.headers,
+            # Closes the response if the body is never iterated.
             background=BackgroundTask(res.aclose)
         )
 
-    async def chat_completions(self, request: Request, model: str) -> Response:
+    async def chat_completions(self, request: ChatCompletionRequest, model: str) -> Response:
         """POST /v1/chat/completions
 
         https://platform.openai.com/docs/api-reference/chat
         """
+        return await self.proxy("/chat/completions", with_model(request.raw, request.body, model))
 
-        body = await request.json()
-        body["model"] = model
-        return await self.proxy("/chat/completions", body, request)
-
-    async def embeddings(self, request: Request, model: str) -> Response:
+    async def embeddings(self, request: EmbeddingRequest, model: str) -> Response:
         """https://platform.openai.com/docs/api-reference/embeddings
         """
-        body = await request.json()
-        body["model"] = model
-        return await self.proxy("/embeddings", body, request)
+        return await self.proxy("/embeddings", with_model(request.raw, request.body, model))
+
+    async def create_embeddings(self, model: str, inputs: List[str], body: dict) -> dict:
+        body = dict(body, model=model, input=inputs)
+        response = await self.pool.client.post(
+            self.openai_api_base + "/embeddings",
+            headers=self.get_headers(),
+            content=jsonlib.dumps(body),
+        )
+        try:
+            res_body = response.json()
+        except ValueError:
+            raise APIError(response.status_code, response.text)
+        if response.status_code != 200:
+            error = res_body.get("error") or {}
+            raise APIError(response.status_code, error.get("message", "") if isinstance(error, dict) else str(error))
+        return res_body
+
+
+def with_model(raw: bytes, body: dict, model: str) -> bytes:
+    """Request body for the upstream model, the original bytes are forwarded when the model is unchanged."""
+    if body.get("model") == model:
+        return raw
+    return jsonlib.dumps(dict(body, model=model))
@@ -0,0 +1,224 @@
+import re
+import time
+import logging
+from typing import AsyncIterator, Dict, List, Sequence, Tuple
+
+import httpx
+from starlette.responses import Response, StreamingResponse
+from sse_starlette.sse import EventSourceResponse
+
+from llm_fusion_api.provider.base import Model, Provider, ChatHandler, EmbeddingHandler
+from llm_fusion_api.response import APIError, aclose_iterator
+from llm_fusion_api.schema import ChatCompletionRequest, EmbeddingRequest
+
+
+logger = logging.getLogger(__name__)
+
+LEAST_OUTSTANDING = 'least_outstanding'
+WEIGHTED_ROUND_ROBIN = 'weighted_round_robin'
+# Upstream status codes that count as a failure of the member, other errors are the client's.
+FAILURE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+WEIGHT_RE = re.compile(r'^(.*)@(\d+(?:\.\d+)?)$')
+
+
+def parse_weighted(value: str) -> Tuple[str, float]:
+    """Split a `value@weight` setting, the weight defaults to 1."""
+    match = WEIGHT_RE.match(value)
+    if match is None:
+        return value, 1.0
+    return match.group(1), float(match.group(2))
+
+
+def is_member_failure(e: BaseException) -> bool:
+    """Whether an error says the member is unhealthy: cancellations and client errors do not."""
+    if isinstance(e, APIError):
+        return e.status_code in FAILURE_STATUS_CODES
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in FAILURE_STATUS_CODES
+    return isinstance(e, httpx.TransportError)
+
+
+class PoolMember(object):
+    """One upstream of a pool (an API key or a base URL) with its load and health."""
+
+    def __init__(self, provider: Provider, weight: float = 1.0):
+        self.provider = provider
+        self.weight = weight
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        # Smooth weighted round-robin state.
+        self.current_weight = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def is_available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+
+class ProviderPool(Provider, ChatHandler):
+    """Spreads the requests of one provider over several members with their own keys or base URLs.
+
+    Members are picked by least outstanding requests (relative to their weight) or by smooth
+    weighted round-robin. A member failing `eject_failures` times in a row is ejected for
+    `eject_seconds`, then gets traffic again. When all members are ejected the one due back
+    first is used, so the pool never refuses a request by itself.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        members: Sequence[Tuple[Provider, float]],
+        strategy: str = LEAST_OUTSTANDING,
+        eject_failures: int = 3,
+        eject_seconds: float = 30.0,
+    ):
+        super().__init__(provider)
+        if strategy not in (LEAST_OUTSTANDING, WEIGHTED_ROUND_ROBIN):
+            raise ValueError(f"Unknown pool strategy: {strategy}")
+        self.members = [PoolMember(member, weight) for member, weight in members]
+        self.strategy = strategy
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self._next = 0
+        for member in self.members:
+            # Members talk to the same vendor, share one connection pool.
+            member.provider.pool = self.pool
+
+    async def startup(self):
+        for member in self.members:
+            await member.provider.startup()
+
+    async def aclose(self):
+        for member in self.members:
+            await member.provider.aclose()
+        await super().aclose()
+
+    def pick(self) -> PoolMember:
+        now = time.monotonic()
+        available = [member for member in self.members if member.is_available(now)]
+        if not available:
+            return min(self.members, key=lambda member: member.ejected_until)
+        if self.strategy == WEIGHTED_ROUND_ROBIN:
+            total = sum(member.weight for member in available)
+            for member in available:
+                member.current_weight += member.weight
+            best = max(available, key=lambda member: member.current_weight)
+            best.current_weight -= total
+            return best
+        # Rotate the starting point so ties do not always go to the first member.
+        self._next = (self._next + 1) % len(available)
+        ordered = available[self._next:] + available[:self._next]
+        return min(ordered, key=lambda member: member.outstanding / member.weight)
+
+    def _acquire(self) -> PoolMember:
+        member = self.pick()
+        member.outstanding += 1
+        member.requests += 1
+        return member
+
+    def _release(self, member: PoolMember, failed: bool):
+        member.outstanding -= 1
+        if not failed:
+            member.failures = 0
+            return
+        member.errors += 1
+        member.failures += 1
+        if member.failures >= self.eject_failures:
+            member.ejected_until = time.monotonic() + self.eject_seconds
+            # Back in rotation after the ejection, a single failure ejects it again.
+            member.failures = self.eject_failures - 1
+            logger.warning("%s pool member %d ejected for %.0fs", self.provider,
+                           self.members.index(member), self.eject_seconds)
+
+    def _track(self, member: PoolMember, response: Response) -> Response:
+        """Release the member once the response is complete, after the end of streams."""
+        failed = response.status_code in FAILURE_STATUS_CODES
+        if not failed and isinstance(response, (StreamingResponse, EventSourceResponse)):
+            response.body_iterator = self._iterate(member, response.body_iterator)
+        else:
+            self._release(member, failed)
+        return response
+
+    async def _iterate(self, member: PoolMember, iterator) -> AsyncIterator:
+        failed = False
+        try:
+            async for item in iterator:
+                yield item
+        except BaseException as e:
+            # Not when the client went away, or the stream was rejected for its request.
+            failed = is_member_failure(e)
+            raise
+        finally:
+            self._release(member, failed)
+            await aclose_iterator(iterator)
+
+    async def list_models(self) -> List[Model]:
+        member = self._acquire()
+        try:
+            models = await member.provider.list_models()  # type: ignore
+        except BaseException as e:
+            self._release(member, is_member_failure(e))
+            raise
+        self._release(member, False)
+        return models
+
+    async def chat_completions(self, request: ChatCompletionRequest, model: str) -> Response:
+        member = self._acquire()
+        try:
+            response = await member.provider.chat_completions(request, model)  # type: ignore
+        except BaseException as e:
+            self._release(member, is_member_failure(e))
+            raise
+        return self._track(member, response)
+
+    def stats(self) -> List[Dict[str, float]]:
+        now = time.monotonic()
+        return [
+            {
+                'outstanding': member.outstanding,
+                'requests': member.requests,
+                'errors': member.errors,
+                'ejected': 0 if member.is_available(now) else 1,
+                'weight': member.weight,
+            }
+            for member in self.members
+        ]
+
+
+class EmbeddingProviderPool(ProviderPool, EmbeddingHandler):
+    """Pool of providers that also handle embeddings."""
+
+    async def embeddings(self, request: EmbeddingRequest, model: str) -> Response:
+        member = self._acquire()
+        try:
+            response = await member.provider.embeddings(request, model)  # type: ignore
+        except BaseException as e:
+            self._release(member, is_member_failure(e))
+            raise
+        return self._track(member, response)
+
+    async def create_embeddings(self, model: str, inputs: List[str], body: dict) -> dict:
+        member = self._acquire()
+        try:
+            result = await member.provider.create_embeddings(model, inputs, body)  # type: ignore
+        except BaseException as e:
+            self._release(member, is_member_failure(e))
+            raise
+        self._release(member, False)
+        return result
+
+
+def make_pool(
+    provider: str,
+    members: Sequence[Tuple[Provider, float]],
+    strategy: str = LEAST_OUTSTANDING,
+    eject_failures: int = 3,
+    eject_seconds: float = 30.0,
+) -> Provider:
+    """Pool the members if there are several, with embedding support if they have it."""
+    if len(members) == 1:
+        return members[0][0]
+    cls = EmbeddingProviderPool if isinstance(members[0][0], EmbeddingHandler) else ProviderPool
+    return cls(provider, members, strategy=strategy, eject_failures=eject_failures, eject_seconds=eject_seconds)
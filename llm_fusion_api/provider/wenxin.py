@@ -1,15 +1,20 @@
-import json
 import time
+import hashlib
+import asyncio
 import httpx
 import logging
-from typing import List
+from typing import AsyncIterator, List, Optional, Tuple
 
-from starlette.requests import Request
 from starlette.responses import Response, JSONResponse
-from sse_starlette.sse import EventSourceResponse
 
-from llm_fusion_api.provider.base import ChatHandler, Model, EmbeddingHandler
-from llm_fusion_api.response import ErrorResponse
+from llm_fusion_api.provider.base import ChatHandler, Model, EmbeddingHandler, Provider, loads_or_empty
+from llm_fusion_api.response import APIError
+from llm_fusion_api.schema import ChatCompletionRequest
+from llm_fusion_api.credential import Credential
+from llm_fusion_api.state import StateStore
+from llm_fusion_api import settings, log
+from llm_fusion_api.tokens import estimate_tokens, split_text, truncate
+from llm_fusion_api.sse import ChunkEncoder, DONE, Event, aiter_events, event_source
 
 
 logger = logging.getLogger(__name__)
@@ -21,167 +26,284 @@ MODEL_ENDPOINT_MAP = {
     "ernie-bot-8k": "ernie_bot_8k",
     "ernie-speed": "ernie_speed",
 }
+# Limits of each embedding model: max number of inputs per call, and max tokens per input.
+EMBEDDING_LIMITS = {
+    "embedding-v1": (16, 384),
+    "bge_large_zh": (16, 512),
+    "bge_large_en": (16, 512),
+    "tao_8k": (1, 8192),
+}
+# Error codes returned when the access token is invalid or expired.
+TOKEN_ERROR_CODES = (110, 111)
+# HTTP status of the error codes caused by the request, or asking to slow down. Other codes,
+# and 336100 ("try again"), are upstream faults.
+ERROR_STATUS = {
+    2: 503,       # service temporarily unavailable
+    4: 429,       # request limit reached
+    17: 429,      # daily request limit reached
+    18: 429,      # QPS limit reached
+    19: 429,      # total request limit reached
+    336001: 400,  # invalid argument
+    336002: 400,  # invalid JSON
+    336003: 400,  # parameter check failed
+    336005: 404,  # API name does not exist
+    336006: 400,  # the messages are not an odd number
+    336007: 400,  # message too long
+    336008: 400,  # system too long
+    336100: 503,  # try again
+    336501: 429,  # RPM limit reached
+    336502: 429,  # TPM limit reached
+}
 
-class Wenxin(ChatHandler, EmbeddingHandler):
-    cached_token: str = ""
-    cached_token_expires_at: int = 0
-
-    def __init__(self, wenxin_api_key: str, wenxin_secret_key: str):
+class Wenxin(Provider, ChatHandler, EmbeddingHandler):
+    def __init__(self, wenxin_api_key: str, wenxin_secret_key: str, api_base: str = "https://aip.baidubce.com",
+                 state: Optional[StateStore] = None):
+        super().__init__("wenxin")
+        self.api_base = api_base.rstrip("/")
         self.wenxin_api_key = wenxin_api_key
         self.wenxin_secret_key = wenxin_secret_key
+        # Wenxin token expires in 30 days, but we will refresh it 1 day ahead.
+        # Shared with the other workers when `state` is, under a digest of the key.
+        key = hashlib.sha256(f"{self.api_base} {wenxin_api_key}".encode()).hexdigest()[:16]
+        self.credential = Credential(
+            "Wenxin", self.fetch_token, refresh_ahead=24 * 3600, store=state, key=f"wenxin:{key}")
+
+    async def startup(self):
+        self.credential.start()
+
+    async def aclose(self):
+        await self.credential.stop()
+        await super().aclose()
 
     async def list_models(self) -> List[Model]:
         """List all models from Wenxin API"""
         chat_models = [Model(provider="wenxin", name=name, type="chat") for name in MODEL_ENDPOINT_MAP]
-        embedding_models = [
-            Model(provider="wenxin", name="embedding-v1", type="embedding"),
-            Model(provider="wenxin", name="bge_large_zh", type="embedding"),
-            Model(provider="wenxin", name="bge_large_en", type="embedding"),
-            Model(provider="wenxin", name="tao_8k", type="embedding"),
-            ]
+        embedding_models = [Model(provider="wenxin", name=name, type="embedding") for name in EMBEDDING_LIMITS]
         return chat_models + embedding_models
 
-    async def get_token(self):
-        url = "https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials" +\
+    async def fetch_token(self) -> Tuple[str, float]:
+        url = f"{self.api_base}/oauth/2.0/token?grant_type=client_credentials" +\
             f"&client_id={self.wenxin_api_key}&client_secret={self.wenxin_secret_key}"
 
-        if self.cached_token and self.cached_token_expires_at > time.time():
-            return self.cached_token
+        response = await self.pool.client.get(url=url)
+        data = response.json()
+        if "error" in data:
+            logger.error("Wenxin token error: %s", data['error'])
+            raise Exception(f"Wenxin token error: {data['error']}")
+        return str(data["access_token"]), time.time() + data["expires_in"]
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url=url)
-            data = response.json()
-            logger.info(f"Wenxin token request: {data}")
-            if "error" in data:
-                logger.error(f"Wenxin token error: {data['error']}")
-                raise Exception(f"Wenxin token error: {data['error']}")
-            self.cached_token = str(data["access_token"])
-            # Wenxin token expires in 30 days, but we will refresh it every 29 days
-            self.cached_token_expires_at = time.time() + data["expires_in"] - 24 * 3600
+    async def get_token(self) -> str:
+        return await self.credential.get()
 
-        return self.cached_token
+    async def post(self, url: str, json: dict, timeout=httpx.USE_CLIENT_DEFAULT) -> dict:
+        """POST to Wenxin API, retrying once with a new token if the token was rejected."""
+        token = await self.get_token()
+        kwargs = dict(url=url, headers={"Content-Type": "application/json"}, json=json, timeout=timeout)
+        log_body = log.sampled(log.BODY)
+        if log_body:
+            logger.info("Wenxin request to %s: %s", url, json)
+        response: httpx.Response = await self.pool.client.post(params={"access_token": token}, **kwargs) # type: ignore
+        response.raise_for_status()
+        res_body = response.json()
+        if res_body.get("error_code") in TOKEN_ERROR_CODES:
+            logger.warning("Wenxin token rejected: %s, retry with a new token", res_body['error_code'])
+            self.credential.invalidate(token)
+            token = await self.get_token()
+            response = await self.pool.client.post(params={"access_token": token}, **kwargs) # type: ignore
+            response.raise_for_status()
+            res_body = response.json()
+        if log_body:
+            logger.info("Wenxin response: %s", res_body)
+        return res_body
 
-    async def chat_completions(self, request: Request, model: str) -> Response:
+    async def chat_completions(self, request: ChatCompletionRequest, model: str) -> Response:
         """https://cloud.baidu.com/doc/WENXINWORKSHOP/s/jlil56u11
         """
-        token = await self.get_token()
-        body = await request.json()
-        new_body = convert_request(body)
+        new_body = convert_request(request)
 
         endpoint = MODEL_ENDPOINT_MAP.get(model.lower(), model)
-        url = f"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/{endpoint}"
-        stream = body.get('stream', False)
-        kwargs = dict(
-            url=url,
-            headers={"Content-Type": "application/json"},
-            params={"access_token": token},
-            json=new_body
-        )
-        logger.info(f"Wenxin request to {kwargs}")
-
-        if not stream:
-            async with httpx.AsyncClient() as client:
-                response: httpx.Response = await client.post(**kwargs, timeout=600) # type: ignore
+        url = f"{self.api_base}/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/{endpoint}"
 
-            response.raise_for_status()
-            res_body = response.json()
-            error_code = res_body.get("error_code", None)
-            if error_code:
-                if error_code == 110 or error_code == 111:
-                    # Token expired
-                    self.cached_token = ""
-                logger.error(f"Wenxin error: {error_code}")
-                return ErrorResponse(500, f"Wenxin error: {error_code}")
-            logger.info(f"Wenxin response: {res_body}")
+        if not request.stream:
+            res_body = await self.post(url, new_body, timeout=600)
+            if res_body.get("error_code"):
+                return wenxin_error(res_body).response()
             return JSONResponse(convert_response(res_body, model))
 
         # stream mode
         async def stream_generator():
-            client = httpx.AsyncClient()
-            first = True
-            completion_tokens = [0]
-            async with client.stream(method='POST', **kwargs) as response: # type: ignore
-                async for line in response.aiter_lines():
-                    if not line.startswith("data: "):
-                        continue
-                    payload = json.loads(line[6:].strip())
-                    logger.info(f"Wenxin stream response: {payload}")
-                    if first:
-                        first = False
-                        first_payload = {
-                            "id": payload["id"],
-                            "created": payload["created"],
-                        }
-                        yield convert_sse_response(first_payload, model, completion_tokens)
-                    yield convert_sse_response(payload, model, completion_tokens)
-            yield "[DONE]"
-
-        r = EventSourceResponse(stream_generator())
+            encoder = None
+            async for event in self.stream_events(url, new_body):
+                payload = event.json()
+                if log.sampled(log.CHUNK):
+                    logger.info("Wenxin stream response: %s", payload)
+                if encoder is None:
+                    encoder = ChunkEncoder(payload["id"], payload["created"], model)
+                    yield encoder.role()
+                yield convert_sse_response(payload, encoder)
+            yield DONE
+
+        r = event_source(stream_generator())
         r.ping_interval = 9999999
         return r
 
-    async def embeddings(self, request: Request, model: str) -> Response:
-        """https://cloud.baidu.com/doc/WENXINWORKSHOP/s/alj562vvu
+    async def stream_events(self, url: str, json: dict) -> AsyncIterator[Event]:
+        """Stream events of a Wenxin SSE response, retrying once with a new token if the token was rejected."""
+        for attempt in range(2):
+            token = await self.get_token()
+            if log.sampled(log.BODY):
+                logger.info("Wenxin stream request to %s: %s", url, json)
+            async with self.pool.client.stream(
+                method='POST',
+                url=url,
+                headers={"Content-Type": "application/json"},
+                params={"access_token": token},
+                json=json,
+            ) as response:
+                response.raise_for_status()
+                if not response.headers.get("content-type", "").startswith("text/event-stream"):
+                    # Errors are returned as a plain JSON body instead of events.
+                    res_body = loads_or_empty(await response.aread())
+                    error_code = res_body.get("error_code")
+                    if error_code in TOKEN_ERROR_CODES and attempt == 0:
+                        logger.warning("Wenxin token rejected: %s, retry with a new token", error_code)
+                        self.credential.invalidate(token)
+                        continue
+                    raise wenxin_error(res_body)
+                async for event in aiter_events(response):
+                    if b'"error_code"' in event.data:
+                        # Failed mid-stream: the client must not see an empty but successful stream.
+                        raise wenxin_error(event.json())
+                    yield event
+            return
+
+    async def create_embeddings(self, model: str, inputs: List[str], body: dict) -> dict:
+        """Fit inputs to the token limit of the model, by truncating them or by embedding
+        chunks and mean-pooling them (WENXIN_EMBEDDING_LONG_INPUT=chunk).
         """
-        body = await request.json()
-        if isinstance(body['input'], str):
-            inputs = [body['input']]
-        else:
-            inputs = body['input']
+        max_tokens = EMBEDDING_LIMITS.get(model, (16, 384))[1]
+        if settings.WENXIN_EMBEDDING_LONG_INPUT != "chunk":
+            return await self.create_embeddings_batches(model, [truncate(input, max_tokens) for input in inputs])
+
+        chunks: List[str] = []
+        owners: List[int] = []
         for i, input in enumerate(inputs):
-            # Wenxin only supports 384 tokens
-            inputs[i] = input[:384]
-        new_body = {'input': inputs}
+            for chunk in split_text(input, max_tokens):
+                chunks.append(chunk)
+                owners.append(i)
+        result = await self.create_embeddings_batches(model, chunks)
+        if len(chunks) == len(inputs):
+            return result
 
-        kwargs = dict(
-            url=f"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/embeddings/{model}",
-            headers={"Content-Type": "application/json"},
-            params={"access_token": await self.get_token()},
-            json=new_body
-        )
-        logger.info(f"Wenxin request to {kwargs}")
-        async with httpx.AsyncClient() as client:
-            response: httpx.Response = await client.post(**kwargs) # type: ignore
+        # Mean-pool the chunks of each input, weighted by their length in tokens.
+        pooled: List[List[float]] = [[] for _ in inputs]
+        weights = [0] * len(inputs)
+        data = sorted(result['data'], key=lambda d: d['index'])
+        for item, owner, chunk in zip(data, owners, chunks):
+            weight = estimate_tokens(chunk) or 1
+            if not pooled[owner]:
+                pooled[owner] = [0.0] * len(item['embedding'])
+            vector = pooled[owner]
+            for j, value in enumerate(item['embedding']):
+                vector[j] += value * weight
+            weights[owner] += weight
+        result['data'] = [
+            {'object': 'embedding', 'index': i, 'embedding': [value / weights[i] for value in vector]}
+            for i, vector in enumerate(pooled)
+        ]
+        return result
 
-        response.raise_for_status()
-        res_body = response.json()
-        error_code = res_body.get("error_code", None)
-        if error_code:
-            if error_code == 110 or error_code == 111:
-                # Token expired
-                self.cached_token = ""
-            logger.error(f"Wenxin error: {error_code}")
-            return ErrorResponse(500, f"Wenxin error: {error_code}")
-        logger.info(f"Wenxin response: {res_body}")
-        return JSONResponse({
+    async def create_embeddings_batches(self, model: str, inputs: List[str]) -> dict:
+        """Split inputs over the per-call limit of the model into sub-batches, sent concurrently."""
+        limit = EMBEDDING_LIMITS.get(model, (16, 384))[0]
+        if len(inputs) <= limit:
+            return await self.create_embeddings_batch(model, inputs)
+
+        semaphore = asyncio.Semaphore(settings.WENXIN_EMBEDDING_CONCURRENCY)
+
+        async def create(batch):
+            async with semaphore:
+                return await self.create_embeddings_batch(model, batch)
+
+        tasks = [asyncio.create_task(create(inputs[i:i + limit])) for i in range(0, len(inputs), limit)]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        data = []
+        usage = {'prompt_tokens': 0, 'total_tokens': 0}
+        for result in results:
+            for item in sorted(result['data'], key=lambda d: d['index']):
+                data.append(dict(item, index=len(data)))
+            for key in usage:
+                usage[key] += result['usage'].get(key, 0)
+        return {
+            'model': model,
+            'object': 'list',
+            'usage': usage,
+            'data': data
+        }
+
+    async def create_embeddings_batch(self, model: str, inputs: List[str]) -> dict:
+        new_body = {'input': inputs}
+
+        url = f"{self.api_base}/rpc/2.0/ai_custom/v1/wenxinworkshop/embeddings/{model}"
+        res_body = await self.post(url, new_body)
+        if res_body.get("error_code"):
+            raise wenxin_error(res_body)
+        return {
             'model': model,
             'object': 'list',
             'usage': res_body['usage'],
             'data': res_body['data']
-        })
+        }
 
 
-def convert_request(body):
+def error_status(error_code: int) -> int:
+    if error_code in ERROR_STATUS:
+        return ERROR_STATUS[error_code]
+    if 336100 < error_code < 336200:
+        # Checks of the parameters of the model: tokens, penalties, functions...
+        return 400
+    return 500
+
+
+def wenxin_error(res_body: dict) -> APIError:
+    """Error of a Wenxin response body, 4xx if the request is at fault."""
+    error_code = res_body.get("error_code")
+    error_msg = res_body.get("error_msg", "unexpected response")
+    status_code = error_status(error_code) if isinstance(error_code, int) else 500
+    if status_code >= 500:
+        logger.error("Wenxin error: %s %s", error_code, error_msg)
+    else:
+        logger.warning("Wenxin error: %s %s", error_code, error_msg)
+    return APIError(status_code, f"Wenxin error: {error_code} - {error_msg}")
+
+
+def convert_request(request: ChatCompletionRequest):
     """Convert OpenAI request body to Wenxin format"""
     msg = []
     system = ""
-    if body['messages'][0]['role'] == 'system':
-        system = body['messages'][0]['content']
-        msg = body['messages'][1:]
+    if request.messages[0]['role'] == 'system':
+        system = request.messages[0]['content']
+        msg = request.messages[1:]
     else:
-        msg = body['messages']
+        msg = request.messages
 
     new =  {
-        'stream': body.get('stream', False),
+        'stream': request.stream,
         'messages': msg,
     }
-    if "temperature" in body:
+    if request.temperature is not None:
         # Wenxin temperature is between 0.001 and 1
-        new["temperature"] = min(max(body["temperature"], 0.001), 1)
+        new["temperature"] = min(max(request.temperature, 0.001), 1)
     if system != "":
         new["system"] = system
-    if "max_tokens" in body:
-        new["max_output_tokens"] = body["max_tokens"]
+    if request.max_tokens is not None:
+        new["max_output_tokens"] = request.max_tokens
 
     return new
 
@@ -207,37 +329,12 @@ def convert_response(body, model):
         'usage': body['usage'],
     }
 
-def convert_sse_response(body, model, last_completion_tokens):
-    """Convert Wenxin SSE response to OpenAI format"""
-    response =  {
-        'id': body['id'],
-        'object': "chat.completion.chunk",
-        'created': body['created'],
-        'model': model,
-        'choices': [
-            {
-                'index': 0,
-                'delta': {},
-                'finish_reason': None,
-            }
-        ]
-    }
-    if body.get('usage'):
-        response['usage'] = body['usage']
-
+def convert_sse_response(body, encoder: ChunkEncoder) -> bytes:
+    """Convert Wenxin SSE response to an OpenAI chunk event"""
+    usage = body.get('usage') or None
     if body.get('is_end'):
         # stream end
-        response['choices'][0]['finish_reason'] = "stop"
-        response['choices'][0]['delta'] = {
-            'content': body['result'],
-        }
-    elif not body.get('result'):
-        response['choices'][0]['delta'] = {
-            'role': "assistant",
-            "content": "",
-        }
-    else:
-        response['choices'][0]['delta'] = {
-            'content': body['result'],
-        }
-    return json.dumps(response, ensure_ascii=False).strip()
+        return encoder.finish("stop", body['result'], usage)
+    if not body.get('result'):
+        return encoder.role(usage)
+    return encoder.content(body['result'], usage)
@@ -1,31 +1,60 @@
-import json
-from math import e
 import time
 import uuid
 import httpx
 import logging
-from typing import List
+from typing import List, Tuple
 
 import jwt
-from starlette.requests import Request
 from starlette.responses import Response, JSONResponse
-from sse_starlette.sse import EventSourceResponse
 
-from llm_fusion_api.provider.base import ChatHandler, Model
-from llm_fusion_api.response import ErrorResponse
+from llm_fusion_api.provider.base import ChatHandler, Model, Provider, loads_or_empty
+from llm_fusion_api.response import APIError
+from llm_fusion_api.schema import ChatCompletionRequest
+from llm_fusion_api import log
+from llm_fusion_api.credential import SignedCredential
+from llm_fusion_api.sse import ChunkEncoder, DONE, aiter_events, event_source
 
 
 logger = logging.getLogger(__name__)
 
-class Zhipu(ChatHandler):
-    chat_completion_url_tpl: str = "https://open.bigmodel.cn/api/paas/v3/model-api/{model}/{invoke_type}"
-
-    def __init__(self, zhipu_api_key: str):
+# HTTP status of the error codes caused by the request, or asking to slow down. Other codes are upstream faults.
+ERROR_STATUS = {
+    1210: 400,  # invalid parameters
+    1211: 404,  # model does not exist
+    1213: 400,  # no prompt
+    1214: 400,  # invalid messages
+    1261: 400,  # prompt too long
+    1301: 400,  # unsafe content
+    1302: 429,  # too many concurrent requests
+    1303: 429,  # request rate too high
+    1304: 429,  # daily limit reached
+    1305: 429,  # too much traffic
+}
+
+class Zhipu(Provider, ChatHandler):
+    chat_completion_url_tpl: str = "{api_base}/api/paas/v3/model-api/{model}/{invoke_type}"
+
+    # Lifetime of signed tokens, in seconds.
+    token_ttl: int = 600
+
+    def __init__(self, zhipu_api_key: str, api_base: str = "https://open.bigmodel.cn"):
+        super().__init__("zhipu")
+        self.api_base = api_base.rstrip("/")
         self.zhipu_api_key = zhipu_api_key
+        self.api_key_id, _, self.api_key_secret = zhipu_api_key.partition(".")
+        # Re-sign one minute before the token expires.
+        self.credential = SignedCredential("Zhipu", self.gen_token, refresh_ahead=60)
+
+    async def startup(self):
+        self.credential.start()
+
+    async def aclose(self):
+        await self.credential.stop()
+        await super().aclose()
 
     def get_chat_completion_url(self, model: str, stream: bool) -> str:
         invoke_type = "sse-invoke" if stream else "invoke"
-        return self.chat_completion_url_tpl.format(model=model, invoke_type=invoke_type)
+        return self.chat_completion_url_tpl.format(api_base=self.api_base, model=model, invoke_type=invoke_type)
 
     async def list_models(self) -> List[Model]:
         """List all models from Zhipu API"""
@@ -35,111 +64,130 @@ class Zhipu(ChatHandler):
             Model(provider="zhipu", name="chatglm_lite", type="chat"),
         ]
 
-    def gen_token(self) -> str:
-        id, secret = self.zhipu_api_key.split(".")
+    def gen_token(self) -> Tuple[str, float]:
+        """Sign a new token, return it with its expiry."""
+        now = time.time()
         payload = {
-            "api_key": id,
-            "exp": int(round(time.time() * 1000)) + 600 * 1000,
-            "timestamp": int(round(time.time() * 1000)),
+            "api_key": self.api_key_id,
+            "exp": int(round(now * 1000)) + self.token_ttl * 1000,
+            "timestamp": int(round(now * 1000)),
         }
 
-        return jwt.encode(
+        token = jwt.encode(
             payload,
-            secret,
+            self.api_key_secret,
             algorithm="HS256",
             headers={"alg": "HS256", "sign_type": "SIGN"},
         )
+        return token, now + self.token_ttl
 
 
-    async def chat_completions(self, request: Request) -> Response:
+    async def chat_completions(self, request: ChatCompletionRequest, model: str) -> Response:
         """https://open.bigmodel.cn/doc/api#chatglm_pro
         """
-        body = await request.json()
-        logger.info(f"Zhipu request: {body}")
-        new_body = convert_request(body)
+        new_body = convert_request(request)
 
-        model = body.get('model', '').split('/')[-1]
-        stream = body.get('stream', False)
+        stream = request.stream
         kwargs = dict(
             url=self.get_chat_completion_url(model, stream),
             headers={
                 "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.gen_token()}",
+                "Authorization": f"Bearer {await self.credential.get()}",
             },
             json=new_body
         )
-        logger.info(f"Zhipu request to {kwargs}")
+        log_body = log.sampled(log.BODY)
+        if log_body:
+            logger.info("Zhipu request to %s: %s", kwargs['url'], new_body)
 
         if not stream:
-            async with httpx.AsyncClient() as client:
-                response: httpx.Response = await client.post(**kwargs) # type: ignore
+            response: httpx.Response = await self.pool.client.post(**kwargs) # type: ignore
 
             response.raise_for_status()
             res_body = response.json()
-            error_code = res_body.get("code", 0)
-            if error_code != 200:
-                logger.error(f"Zhipu error: {error_code}")
-                return ErrorResponse(500, f"Zhipu error: {error_code} - {res_body.get('msg', '')}")
-            logger.info(f"Zhipu response: {res_body}")
-            return JSONResponse(convert_response(res_body, model))
+            if res_body.get("code", 0) != 200:
+                return zhipu_error(res_body).response()
+            if log_body:
+                logger.info("Zhipu response: %s", res_body)
+            return JSONResponse(convert_response(res_body['data'], model))
 
         # stream mode
         async def stream_generator():
             id = uuid.uuid4().hex
-            client = httpx.AsyncClient()
-            first = True
-            async with client.stream(method='POST', **kwargs) as response: # type: ignore
-                async for line in response.aiter_lines():
-                    if line.startswith("id: "):
-                        id = line[4:].strip()
-                        continue
-                    if line.startswith('event: "finish"'):
-                        yield convert_sse_response({"finished": True}, model, id=id)
+            encoder = None
+            async with self.pool.client.stream(method='POST', **kwargs) as response: # type: ignore
+                response.raise_for_status()
+                if response.headers.get("content-type", "").startswith("application/json"):
+                    # Errors are returned as a plain JSON body instead of events.
+                    raise zhipu_error(loads_or_empty(await response.aread()))
+                async for event in aiter_events(response):
+                    if log.sampled(log.CHUNK):
+                        logger.info("Zhipu stream response: %r", event)
+                    # Events are `add` with the next piece of text, then `finish`, or `error` / `interrupted`.
+                    type = event.event.strip('"')
+                    if type == 'error':
+                        # Failed mid-stream: the client must not see an empty but successful stream.
+                        logger.error("Zhipu stream error: %s", event.text)
+                        raise APIError(500, f"Zhipu error: {event.text}")
+                    if type == 'interrupted':
+                        # Stopped by the content filter.
+                        logger.warning("Zhipu stream interrupted: %s", event.text)
+                        raise APIError(400, f"Zhipu stream interrupted: {event.text}")
+                    if encoder is None:
+                        encoder = ChunkEncoder(event.id or id, int(time.time()), model)
+                        yield convert_sse_response({}, encoder)
+                    if type == 'finish':
+                        yield convert_sse_response({"finished": True}, encoder)
                         break
-                    if not line.startswith("data: "):
-                        continue
-                    text = line[6:].strip()
-                    logger.info(f"Zhipu stream response: {text}")
-                    if first:
-                        first = False
-                        yield convert_sse_response({}, model, id=id)
                     yield convert_sse_response({
-                        "text": text,
-                    }, model, id=id)
-            yield "[DONE]"
+                        "text": event.text,
+                    }, encoder)
+            yield DONE
 
-        return EventSourceResponse(stream_generator())
+        return event_source(stream_generator())
 
 
-def convert_request(body):
+def zhipu_error(res_body: dict) -> APIError:
+    """Error of a Zhipu response body, 4xx if the request is at fault."""
+    error_code = res_body.get("code")
+    error_msg = res_body.get("msg", "unexpected response")
+    status_code = ERROR_STATUS.get(error_code, 500)
+    if status_code >= 500:
+        logger.error("Zhipu error: %s %s", error_code, error_msg)
+    else:
+        logger.warning("Zhipu error: %s %s", error_code, error_msg)
+    return APIError(status_code, f"Zhipu error: {error_code} - {error_msg}")
+
+
+def convert_request(request: ChatCompletionRequest):
     """Convert OpenAI request body to Zhipu format"""
     msg = []
-    if body['messages'][0]['role'] == 'system':
-        if body['messages'][0]['content'].strip() == '':
-            msg = body['messages'][1:]
+    if request.messages[0]['role'] == 'system':
+        if request.messages[0]['content'].strip() == '':
+            msg = request.messages[1:]
         else:
             msg.append({
                 'role': 'user',
-                'content': body['messages'][0]['content']
+                'content': request.messages[0]['content']
             })
             msg.append({
                 'role': 'assistant',
                 'content': '收到'
             })
-            msg.extend(body['messages'][1:])
+            msg.extend(request.messages[1:])
     else:
-        msg = body['messages']
+        msg = request.messages
 
     new =  {
         'incremental': True,
         'prompt': msg,
     }
-    if "temperature" in body:
+    if request.temperature is not None:
         # Wenxin temperature is between 0.001 and 1
-        new["temperature"] = min(max(body["temperature"], 0.001), 1)
+        new["temperature"] = min(max(request.temperature, 0.001), 1)
 
-    if "top_p" in body:
-        new["top_p"] = body["top_p"]
+    if request.top_p is not None:
+        new["top_p"] = request.top_p
 
     return new
 
@@ -165,31 +213,11 @@ def convert_response(body, model):
     return r
 
 
-def convert_sse_response(body, model, id=None):
-    """Convert MiniMax SSE response to OpenAI format"""
-    response =  {
-        'id': id,
-        'object': "chat.completion.chunk",
-        'created': int(time.time()),
-        'model': model,
-        'choices': [
-            {
-                'index': 0,
-                'delta': {},
-                'finish_reason': None,
-            }
-        ],
-    }
+def convert_sse_response(body, encoder: ChunkEncoder) -> bytes:
+    """Convert Zhipu SSE response to an OpenAI chunk event"""
+    # The finish event has no text, check it first.
+    if 'finished' in body:
+        return encoder.finish('stop')
     if 'text' not in body:
-        response['choices'][0]['delta'] = {
-            'role': "assistant",
-            "content": "",
-        }
-    elif 'finished' in body:
-        response['choices'][0]['finish_reason'] = 'stop'
-    else:
-        response['choices'][0]['delta'] = {
-            'content': body['text'],
-        }
-
-    return json.dumps(response, ensure_ascii=False)
+        return encoder.role()
+    return encoder.content(body['text'])
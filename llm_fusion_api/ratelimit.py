@@ -0,0 +1,139 @@
+import json
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from llm_fusion_api.response import ErrorResponse, APIError
+from llm_fusion_api.state import MemoryStateStore, StateStore
+
+
+logger = logging.getLogger(__name__)
+
+
+class Tenant(object):
+    """An API client with its keys and budgets, a budget of 0 is unlimited.
+
+    `priority` orders its calls waiting for an upstream slot, higher first.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        keys: Sequence[str] = (),
+        key_hashes: Sequence[str] = (),
+        requests_per_second: float = 0,
+        tokens_per_minute: float = 0,
+        max_streams: int = 0,
+        priority: int = 0,
+    ):
+        self.name = name
+        self.keys = keys
+        self.key_hashes = key_hashes
+        self.requests_per_second = requests_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self.max_streams = max_streams
+        self.priority = priority
+
+
+def load_tenants(path: str) -> List[Tenant]:
+    """Read tenants from a JSON file: {"tenants": [{"name": ..., "keys": [...], "requests_per_second": ...}]}"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    return [Tenant(**tenant) for tenant in data['tenants']]
+
+
+class RateLimited(APIError):
+    """A tenant is over budget, rendered as a 429 with `Retry-After`"""
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(429, message)
+        self.retry_after = retry_after
+
+    def response(self) -> ErrorResponse:
+        response = super().response()
+        response.headers['Retry-After'] = str(max(int(self.retry_after + 0.999), 1))
+        return response
+
+
+class Lease(object):
+    """Budget taken by one request: its stream slot, and its estimated tokens to settle with the actual usage."""
+
+    def __init__(self, limiter: 'RateLimiter', tenant: Tenant, tokens: int, stream: bool):
+        self.limiter = limiter
+        self.tenant = tenant
+        self.tokens = tokens
+        self.stream = stream
+
+    def finish(self, usage: Dict[str, int]):
+        """Release the stream slot and charge the difference between the used and the estimated tokens."""
+        if self.stream:
+            self.stream = False
+            self.limiter.store.call_soon(self.limiter.store.release_slot, f"{self.tenant.name}:streams")
+        used = usage.get('total_tokens', usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0))
+        if self.tenant.tokens_per_minute and used and used != self.tokens:
+            rate = self.tenant.tokens_per_minute / 60
+            self.limiter.store.call_soon(self.limiter.store.charge, f"{self.tenant.name}:tokens", rate,
+                                         self.tenant.tokens_per_minute, used - self.tokens)
+            self.tokens = used
+
+
+class RateLimiter(object):
+    """Enforces the budgets of tenants: requests per second, tokens per minute and concurrent streams.
+
+    Over-budget requests wait up to `max_wait` seconds for the budget to be available again,
+    or are rejected with a 429 error and a `Retry-After` header.
+    """
+    # Polling interval for a stream slot.
+    slot_poll_interval: float = 0.1
+
+    def __init__(self, tenants: List[Tenant], store: Optional[StateStore] = None, max_wait: float = 0):
+        self.tenants = {tenant.name: tenant for tenant in tenants}
+        self.store = store or MemoryStateStore()
+        self.max_wait = max_wait
+        self.rejected: Dict[str, int] = {}
+
+    async def admit(self, tenant_name: Optional[str], tokens: int, stream: bool = False) -> Optional[Lease]:
+        """Take the budget of a request, waiting for it if allowed. Raises `RateLimited` if over budget."""
+        tenant = self.tenants.get(tenant_name or '')
+        if tenant is None:
+            return None
+        deadline = time.monotonic() + self.max_wait
+        # Buckets taken from so far: (budget, rate, capacity, cost)
+        taken: List[Tuple[str, float, float, float]] = []
+        try:
+            if tenant.requests_per_second:
+                bucket = ('requests', tenant.requests_per_second, max(tenant.requests_per_second, 1), 1)
+                await self._take(tenant, *bucket, deadline)
+                taken.append(bucket)
+            if tenant.tokens_per_minute:
+                bucket = ('tokens', tenant.tokens_per_minute / 60, tenant.tokens_per_minute, tokens)
+                await self._take(tenant, *bucket, deadline)
+                taken.append(bucket)
+            stream = stream and tenant.max_streams > 0
+            if stream:
+                key = f"{tenant.name}:streams"
+                while not await self.store.call(self.store.acquire_slot, key, tenant.max_streams):
+                    if time.monotonic() + self.slot_poll_interval > deadline:
+                        self._reject(tenant, "concurrent streams", 1)
+                    await asyncio.sleep(self.slot_poll_interval)
+        except BaseException:
+            # Rejected or cancelled on a later budget: refund the earlier ones, the request is not sent.
+            for budget, rate, capacity, cost in taken:
+                self.store.call_soon(self.store.charge, f"{tenant.name}:{budget}", rate, capacity, -cost)
+            raise
+        return Lease(self, tenant, tokens, stream)
+
+    async def _take(self, tenant: Tenant, budget: str, rate: float, capacity: float, cost: float, deadline: float):
+        key = f"{tenant.name}:{budget}"
+        while True:
+            wait = await self.store.call(self.store.take, key, rate, capacity, cost)
+            if not wait:
+                return
+            if time.monotonic() + wait > deadline:
+                self._reject(tenant, budget, wait)
+            await asyncio.sleep(wait)
+
+    def _reject(self, tenant: Tenant, budget: str, retry_after: float):
+        self.rejected[tenant.name] = self.rejected.get(tenant.name, 0) + 1
+        logger.info("%s over its %s budget, retry after %.1fs", tenant.name, budget, retry_after)
+        raise RateLimited(f"Rate limit exceeded for {tenant.name}: {budget}", retry_after)
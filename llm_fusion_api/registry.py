@@ -0,0 +1,142 @@
+"""Routing of public model IDs to providers.
+
+The registry is built from the model catalog and rebuilt each time a provider's model
+list is refreshed: every listed model is reachable under its public ID (`gpt-4`,
+`wenxin/ernie-bot`, `fastchat/lmsys/vicuna-7b-v1.5`) with one dict lookup. IDs and aliases
+match in any case. Aliases map a public ID to one or several targets, split by weight.
+Unknown models are rejected before any upstream work, except on providers whose model list
+could not be fetched, where `provider/model` names are passed through unchecked.
+"""
+import logging
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from llm_fusion_api.provider import Model, parse_weighted
+from llm_fusion_api.response import APIError
+
+
+logger = logging.getLogger(__name__)
+
+CHAT = 'chat'
+EMBEDDING = 'embedding'
+
+
+class Route(object):
+    """Where a public model ID goes: the provider, the model name upstream and what it can do."""
+    provider: str
+    model: str
+    capabilities: FrozenSet[str]
+
+    def __init__(self, provider: str, model: str, capabilities: Iterable[str] = (CHAT, EMBEDDING)):
+        self.provider = provider
+        self.model = model
+        self.capabilities = frozenset(capabilities)
+
+    def __repr__(self):
+        return f"Route({self.provider}/{self.model}, {sorted(self.capabilities)})"
+
+
+class Alias(object):
+    """Targets of an alias, picked by smooth weighted round-robin."""
+
+    def __init__(self, targets: List[Tuple[str, float]]):
+        self.targets = [target for target, _ in targets]
+        self.weights = [weight for _, weight in targets]
+        self.total = sum(self.weights)
+        self.current = [0.0] * len(targets)
+
+    def pick(self) -> str:
+        best = 0
+        for i, weight in enumerate(self.weights):
+            self.current[i] += weight
+            if self.current[i] > self.current[best]:
+                best = i
+        self.current[best] -= self.total
+        return self.targets[best]
+
+
+def public_id(model: Model) -> str:
+    """ID of a model in the API: OpenAI's models go without their provider."""
+    return model.name if model.provider == 'openai' else f"{model.provider}/{model.name}"
+
+
+def parse_aliases(items: Iterable[str]) -> Dict[str, List[Tuple[str, float]]]:
+    """Parse `alias -> model` and `alias -> model@weight | model@weight` settings."""
+    aliases: Dict[str, List[Tuple[str, float]]] = {}
+    for item in items:
+        alias, arrow, targets = item.partition('->')
+        parsed = [parse_weighted(target.strip()) for target in targets.split('|') if target.strip()]
+        if not arrow or not alias.strip() or not parsed:
+            raise ValueError(f"Invalid model alias {item!r}, expected 'alias -> model'")
+        aliases[alias.strip()] = parsed
+    return aliases
+
+
+class ModelRegistry(object):
+    """Public model IDs of all providers, and the aliases between them.
+
+    `untyped` providers list their models without telling chat from embedding models,
+    their models are routed for both.
+    """
+
+    def __init__(self, providers: Iterable[str], aliases: Dict[str, List[Tuple[str, float]]],
+                 untyped: Iterable[str] = ()):
+        self.providers = set(providers)
+        self.untyped = set(untyped)
+        self.aliases = {name.lower(): Alias(targets) for name, targets in aliases.items()}
+        for name, targets in aliases.items():
+            for target, _ in targets:
+                if self._parse(target) is None:
+                    logger.warning("Alias %s targets %s, whose provider is not configured", name, target)
+        self.routes: Dict[str, Route] = {}
+        self.listed: Dict[str, Dict[str, Route]] = {}
+        # Providers without a model list (yet): their models are not checked.
+        self.unlisted: Set[str] = set(self.providers)
+
+    def update(self, provider: str, models: List[Model], error: Optional[str] = None):
+        """Replace the models of a provider, from a refresh of the catalog."""
+        if error and not models:
+            self.listed.pop(provider, None)
+            self.unlisted.add(provider)
+        else:
+            routes = {}
+            for model in models:
+                capabilities = (CHAT, EMBEDDING) if provider in self.untyped else (model.type,)
+                route = Route(provider, model.name, capabilities)
+                routes[public_id(model).lower()] = routes[f"{provider}/{model.name}".lower()] = route
+            self.listed[provider] = routes
+            self.unlisted.discard(provider)
+        # Rebuilt rather than updated in place, lookups never see a partial table.
+        routes = {}
+        for provider_routes in self.listed.values():
+            routes.update(provider_routes)
+        self.routes = routes
+
+    def resolve(self, name: str, capability: str) -> Route:
+        """Route of a model ID or alias, raise an `APIError` if it is unknown or can not serve `capability`."""
+        key = name.lower()
+        alias = self.aliases.get(key)
+        if alias is not None:
+            # Configured targets are trusted, listed or not.
+            target = alias.pick()
+            route = self.routes.get(target.lower()) or self._parse(target)
+        else:
+            route = self.routes.get(key)
+            if route is None:
+                route = self._parse(name)
+                if route is not None and route.provider not in self.unlisted:
+                    route = None
+        if route is None:
+            raise APIError(404, f"The model `{name}` does not exist")
+        if capability not in route.capabilities:
+            raise APIError(400, f"The model `{name}` does not support {capability}")
+        return route
+
+    def _parse(self, name: str) -> Optional[Route]:
+        """Route of a `provider/model` name by its first segment, models without a provider are OpenAI's."""
+        provider, slash, model = name.partition('/')
+        provider = provider.lower()
+        if not slash:
+            provider, model = 'openai', name
+        if provider not in self.providers or not model:
+            return None
+        return Route(provider, model)
@@ -0,0 +1,267 @@
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set
+
+import httpx
+from starlette.responses import Response, StreamingResponse
+from sse_starlette.sse import EventSourceResponse
+
+from llm_fusion_api.response import ErrorResponse, APIError, aclose_iterator
+from llm_fusion_api.breaker import CircuitBreakers
+from llm_fusion_api.concurrency import AdaptiveLimiters, Overloaded
+
+
+logger = logging.getLogger(__name__)
+
+# Upstream status codes worth retrying on another attempt, member or model.
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def is_retryable_error(e: BaseException) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRYABLE_STATUS_CODES
+    if isinstance(e, APIError):
+        return e.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(e, httpx.TransportError)
+
+
+def is_client_error(e: BaseException) -> bool:
+    """Errors caused by the request, which say nothing about the health of the upstream."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code not in RETRYABLE_STATUS_CODES
+    if isinstance(e, APIError):
+        return e.status_code not in RETRYABLE_STATUS_CODES
+    return False
+
+
+def is_failure(result: Any) -> bool:
+    """Whether a result is a retryable error response."""
+    return isinstance(result, Response) and result.status_code in RETRYABLE_STATUS_CODES
+
+
+def error_response(e: Exception) -> ErrorResponse:
+    """OpenAI-shaped response of an upstream error that was not recovered from."""
+    if isinstance(e, APIError):
+        return e.response()
+    if isinstance(e, httpx.HTTPStatusError):
+        status_code = 429 if e.response.status_code == 429 else 502
+        return ErrorResponse(status_code, f"Upstream error: {e.response.status_code}")
+    if isinstance(e, httpx.TimeoutException):
+        return ErrorResponse(504, "Upstream timeout")
+    return ErrorResponse(502, f"Upstream error: {e.__class__.__name__}")
+
+
+async def discard(result: Any):
+    """Release the upstream connection of a response that will not be sent."""
+    if not isinstance(result, (StreamingResponse, EventSourceResponse)):
+        return
+    try:
+        await aclose_iterator(result.body_iterator)
+    except Exception:
+        pass
+    if result.background is not None:
+        await result.background()
+
+
+class LatencyWindow(object):
+    """Latencies of the last `size` successful calls, for percentiles."""
+
+    def __init__(self, size: int):
+        self.samples: Deque[float] = deque(maxlen=size)
+        self._sorted: Optional[List[float]] = None
+
+    def add(self, latency: float):
+        self.samples.append(latency)
+        self._sorted = None
+
+    def percentile(self, p: float) -> float:
+        if self._sorted is None:
+            self._sorted = sorted(self.samples)
+        index = min(int(len(self._sorted) * p / 100), len(self._sorted) - 1)
+        return self._sorted[index]
+
+
+class Resilience(object):
+    """Retries upstream calls with jittered exponential backoff, and hedges slow non-stream calls.
+
+    A call is retried on 429/5xx responses and on connection errors, up to `retries` times.
+    Streams are retried only until their first chunk, which is awaited before the response
+    is returned. When `hedge_percentile` is set, a non-stream call still running after that
+    percentile of the recent latencies of the same key gets a duplicate, the first success wins.
+    With `breakers`, calls to a key whose circuit breaker is open fail fast with a 503.
+    With `limiters`, each upstream call takes a slot of the adaptive limiter of its key, and
+    a call finding no slot in time fails with a 503 without being retried.
+    """
+
+    def __init__(
+        self,
+        retries: int = 2,
+        base_delay: float = 0.2,
+        max_delay: float = 5.0,
+        hedge_percentile: float = 0,
+        hedge_min_samples: int = 20,
+        window: int = 200,
+        breakers: Optional[CircuitBreakers] = None,
+        limiters: Optional[AdaptiveLimiters] = None,
+    ):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.window = window
+        self.breakers = breakers
+        self.limiters = limiters
+        self.latencies: Dict[str, LatencyWindow] = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._tasks: Set[asyncio.Task] = set()
+
+    def backoff(self, attempt: int, result: Any = None) -> float:
+        """Full jitter: a random delay up to the exponential backoff, at least the upstream Retry-After."""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = result.headers.get('retry-after') if isinstance(result, Response) else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), self.max_delay))
+        return delay
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+        window = self.latencies.get(key)
+        if not self.hedge_percentile or window is None or len(window.samples) < self.hedge_min_samples:
+            return None
+        return window.percentile(self.hedge_percentile)
+
+    async def call(
+        self, key: str, call: Callable[[], Awaitable[Any]], stream: bool = False, priority: int = 0,
+    ) -> Any:
+        """Run `call` with retries. Returns its last result, or raises its last error if it failed with one."""
+        breaker = self.breakers.get(key) if self.breakers is not None else None
+        if self.limiters is not None:
+            call = self.limiters.get(key).wrap(call, priority, stream)
+        attempt = 0
+        while True:
+            if breaker is not None and not breaker.allow():
+                return breaker.reject()
+            start = time.monotonic()
+            try:
+                if stream:
+                    result = await self._call_stream(call)
+                else:
+                    result = await self._call_hedged(key, call)
+            except Overloaded as e:
+                # Not sent upstream, retrying would only add to the queue.
+                if breaker is not None:
+                    breaker.release()
+                return e.response()
+            except Exception as e:
+                if breaker is not None:
+                    breaker.record(not is_client_error(e), time.monotonic() - start)
+                if attempt >= self.retries or not is_retryable_error(e):
+                    raise
+                logger.warning("%s attempt %d failed: %r, retrying", key, attempt + 1, e)
+                result = None
+            except BaseException:
+                if breaker is not None:
+                    breaker.release()
+                raise
+            else:
+                if breaker is not None:
+                    breaker.record(is_failure(result), time.monotonic() - start)
+                if attempt >= self.retries or not is_failure(result):
+                    return result
+                logger.warning("%s attempt %d failed: %d, retrying", key, attempt + 1, result.status_code)
+                await discard(result)
+            await asyncio.sleep(self.backoff(attempt, result))
+            attempt += 1
+
+    async def _call_stream(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Call and wait for the first chunk of a stream, so a failure to start can be retried."""
+        result = await call()
+        if is_failure(result) or not isinstance(result, (StreamingResponse, EventSourceResponse)):
+            return result
+        iterator = result.body_iterator
+        try:
+            first = await iterator.__anext__()
+        except StopAsyncIteration:
+            return result
+        except Exception:
+            await discard(result)
+            raise
+        result.body_iterator = prepend(first, iterator)
+        return result
+
+    async def _call_hedged(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        start = time.monotonic()
+        delay = self.hedge_delay(key)
+        if delay is None:
+            result = await call()
+        else:
+            result = await self._race(call, delay)
+        if not is_failure(result):
+            self.latencies.setdefault(key, LatencyWindow(self.window)).add(time.monotonic() - start)
+        return result
+
+    async def _race(self, call: Callable[[], Awaitable[Any]], delay: float) -> Any:
+        tasks = [asyncio.ensure_future(call())]
+        winner = tasks[0]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedges += 1
+                tasks.append(asyncio.ensure_future(call()))
+                pending = set(tasks)
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    succeeded = [task for task in done if task.exception() is None and not is_failure(task.result())]
+                    if succeeded:
+                        winner = succeeded[0]
+                        self.hedge_wins += winner is tasks[1]
+                        break
+                # Otherwise both failed, report the primary.
+            return winner.result()
+        finally:
+            for task in tasks:
+                if task is not winner:
+                    # Cancel the loser, or release its response if it completed too.
+                    task.cancel()
+                    self._discard_later(task)
+            if not winner.done():
+                winner.cancel()
+
+    def _discard_later(self, task: asyncio.Future):
+        async def wait_and_discard():
+            try:
+                await discard(await task)
+            except BaseException:
+                pass
+        cleanup = asyncio.create_task(wait_and_discard())
+        self._tasks.add(cleanup)
+        cleanup.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hedges": self.hedges, "hedge_wins": self.hedge_wins}
+
+
+async def prepend(first: Any, iterator):
+    try:
+        yield first
+        async for item in iterator:
+            yield item
+    finally:
+        await aclose_iterator(iterator)
+
+
+def parse_fallbacks(chains: Iterable[str]) -> Dict[str, List[str]]:
+    """Parse `a -> b -> c` chains: each model falls back to the models after it.
+
+    Keys are lowercased, model IDs match in any case as in the registry.
+    """
+    fallbacks: Dict[str, List[str]] = {}
+    for chain in chains:
+        models = [model.strip() for model in chain.split('->') if model.strip()]
+        for i, model in enumerate(models[:-1]):
+            fallbacks.setdefault(model.lower(), models[i + 1:])
+    return fallbacks
@@ -5,3 +5,25 @@ class ErrorResponse(JSONResponse):
     def __init__(self, status_code: int, message: str):
         content = {'error': {'message': message}}
         super().__init__(content, status_code=status_code)
+
+
+class APIError(Exception):
+    """Error raised by providers, rendered as an `ErrorResponse`"""
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+    def response(self) -> ErrorResponse:
+        return ErrorResponse(self.status_code, self.message)
+
+
+async def aclose_iterator(iterator):
+    """Close a response body iterator, releasing the upstream response it reads from.
+
+    Iterating with `async for` does not close the iterator when the consumer stops early,
+    so each wrapper of a body iterator closes the one it wraps.
+    """
+    aclose = getattr(iterator, 'aclose', None)
+    if aclose is not None:
+        await aclose()
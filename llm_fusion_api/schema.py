@@ -0,0 +1,128 @@
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Union
+
+from llm_fusion_api import jsonlib
+from llm_fusion_api.tokens import estimate_tokens
+from llm_fusion_api.response import APIError
+
+
+def decode_body(raw: bytes) -> dict:
+    """Decode a JSON request body, raise a 400 `APIError` if it is not a JSON object."""
+    try:
+        body = jsonlib.loads(raw)
+    except ValueError:
+        raise APIError(400, 'Invalid JSON body')
+    if not isinstance(body, dict):
+        raise APIError(400, 'Request body must be a JSON object')
+    return body
+
+
+def _number(body: dict, name: str) -> Optional[float]:
+    value = body.get(name)
+    if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+        raise APIError(400, f"'{name}' must be a number")
+    return value
+
+
+def _integer(body: dict, name: str) -> Optional[int]:
+    value = body.get(name)
+    if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+        raise APIError(400, f"'{name}' must be an integer")
+    return value
+
+
+@dataclass(slots=True)
+class ChatCompletionRequest:
+    """Validated POST /v1/chat/completions request, decoded once and handed to providers.
+
+    `body` is the decoded request with all fields, `raw` the bytes it was decoded from.
+    """
+    model: str
+    messages: List[dict]
+    stream: bool = False
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    n: Optional[int] = None
+    max_tokens: Optional[int] = None
+    stop: Union[str, List[str], None] = None
+    body: dict = field(default_factory=dict, repr=False)
+    raw: bytes = field(default=b'', repr=False)
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> 'ChatCompletionRequest':
+        body = decode_body(raw)
+        model = body.get('model')
+        if not isinstance(model, str) or not model:
+            raise APIError(400, "'model' is required")
+        messages = body.get('messages')
+        if not isinstance(messages, list) or not messages:
+            raise APIError(400, "'messages' must be a non-empty list")
+        for message in messages:
+            if not isinstance(message, dict) or not isinstance(message.get('role'), str):
+                raise APIError(400, "Each message must be an object with a 'role'")
+        stream = body.get('stream') or False
+        if not isinstance(stream, bool):
+            raise APIError(400, "'stream' must be a boolean")
+        return cls(
+            model=model,
+            messages=messages,
+            stream=stream,
+            temperature=_number(body, 'temperature'),
+            top_p=_number(body, 'top_p'),
+            n=_integer(body, 'n'),
+            max_tokens=_integer(body, 'max_tokens'),
+            stop=body.get('stop'),
+            body=body,
+            raw=raw,
+        )
+
+    def estimate_prompt_tokens(self) -> int:
+        """Estimated tokens of the text content of the messages."""
+        total = 0
+        for message in self.messages:
+            content = message.get('content')
+            if isinstance(content, str):
+                total += estimate_tokens(content)
+            elif isinstance(content, list):
+                total += sum(estimate_tokens(part['text']) for part in content
+                             if isinstance(part, dict) and isinstance(part.get('text'), str))
+        return total
+
+
+@dataclass(slots=True)
+class EmbeddingRequest:
+    """Validated POST /v1/embeddings request, decoded once and handed to providers.
+
+    `inputs` is always a list, even if the request had a single string `input`.
+    """
+    model: str
+    inputs: List[Any]
+    body: dict = field(default_factory=dict, repr=False)
+    raw: bytes = field(default=b'', repr=False)
+
+    @classmethod
+    def from_bytes(cls, raw: bytes, default_model: Optional[str] = None) -> 'EmbeddingRequest':
+        body = decode_body(raw)
+        model = body.get('model', default_model)
+        if not isinstance(model, str) or not model:
+            raise APIError(400, "'model' is required")
+        inputs = body.get('input')
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        elif not isinstance(inputs, list) or not inputs:
+            raise APIError(400, "'input' must be a string or a non-empty list")
+        return cls(model=model, inputs=inputs, body=body, raw=raw)
+
+    def is_text(self) -> bool:
+        """Whether all inputs are strings, as opposed to token arrays."""
+        return all(isinstance(input, str) for input in self.inputs)
+
+    def estimate_tokens(self) -> int:
+        """Estimated tokens of the inputs, token arrays count their length."""
+        total = 0
+        for input in self.inputs:
+            if isinstance(input, str):
+                total += estimate_tokens(input)
+            else:
+                total += len(input) if isinstance(input, list) else 1
+        return total
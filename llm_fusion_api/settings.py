@@ -1,5 +1,5 @@
 from starlette.config import Config
-from starlette.datastructures import Secret
+from starlette.datastructures import CommaSeparatedStrings, Secret
 
 
 # Load environment variables from .env file
@@ -9,18 +9,126 @@ config: Config = Config(".env")
 # Debug mode
 DEBUG: bool = config('DEBUG', cast=bool, default=False)
 # Secret token for authentication
-SECRET_TOKEN: Secret = config('SECRET_TOKEN', cast=Secret, default=Secret(''))
+SECRET_TOKEN: Secret = config('SECRET_TOKEN', cast=Secret, default='')
+# Additional API keys, comma separated, in plain text or as sha256 hex digests
+SECRET_TOKENS: CommaSeparatedStrings = config('SECRET_TOKENS', cast=CommaSeparatedStrings, default='')
+SECRET_TOKEN_HASHES: CommaSeparatedStrings = config('SECRET_TOKEN_HASHES', cast=CommaSeparatedStrings, default='')
+# Tenants with their own API keys and budgets, in a JSON file (see README)
+TENANTS_FILE: str = config('TENANTS_FILE', default='')
+# SQLite database (in WAL mode) of the state shared by the workers of a host: Wenxin access tokens, model lists,
+# the response cache and rate limits. In-process when empty. RATE_LIMIT_DB is its former name.
+RATE_LIMIT_DB: str = config('RATE_LIMIT_DB', default='')
+STATE_DB: str = config('STATE_DB', default=RATE_LIMIT_DB)
+# Seconds an over-budget request may wait for its budget, 0 to reject it right away with a 429
+RATE_LIMIT_MAX_WAIT: float = config('RATE_LIMIT_MAX_WAIT', cast=float, default=0.0)
 # OpenAI API settings
 OPENAI_API_BASE: str = config('OPENAI_API_BASE', default='https://api.openai.com/v1')
-OPENAI_API_KEY: Secret = config('OPENAI_API_KEY', cast=Secret, default=Secret(''))
+OPENAI_API_KEY: Secret = config('OPENAI_API_KEY', cast=Secret, default='')
+# Additional OpenAI API keys, comma separated, optionally weighted as `key@weight`
+OPENAI_API_KEYS: CommaSeparatedStrings = config('OPENAI_API_KEYS', cast=CommaSeparatedStrings, default='')
 # Wenxin API settings
-WENXIN_API_KEY: Secret = config('WENXIN_API_KEY', cast=Secret, default=Secret(''))
-WENXIN_SECRET_KEY: Secret = config('WENXIN_SECRET_KEY', cast=Secret, default=Secret(''))
+WENXIN_API_BASE: str = config('WENXIN_API_BASE', default='https://aip.baidubce.com')
+WENXIN_API_KEY: Secret = config('WENXIN_API_KEY', cast=Secret, default='')
+WENXIN_SECRET_KEY: Secret = config('WENXIN_SECRET_KEY', cast=Secret, default='')
+# Additional Wenxin credentials, comma separated `api_key:secret_key` pairs, optionally weighted with `@weight`
+WENXIN_API_KEYS: CommaSeparatedStrings = config('WENXIN_API_KEYS', cast=CommaSeparatedStrings, default='')
 # FastChat API settings
 FASTCHAT_OPENAI_API_BASE: str = config('FASTCHAT_OPENAI_API_BASE', default='')
-FASTCHAT_OPENAI_API_KEY: Secret = config('FASTCHAT_OPENAI_API_KEY', cast=Secret, default=Secret(''))
+# Additional FastChat replicas, comma separated base URLs, optionally weighted as `url@weight`
+FASTCHAT_OPENAI_API_BASES: CommaSeparatedStrings = config(
+    'FASTCHAT_OPENAI_API_BASES', cast=CommaSeparatedStrings, default='')
+FASTCHAT_OPENAI_API_KEY: Secret = config('FASTCHAT_OPENAI_API_KEY', cast=Secret, default='')
 # MiniMax API settings
-MINIMAX_GROUP_ID: Secret = config('MINIMAX_GROUP_ID', cast=Secret, default=Secret(''))
-MINIMAX_API_KEY: Secret = config('MINIMAX_API_KEY', cast=Secret, default=Secret(''))
+MINIMAX_API_BASE: str = config('MINIMAX_API_BASE', default='https://api.minimax.chat')
+MINIMAX_GROUP_ID: Secret = config('MINIMAX_GROUP_ID', cast=Secret, default='')
+MINIMAX_API_KEY: Secret = config('MINIMAX_API_KEY', cast=Secret, default='')
+# Additional MiniMax API keys of the same group, comma separated, optionally weighted as `key@weight`
+MINIMAX_API_KEYS: CommaSeparatedStrings = config('MINIMAX_API_KEYS', cast=CommaSeparatedStrings, default='')
 # Zhipu API settings
-ZHIPU_API_KEY: Secret = config('ZHIPU_API_KEY', cast=Secret, default=Secret(''))
+ZHIPU_API_BASE: str = config('ZHIPU_API_BASE', default='https://open.bigmodel.cn')
+ZHIPU_API_KEY: Secret = config('ZHIPU_API_KEY', cast=Secret, default='')
+# Additional Zhipu API keys, comma separated, optionally weighted as `key@weight`
+ZHIPU_API_KEYS: CommaSeparatedStrings = config('ZHIPU_API_KEYS', cast=CommaSeparatedStrings, default='')
+# Routing over the keys/base URLs of a provider: least_outstanding or weighted_round_robin
+POOL_STRATEGY: str = config('POOL_STRATEGY', default='least_outstanding')
+# A key/base URL failing this many times in a row is ejected for POOL_EJECT_SECONDS
+POOL_EJECT_FAILURES: int = config('POOL_EJECT_FAILURES', cast=int, default=3)
+POOL_EJECT_SECONDS: float = config('POOL_EJECT_SECONDS', cast=float, default=30.0)
+# Upstream HTTP connection pool settings (per provider)
+HTTP_MAX_CONNECTIONS: int = config('HTTP_MAX_CONNECTIONS', cast=int, default=100)
+HTTP_MAX_KEEPALIVE_CONNECTIONS: int = config('HTTP_MAX_KEEPALIVE_CONNECTIONS', cast=int, default=20)
+HTTP_KEEPALIVE_EXPIRY: float = config('HTTP_KEEPALIVE_EXPIRY', cast=float, default=30.0)
+HTTP_TIMEOUT: float = config('HTTP_TIMEOUT', cast=float, default=5.0)
+# HTTP/2 requires the `h2` package (pip install httpx[http2])
+HTTP2: bool = config('HTTP2', cast=bool, default=False)
+# Model catalog settings (GET /v1/models)
+MODELS_CACHE_TTL: float = config('MODELS_CACHE_TTL', cast=float, default=300.0)
+MODELS_FETCH_TIMEOUT: float = config('MODELS_FETCH_TIMEOUT', cast=float, default=10.0)
+# Model aliases, comma separated, e.g. "gpt-4 -> wenxin/ernie-bot-4". An alias split across several models by weight
+# lists them separated by "|", e.g. "chat -> wenxin/ernie-bot@3 | zhipu/chatglm_pro@1"
+MODEL_ALIASES: CommaSeparatedStrings = config('MODEL_ALIASES', cast=CommaSeparatedStrings, default='')
+# Response cache of deterministic (temperature 0) chat completions, disabled by default
+RESPONSE_CACHE: bool = config('RESPONSE_CACHE', cast=bool, default=False)
+RESPONSE_CACHE_MAX_ENTRIES: int = config('RESPONSE_CACHE_MAX_ENTRIES', cast=int, default=1024)
+RESPONSE_CACHE_TTL: float = config('RESPONSE_CACHE_TTL', cast=float, default=3600.0)
+# Optional directory for the on-disk tier of the response cache
+RESPONSE_CACHE_DIR: str = config('RESPONSE_CACHE_DIR', default='')
+# Size cap of RESPONSE_CACHE_DIR in megabytes, its oldest files are removed over it, 0 for no cap
+RESPONSE_CACHE_DIR_MAX_MB: float = config('RESPONSE_CACHE_DIR_MAX_MB', cast=float, default=1024.0)
+# Embedding cache, disabled when EMBEDDING_CACHE_MAX_ENTRIES is 0
+EMBEDDING_CACHE_MAX_ENTRIES: int = config('EMBEDDING_CACHE_MAX_ENTRIES', cast=int, default=0)
+# Optional directory for memory-mapped embedding cache files, in memory otherwise
+EMBEDDING_CACHE_DIR: str = config('EMBEDDING_CACHE_DIR', default='')
+# Coalesce concurrent single-input embedding requests for up to this many milliseconds, 0 to disable
+EMBEDDING_BATCH_WINDOW: float = config('EMBEDDING_BATCH_WINDOW', cast=float, default=0.0)
+EMBEDDING_BATCH_MAX_SIZE: int = config('EMBEDDING_BATCH_MAX_SIZE', cast=int, default=16)
+# Max concurrent upstream calls when a large Wenxin embedding request is split into sub-batches
+WENXIN_EMBEDDING_CONCURRENCY: int = config('WENXIN_EMBEDDING_CONCURRENCY', cast=int, default=4)
+# Wenxin embedding inputs over the model token limit are truncated, or split and mean-pooled with "chunk"
+WENXIN_EMBEDDING_LONG_INPUT: str = config('WENXIN_EMBEDDING_LONG_INPUT', default='truncate')
+# Coalesce the chunks of converted streams (Wenxin, MiniMax, Zhipu) sent within this many milliseconds into one
+# write, 0 to send each chunk as soon as it is ready
+SSE_FLUSH_WINDOW: float = config('SSE_FLUSH_WINDOW', cast=float, default=0.0)
+# End streams whose upstream sends no chunk for this many seconds, with an error event, 0 to disable
+STREAM_IDLE_TIMEOUT: float = config('STREAM_IDLE_TIMEOUT', cast=float, default=60.0)
+# Offline batches (/v1/files and /v1/batches), disabled when BATCH_DIR is empty: directory of the files and batches,
+# concurrent requests and requests per second (0 for no limit) of each batch, and seconds between checkpoints
+BATCH_DIR: str = config('BATCH_DIR', default='')
+BATCH_CONCURRENCY: int = config('BATCH_CONCURRENCY', cast=int, default=8)
+BATCH_REQUESTS_PER_SECOND: float = config('BATCH_REQUESTS_PER_SECOND', cast=float, default=0.0)
+BATCH_CHECKPOINT_SECONDS: float = config('BATCH_CHECKPOINT_SECONDS', cast=float, default=1.0)
+# Logging: level, output format (text or json), and sampling rates (0.0 to 1.0) of bodies and stream chunks
+LOG_LEVEL: str = config('LOG_LEVEL', default='INFO')
+LOG_FORMAT: str = config('LOG_FORMAT', default='text')
+LOG_SAMPLE_BODIES: float = config('LOG_SAMPLE_BODIES', cast=float, default=0.01)
+LOG_SAMPLE_CHUNKS: float = config('LOG_SAMPLE_CHUNKS', cast=float, default=0.0)
+# Retries of upstream calls on 429/5xx and connection errors, with jittered exponential backoff (in seconds)
+RETRY_ATTEMPTS: int = config('RETRY_ATTEMPTS', cast=int, default=2)
+RETRY_BASE_DELAY: float = config('RETRY_BASE_DELAY', cast=float, default=0.2)
+RETRY_MAX_DELAY: float = config('RETRY_MAX_DELAY', cast=float, default=5.0)
+# Duplicate non-stream calls slower than this percentile (e.g. 95) of the recent latencies of the model, 0 to disable
+HEDGE_PERCENTILE: float = config('HEDGE_PERCENTILE', cast=float, default=0.0)
+HEDGE_MIN_SAMPLES: int = config('HEDGE_MIN_SAMPLES', cast=int, default=20)
+# Chat model fallback chains, comma separated, e.g. "wenxin/ernie-bot-4 -> zhipu/chatglm_pro -> gpt-3.5-turbo"
+FALLBACK_CHAINS: CommaSeparatedStrings = config('FALLBACK_CHAINS', cast=CommaSeparatedStrings, default='')
+# Circuit breaker per provider/model: opens when BREAKER_ERROR_RATE of the last BREAKER_WINDOW calls failed
+# (at least BREAKER_MIN_CALLS), calls slower than BREAKER_SLOW_SECONDS (0 to disable) count as failures.
+# Open, calls fail fast for BREAKER_OPEN_SECONDS, then BREAKER_HALF_OPEN_CALLS probes decide to close it.
+# BREAKER_WINDOW=0 disables circuit breakers.
+BREAKER_WINDOW: int = config('BREAKER_WINDOW', cast=int, default=20)
+BREAKER_MIN_CALLS: int = config('BREAKER_MIN_CALLS', cast=int, default=10)
+BREAKER_ERROR_RATE: float = config('BREAKER_ERROR_RATE', cast=float, default=0.5)
+BREAKER_SLOW_SECONDS: float = config('BREAKER_SLOW_SECONDS', cast=float, default=0.0)
+BREAKER_OPEN_SECONDS: float = config('BREAKER_OPEN_SECONDS', cast=float, default=30.0)
+BREAKER_HALF_OPEN_CALLS: int = config('BREAKER_HALF_OPEN_CALLS', cast=int, default=3)
+# Adaptive concurrency limit per provider/model, starting at CONCURRENCY_INITIAL_LIMIT (0 disables it).
+# It shrinks by CONCURRENCY_BACKOFF on 429/503/timeouts or latencies over CONCURRENCY_LATENCY_TOLERANCE times the
+# recent median, and grows back by one per round of successful calls. Calls over the limit wait in a queue of
+# CONCURRENCY_QUEUE_SIZE for up to CONCURRENCY_MAX_WAIT seconds, then fail with a 503.
+CONCURRENCY_INITIAL_LIMIT: int = config('CONCURRENCY_INITIAL_LIMIT', cast=int, default=0)
+CONCURRENCY_MIN_LIMIT: int = config('CONCURRENCY_MIN_LIMIT', cast=int, default=1)
+CONCURRENCY_MAX_LIMIT: int = config('CONCURRENCY_MAX_LIMIT', cast=int, default=256)
+CONCURRENCY_BACKOFF: float = config('CONCURRENCY_BACKOFF', cast=float, default=0.7)
+CONCURRENCY_LATENCY_TOLERANCE: float = config('CONCURRENCY_LATENCY_TOLERANCE', cast=float, default=2.0)
+CONCURRENCY_QUEUE_SIZE: int = config('CONCURRENCY_QUEUE_SIZE', cast=int, default=100)
+CONCURRENCY_MAX_WAIT: float = config('CONCURRENCY_MAX_WAIT', cast=float, default=10.0)
@@ -0,0 +1,246 @@
+"""Server-sent events: encoding of OpenAI `chat.completion.chunk` events, and decoding of upstream streams.
+
+The envelope of the chunks of a stream (`id`, `object`, `created`, `model`) is serialized
+once, each chunk only escapes its delta and splices it in. Events are framed here, as
+bytes that `EventSourceResponse` sends as they are.
+
+Upstream streams are decoded incrementally from their raw byte chunks by `SSEDecoder`,
+following https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+"""
+import asyncio
+from typing import Any, AsyncIterable, AsyncIterator, List, Optional
+
+import httpx
+from sse_starlette.sse import EventSourceResponse
+
+from llm_fusion_api import jsonlib, settings
+from llm_fusion_api.response import aclose_iterator
+
+
+# Same line separator as EventSourceResponse.
+SEP = b'\r\n'
+DONE = b'data: [DONE]' + SEP + SEP
+
+ROLE_DELTA = b'{"role":"assistant","content":""}'
+EMPTY_DELTA = b'{}'
+
+BOM = b'\xef\xbb\xbf'
+
+
+class ChunkEncoder(object):
+    """Encoder of the chunks of one stream, for one choice."""
+    __slots__ = ('head',)
+
+    def __init__(self, id: Optional[str], created: int, model: str, index: int = 0):
+        envelope = jsonlib.dumps({'id': id, 'object': "chat.completion.chunk", 'created': created, 'model': model})
+        # Everything up to the delta: `data: {"id":...,"choices":[{"index":0,"delta":`
+        self.head = b'data: ' + envelope[:-1] + b',"choices":[{"index":' + str(index).encode() + b',"delta":'
+
+    def _event(self, delta: bytes, finish_reason: bytes, usage: Optional[dict]) -> bytes:
+        if usage:
+            return b''.join((self.head, delta, b',"finish_reason":', finish_reason, b'}],"usage":',
+                             jsonlib.dumps(usage), b'}', SEP, SEP))
+        return b''.join((self.head, delta, b',"finish_reason":', finish_reason, b'}]}', SEP, SEP))
+
+    def role(self, usage: Optional[dict] = None) -> bytes:
+        """First chunk, with the role of the message."""
+        return self._event(ROLE_DELTA, b'null', usage)
+
+    def content(self, text: str, usage: Optional[dict] = None) -> bytes:
+        return self._event(b'{"content":' + jsonlib.dumps(text) + b'}', b'null', usage)
+
+    def finish(self, finish_reason: str = 'stop', text: Optional[str] = None, usage: Optional[dict] = None) -> bytes:
+        """Last chunk, with the finish reason and the last piece of text if any."""
+        delta = EMPTY_DELTA if text is None else b'{"content":' + jsonlib.dumps(text) + b'}'
+        return self._event(delta, jsonlib.dumps(finish_reason), usage)
+
+
+async def coalesce(events: AsyncIterable[bytes], window: float) -> AsyncIterator[bytes]:
+    """Join the events that follow an event within `window` seconds into one write.
+
+    The first event is never delayed by more than `window`, and a stalled upstream
+    does not hold back the events already received.
+    """
+    iterator = events.__aiter__()
+    pending: Optional[asyncio.Future] = None
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            if pending is None:
+                try:
+                    first = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+            else:
+                try:
+                    first = await pending
+                except StopAsyncIteration:
+                    return
+                finally:
+                    pending = None
+            buffer: List[bytes] = [first]
+            deadline = loop.time() + window
+            while True:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                pending = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait((pending,), timeout=timeout)
+                if not done:
+                    # Carried over as the first event of the next write.
+                    break
+                try:
+                    buffer.append(pending.result())
+                except StopAsyncIteration:
+                    pending = None
+                    yield b''.join(buffer)
+                    return
+                pending = None
+            yield b''.join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait((pending,))
+        await aclose_iterator(iterator)
+
+
+def event_source(events: AsyncIterable[bytes], **kwargs) -> EventSourceResponse:
+    """Stream framed events, coalesced over SSE_FLUSH_WINDOW milliseconds when it is set."""
+    if settings.SSE_FLUSH_WINDOW > 0:
+        events = coalesce(events, settings.SSE_FLUSH_WINDOW / 1000)
+    return EventSourceResponse(events, **kwargs)
+
+
+def iter_data(item) -> List[str]:
+    """The data of the events of a streamed item: a framed event or several, or the bare data."""
+    if isinstance(item, bytes):
+        return [line[6:].decode() for line in item.split(SEP) if line.startswith(b'data: ')]
+    return [item]
+
+
+class Event(object):
+    """A decoded event. `data` is kept as bytes, which `json()` parses without decoding it first."""
+    __slots__ = ('event', 'data', 'id', 'retry')
+
+    def __init__(self, event: str, data: bytes, id: str = '', retry: Optional[int] = None):
+        self.event = event
+        self.data = data
+        self.id = id
+        self.retry = retry
+
+    @property
+    def text(self) -> str:
+        return self.data.decode('utf-8', 'replace')
+
+    def json(self) -> Any:
+        return jsonlib.loads(self.data)
+
+    def __repr__(self):
+        return f"Event({self.event!r}, {self.data!r}, id={self.id!r})"
+
+
+class SSEDecoder(object):
+    """Incremental decoder of an event stream, fed raw byte chunks split anywhere.
+
+    Lines end with CRLF, LF or CR, a CRLF split across two chunks included. Multi-line
+    `data` fields are joined with LF, comments and unknown fields are skipped, and an
+    event is dispatched at each blank line, only if it had a `data` field. `close` ends
+    the stream and dispatches an event left without its blank line.
+    """
+    __slots__ = ('_buffer', '_skip_lf', '_start', '_event', '_data', '_id', '_retry')
+
+    def __init__(self):
+        self._buffer = b''
+        # The last chunk ended with CR: a LF starting the next one ends the same line.
+        self._skip_lf = False
+        self._start = True
+        self._event = ''
+        self._data: List[bytes] = []
+        self._id = ''
+        self._retry: Optional[int] = None
+
+    def feed(self, chunk: bytes) -> List[Event]:
+        """Decode a chunk, return the events completed by it."""
+        if self._start:
+            # Skip a byte order mark, even split across chunks.
+            chunk = self._buffer + chunk
+            if len(chunk) < 3 and BOM.startswith(chunk):
+                self._buffer = chunk
+                return []
+            self._buffer = b''
+            self._start = False
+            if chunk.startswith(BOM):
+                chunk = chunk[3:]
+        if self._skip_lf and chunk:
+            self._skip_lf = False
+            if chunk[0] == 10:
+                chunk = chunk[1:]
+        buffer = self._buffer + chunk if self._buffer else chunk
+        if b'\r' in buffer:
+            self._skip_lf = buffer.endswith(b'\r')
+            buffer = buffer.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+        lines = buffer.split(b'\n')
+        # The last line is not complete yet.
+        self._buffer = lines.pop()
+        events: List[Event] = []
+        for line in lines:
+            if not line:
+                if self._data:
+                    events.append(self._dispatch())
+                else:
+                    self._event = ''
+            elif line.startswith(b'data: '):
+                # Fast path for the most common line.
+                self._data.append(line[6:])
+            else:
+                self._field(line)
+        return events
+
+    def close(self) -> List[Event]:
+        """End of the stream: return the event of the last lines, if they had data."""
+        line, self._buffer = self._buffer, b''
+        if line and not self._start:
+            if line.startswith(b'data: '):
+                self._data.append(line[6:])
+            else:
+                self._field(line)
+        return [self._dispatch()] if self._data else []
+
+    def _field(self, line: bytes):
+        colon = line.find(b':')
+        if colon == 0:
+            # Comment, such as a keep-alive.
+            return
+        if colon < 0:
+            name, value = line, b''
+        else:
+            name = line[:colon]
+            value = line[colon + 2:] if line[colon + 1:colon + 2] == b' ' else line[colon + 1:]
+        if name == b'data':
+            self._data.append(value)
+        elif name == b'event':
+            self._event = value.decode('utf-8', 'replace')
+        elif name == b'id':
+            if b'\0' not in value:
+                self._id = value.decode('utf-8', 'replace')
+        elif name == b'retry':
+            if value.isdigit():
+                self._retry = int(value)
+
+    def _dispatch(self) -> Event:
+        data = self._data[0] if len(self._data) == 1 else b'\n'.join(self._data)
+        event = Event(self._event or 'message', data, self._id, self._retry)
+        self._event = ''
+        self._data = []
+        return event
+
+
+async def aiter_events(response: httpx.Response) -> AsyncIterator[Event]:
+    """Events of a streamed upstream response, the last one included if the stream ends without a blank line."""
+    decoder = SSEDecoder()
+    async for chunk in response.aiter_bytes():
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.close():
+        yield event
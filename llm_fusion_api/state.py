@@ -0,0 +1,363 @@
+"""State shared by the workers of a host: cached values, token buckets, concurrency slots and leases.
+
+`uvicorn --workers` runs independent processes. With the in-process store each one keeps
+its own budgets, and the caches of the app stay in the worker that filled them.
+`SQLiteStateStore` keeps the state in one SQLite database in WAL mode instead: all the
+workers of a host share one access token per key, one model list per provider, one
+response cache and one budget per tenant.
+"""
+import os
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class StateStore(ABC):
+    """Values with a TTL, token buckets, concurrency slots and leases, shared by the users of one store.
+
+    Hits and misses of `get` are counted per namespace. `lock_waits` and `lock_wait_seconds`
+    count the writes that waited for another process, `lease_conflicts` the leases held elsewhere.
+    """
+    # Other processes see the same state.
+    shared: bool = False
+    # Calls block on I/O, `call` runs them in a thread.
+    threaded: bool = False
+
+    def __init__(self):
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        self.lock_waits = 0
+        self.lock_wait_seconds = 0.0
+        self.lease_conflicts = 0
+
+    async def call(self, fn, *args):
+        if self.threaded:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    def call_soon(self, fn, *args):
+        """Fire and forget from sync code, e.g. the end of a stream."""
+        if self.threaded:
+            try:
+                asyncio.get_running_loop().run_in_executor(None, fn, *args)
+                return
+            except RuntimeError:
+                pass
+        fn(*args)
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def set(self, namespace: str, key: str, value: bytes, ttl: float):
+        pass
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str, value: Optional[bytes] = None):
+        """Delete a value, only if it is still `value` when given."""
+        pass
+
+    @abstractmethod
+    def take(self, key: str, rate: float, capacity: float, cost: float) -> float:
+        """Take `cost` tokens if the bucket has them and return 0, else return the seconds to wait for them."""
+        pass
+
+    @abstractmethod
+    def charge(self, key: str, rate: float, capacity: float, cost: float):
+        """Adjust the bucket by `cost` without checking, it may go negative (a debt) or be refunded."""
+        pass
+
+    @abstractmethod
+    def acquire_slot(self, key: str, limit: int) -> bool:
+        pass
+
+    @abstractmethod
+    def release_slot(self, key: str):
+        pass
+
+    @abstractmethod
+    def acquire_lease(self, name: str, seconds: float) -> bool:
+        """Hold `name` for `seconds`, unless another process holds it. The holder may extend it."""
+        pass
+
+    @abstractmethod
+    def release_lease(self, name: str):
+        pass
+
+    def _count(self, namespace: str, hit: bool):
+        counts = self.hits if hit else self.misses
+        counts[namespace] = counts.get(namespace, 0) + 1
+
+
+async def fetch_once(
+    store: StateStore,
+    lease: str,
+    load: Callable[[], Awaitable[Optional[T]]],
+    fetch: Callable[[], Awaitable[T]],
+    timeout: float,
+    poll_interval: float = 0.1,
+) -> T:
+    """Return the value `load` finds in the store, or `fetch` it in one process at a time.
+
+    `fetch` stores the value. The processes that do not hold `lease` wait for it, up to
+    `timeout` seconds before fetching it anyway.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        value = await load()
+        if value is not None:
+            return value
+        if await store.call(store.acquire_lease, lease, timeout):
+            break
+        if time.monotonic() > deadline:
+            logger.warning("%s held by another worker for %ss, fetching anyway", lease, timeout)
+            break
+        await asyncio.sleep(poll_interval)
+    try:
+        # Stored by the previous holder while this one was waiting?
+        value = await load()
+        if value is not None:
+            return value
+        return await fetch()
+    finally:
+        await store.call(store.release_lease, lease)
+
+
+def refill(tokens: float, updated: float, now: float, rate: float, capacity: float) -> float:
+    return min(capacity, tokens + (now - updated) * rate)
+
+
+class MemoryStateStore(StateStore):
+    """State of this process only."""
+
+    def __init__(self):
+        super().__init__()
+        self.values: Dict[Tuple[str, str], Tuple[bytes, float]] = {}
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+        self.slots: Dict[str, int] = {}
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        item = self.values.get((namespace, key))
+        if item is not None and item[1] <= time.time():
+            del self.values[(namespace, key)]
+            item = None
+        self._count(namespace, item is not None)
+        return item[0] if item is not None else None
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: float):
+        self.values[(namespace, key)] = (value, time.time() + ttl)
+
+    def delete(self, namespace: str, key: str, value: Optional[bytes] = None):
+        item = self.values.get((namespace, key))
+        if item is not None and (value is None or item[0] == value):
+            del self.values[(namespace, key)]
+
+    def take(self, key: str, rate: float, capacity: float, cost: float) -> float:
+        now = time.time()
+        tokens, updated = self.buckets.get(key, (capacity, now))
+        tokens = refill(tokens, updated, now, rate, capacity)
+        if tokens < min(cost, capacity):
+            self.buckets[key] = (tokens, now)
+            return (min(cost, capacity) - tokens) / rate
+        self.buckets[key] = (tokens - cost, now)
+        return 0
+
+    def charge(self, key: str, rate: float, capacity: float, cost: float):
+        now = time.time()
+        tokens, updated = self.buckets.get(key, (capacity, now))
+        self.buckets[key] = (min(capacity, refill(tokens, updated, now, rate, capacity) - cost), now)
+
+    def acquire_slot(self, key: str, limit: int) -> bool:
+        if self.slots.get(key, 0) >= limit:
+            return False
+        self.slots[key] = self.slots.get(key, 0) + 1
+        return True
+
+    def release_slot(self, key: str):
+        self.slots[key] = max(self.slots.get(key, 0) - 1, 0)
+
+    def acquire_lease(self, name: str, seconds: float) -> bool:
+        # No other process to hold it.
+        return True
+
+    def release_lease(self, name: str):
+        pass
+
+
+class SQLiteStateStore(StateStore):
+    """State in a SQLite database in WAL mode, shared by all the workers on a host.
+
+    Slots and leases are held per process, those of a worker that died are dropped when
+    they would prevent a new one from being acquired. The database holds access tokens:
+    it is created readable by its owner only.
+    """
+    shared = True
+    threaded = True
+    # Writes waiting longer than this for the database lock count as contended.
+    contention_threshold: float = 0.001
+    # Expired values are deleted every that many writes.
+    purge_interval: int = 256
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.pid = os.getpid()
+        self._local = threading.local()
+        self._writes = 0
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (namespace TEXT, key TEXT, value BLOB, expires REAL, "
+            "PRIMARY KEY (namespace, key)) WITHOUT ROWID")
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS slots (key TEXT, pid INTEGER, count INTEGER, PRIMARY KEY (key, pid))")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, pid INTEGER, expires REAL)")
+        conn.execute("DELETE FROM slots WHERE pid = ?", (self.pid,))
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _waited(self, start: float):
+        waited = time.perf_counter() - start
+        if waited > self.contention_threshold:
+            self.lock_waits += 1
+            self.lock_wait_seconds += waited
+
+    def _transaction(self) -> sqlite3.Connection:
+        conn = self._connect()
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        self._waited(start)
+        return conn
+
+    def _write(self, sql: str, parameters: tuple):
+        """Run one write statement, in its own transaction."""
+        conn = self._connect()
+        start = time.perf_counter()
+        conn.execute(sql, parameters)
+        self._waited(start)
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        row = self._connect().execute(
+            "SELECT value FROM kv WHERE namespace = ? AND key = ? AND expires > ?", (namespace, key, time.time()),
+        ).fetchone()
+        self._count(namespace, row is not None)
+        return row[0] if row is not None else None
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: float):
+        now = time.time()
+        self._write("INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?)", (namespace, key, value, now + ttl))
+        self._writes += 1
+        if self._writes % self.purge_interval == 0:
+            self._write("DELETE FROM kv WHERE expires <= ?", (now,))
+
+    def delete(self, namespace: str, key: str, value: Optional[bytes] = None):
+        if value is None:
+            self._write("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+        else:
+            self._write("DELETE FROM kv WHERE namespace = ? AND key = ? AND value = ?", (namespace, key, value))
+
+    def _bucket(self, conn: sqlite3.Connection, key: str, rate: float, capacity: float, now: float) -> float:
+        row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return capacity
+        return refill(row[0], row[1], now, rate, capacity)
+
+    def take(self, key: str, rate: float, capacity: float, cost: float) -> float:
+        conn = self._transaction()
+        try:
+            now = time.time()
+            tokens = self._bucket(conn, key, rate, capacity, now)
+            wait = 0.0
+            if tokens < min(cost, capacity):
+                wait = (min(cost, capacity) - tokens) / rate
+            else:
+                tokens -= cost
+            conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (key, tokens, now))
+            conn.execute("COMMIT")
+            return wait
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def charge(self, key: str, rate: float, capacity: float, cost: float):
+        conn = self._transaction()
+        try:
+            now = time.time()
+            tokens = min(capacity, self._bucket(conn, key, rate, capacity, now) - cost)
+            conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (key, tokens, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def acquire_slot(self, key: str, limit: int) -> bool:
+        conn = self._transaction()
+        try:
+            rows = conn.execute("SELECT pid, count FROM slots WHERE key = ?", (key,)).fetchall()
+            if sum(count for _, count in rows) >= limit:
+                dead = [pid for pid, _ in rows if pid != self.pid and not pid_alive(pid)]
+                for pid in dead:
+                    conn.execute("DELETE FROM slots WHERE pid = ?", (pid,))
+                if sum(count for pid, count in rows if pid not in dead) >= limit:
+                    conn.execute("COMMIT")
+                    return False
+            conn.execute(
+                "INSERT INTO slots VALUES (?, ?, 1) ON CONFLICT (key, pid) DO UPDATE SET count = count + 1",
+                (key, self.pid),
+            )
+            conn.execute("COMMIT")
+            return True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def release_slot(self, key: str):
+        self._write("UPDATE slots SET count = MAX(count - 1, 0) WHERE key = ? AND pid = ?", (key, self.pid))
+
+    def acquire_lease(self, name: str, seconds: float) -> bool:
+        conn = self._transaction()
+        try:
+            now = time.time()
+            row = conn.execute("SELECT pid, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != self.pid and row[1] > now and pid_alive(row[0]):
+                conn.execute("COMMIT")
+                self.lease_conflicts += 1
+                return False
+            conn.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?)", (name, self.pid, now + seconds))
+            conn.execute("COMMIT")
+            return True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def release_lease(self, name: str):
+        self._write("DELETE FROM leases WHERE name = ? AND pid = ?", (name, self.pid))
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
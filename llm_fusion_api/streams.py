@@ -0,0 +1,91 @@
+"""End of streamed responses: client disconnects and stalled upstreams.
+
+Starlette and sse-starlette stop iterating a response when the client goes away, but
+leave its body iterator suspended, so the upstream request stays open until the
+iterator is garbage collected. `guard` closes the iterator chain right after the
+response ends, which aborts the upstream request and releases its connection, and
+ends streams whose upstream sends nothing for `idle_timeout` seconds, or that fail with an `APIError`.
+"""
+import asyncio
+import logging
+from typing import AsyncIterator, Optional
+
+import httpx
+from starlette.background import BackgroundTask
+from starlette.responses import Response, StreamingResponse
+from sse_starlette.sse import EventSourceResponse
+
+from llm_fusion_api import jsonlib, metrics
+from llm_fusion_api.response import APIError, aclose_iterator
+from llm_fusion_api.sse import SEP
+
+
+logger = logging.getLogger(__name__)
+
+CLIENT_DISCONNECT = 'client_disconnect'
+IDLE_TIMEOUT = 'idle_timeout'
+
+
+def guard(response: Response, tracker: metrics.RequestMetrics, idle_timeout: float = 0) -> Response:
+    """Close the body of a streamed response as soon as it ends, and time out idle upstreams.
+
+    The body is closed from its outermost wrapper at the time, so wrappers added after
+    this one (such as `RequestMetrics.track`) see the disconnect too.
+    """
+    if not isinstance(response, (StreamingResponse, EventSourceResponse)):
+        return response
+    is_sse = isinstance(response, EventSourceResponse) or \
+        response.headers.get('content-type', '').startswith('text/event-stream')
+    response.body_iterator = _iterate(response.body_iterator, tracker, idle_timeout, is_sse)
+    background = response.background
+
+    async def close():
+        # Runs once the response is done, sent or not: a no-op if the stream was complete.
+        await aclose_iterator(response.body_iterator)
+        if background is not None:
+            await background()
+    response.background = BackgroundTask(close)
+    return response
+
+
+async def _iterate(iterator, tracker: metrics.RequestMetrics, idle_timeout: float, is_sse: bool) -> AsyncIterator:
+    name = f"{tracker.provider}/{tracker.model}"
+    try:
+        while True:
+            try:
+                if idle_timeout:
+                    async with asyncio.timeout(idle_timeout):
+                        item = await iterator.__anext__()
+                else:
+                    item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            except (TimeoutError, httpx.TimeoutException):
+                logger.warning("%s stream idle for %ss, aborted", name, idle_timeout)
+                metrics.observe_stream_abort(tracker.provider, tracker.model, IDLE_TIMEOUT)
+                tracker.finish(504)
+                if not is_sse:
+                    raise
+                yield error_event("Upstream stream timed out")
+                return
+            except APIError as e:
+                # The upstream reported an error after the stream started.
+                logger.warning("%s stream failed: %s", name, e.message)
+                tracker.finish(e.status_code)
+                if not is_sse:
+                    raise
+                yield error_event(e.message, 'upstream_error')
+                return
+            yield item
+    except (GeneratorExit, asyncio.CancelledError):
+        # Closed or cancelled before the end: the client went away.
+        logger.info("%s client disconnected, upstream stream aborted", name)
+        metrics.observe_stream_abort(tracker.provider, tracker.model, CLIENT_DISCONNECT)
+        raise
+    finally:
+        await aclose_iterator(iterator)
+
+
+def error_event(message: str, type: Optional[str] = 'timeout') -> bytes:
+    """OpenAI-shaped error event, ending a stream that can not be completed."""
+    return b'data: ' + jsonlib.dumps({'error': {'message': message, 'type': type}}) + SEP + SEP
@@ -0,0 +1,70 @@
+import re
+from functools import lru_cache
+from typing import List, Tuple
+
+# CJK ideographs, kana and hangul count as one token each.
+CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+TOKEN_RE = re.compile(rf"[{CJK}]|[^\W\d_{CJK}]+|\d|\S")
+# Average number of characters per token of words in alphabetic scripts.
+CHARS_PER_TOKEN = 4
+
+
+def _cost(piece: str) -> int:
+    if len(piece) == 1:
+        return 1
+    return -(-len(piece) // CHARS_PER_TOKEN)
+
+
+@lru_cache(maxsize=4096)
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of a text, without a model-specific tokenizer.
+
+    CJK characters, digits and punctuation count as one token and words one token per
+    4 characters, which slightly overestimates BPE/WordPiece tokenizers on English text.
+    """
+    return sum(_cost(m.group()) for m in TOKEN_RE.finditer(text))
+
+
+@lru_cache(maxsize=1024)
+def split_text(text: str, max_tokens: int) -> Tuple[str, ...]:
+    """Split a text into chunks of at most `max_tokens` estimated tokens, at token boundaries."""
+    chunks = []
+    start = 0
+    tokens = 0
+    for m in TOKEN_RE.finditer(text):
+        cost = _cost(m.group())
+        if tokens + cost > max_tokens and tokens > 0:
+            chunks.append(text[start:m.start()])
+            start, tokens = m.start(), 0
+        if cost > max_tokens:
+            # A single word longer than the limit, cut it by characters.
+            step = max_tokens * CHARS_PER_TOKEN
+            end = m.start()
+            while m.end() - end > step:
+                chunks.append(text[start:end + step])
+                start = end = end + step
+            cost = _cost(text[start:m.end()])
+        tokens += cost
+    if start < len(text) or not chunks:
+        chunks.append(text[start:])
+    return tuple(chunks)
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    """Truncate a text to at most `max_tokens` estimated tokens."""
+    if len(text) <= max_tokens:
+        # Every token is at least one character.
+        return text
+    return split_text(text, max_tokens)[0]
+
+
+def split_tokens(texts: List[str], total: int) -> List[int]:
+    """Split the token usage of a batch over its texts, proportionally to their estimated tokens."""
+    weights = [estimate_tokens(text) for text in texts]
+    total_weight = sum(weights) or 1
+    tokens = [total * weight // total_weight for weight in weights]
+    # Give the rounding remainder to the longest texts so the sum stays exact.
+    remainder = total - sum(tokens)
+    for i in sorted(range(len(texts)), key=lambda i: -weights[i])[:remainder]:
+        tokens[i] += 1
+    return tokens
@@ -0,0 +1,25 @@
+import time
+
+import pytest
+
+
+class Clock(object):
+    """`time` module with a wall and monotonic clock moved by the tests, the rest is the real module."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock() -> Clock:
+    """A clock to patch in as the `time` module of the module under test."""
+    return Clock()
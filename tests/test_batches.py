@@ -0,0 +1,130 @@
+import json
+import asyncio
+from typing import Any, AsyncIterator, List, Optional, Tuple
+
+from llm_fusion_api.batches import FINAL_STATUSES, Batches, FileStore
+
+
+class Upstream(object):
+    """Dispatch of the batches: echoes the input, fails the `fail` ones, and waits while paused."""
+
+    def __init__(self, fail: Tuple[str, ...] = ()):
+        self.fail = fail
+        self.calls: List[str] = []
+        self.running = asyncio.Event()
+        self.running.set()
+
+    async def dispatch(self, endpoint: str, body: bytes, tenant: Optional[str]) -> Tuple[int, Any]:
+        await self.running.wait()
+        text = json.loads(body)['input']
+        self.calls.append(text)
+        await asyncio.sleep(0.001)
+        if text in self.fail:
+            return 400, {'error': {'message': f"bad input {text}"}}
+        return 200, {'object': 'list', 'data': [{'embedding': [1.0], 'index': 0}], 'input': text}
+
+
+def requests(count: int) -> bytes:
+    return b''.join(
+        json.dumps({
+            'custom_id': f"r{i}",
+            'method': 'POST',
+            'url': '/v1/embeddings',
+            'body': {'model': 'text-embedding-ada-002', 'input': f"t{i}"},
+        }).encode() + b'\n'
+        for i in range(count)
+    )
+
+
+async def chunks(data: bytes) -> AsyncIterator[bytes]:
+    yield data
+
+
+async def wait_for(batches: Batches, batch_id: str, condition, timeout: float = 10) -> dict:
+    async def poll():
+        while True:
+            batch = batches.get(batch_id)
+            if condition(batch):
+                return batch
+            await asyncio.sleep(0.005)
+    return await asyncio.wait_for(poll(), timeout)
+
+
+def results(files: FileStore, file_id: str) -> List[dict]:
+    with open(files.content_path(file_id), 'rb') as f:
+        return [json.loads(line) for line in f]
+
+
+def new_batches(tmp_path, upstream: Upstream) -> Batches:
+    files = FileStore(str(tmp_path / 'files'))
+    return Batches(str(tmp_path / 'batches'), files, upstream.dispatch, concurrency=4, checkpoint_seconds=0.01)
+
+
+def test_batch_runs_to_completion(tmp_path):
+    async def run():
+        upstream = Upstream(fail=('t3',))
+        batches = new_batches(tmp_path, upstream)
+        file = await batches.files.save(chunks(requests(10) + b'\n'), 'input.jsonl', 'batch', None)
+        batch = batches.create(file['id'], '/v1/embeddings')
+        batch = await wait_for(batches, batch['id'], lambda b: b['status'] in FINAL_STATUSES)
+        assert batch['status'] == 'completed'
+        assert batch['request_counts'] == {'total': 10, 'completed': 9, 'failed': 1}
+        output = results(batches.files, batch['output_file_id'])
+        assert sorted(r['custom_id'] for r in output) == sorted(f"r{i}" for i in range(10) if i != 3)
+        assert all(r['response']['status_code'] == 200 for r in output)
+        [error] = results(batches.files, batch['error_file_id'])
+        assert error['custom_id'] == 'r3'
+        assert error['error'] == {'code': '400', 'message': 'bad input t3'}
+        # The final status is on disk, not only in memory.
+        assert batches.load(batch['id'])['batch']['status'] == 'completed'
+        assert not [name for name in (tmp_path / 'batches').iterdir() if name.suffix == '.tmp']
+
+    asyncio.run(run())
+
+
+def test_batch_resumes_from_checkpoint(tmp_path):
+    async def run():
+        upstream = Upstream()
+        batches = new_batches(tmp_path, upstream)
+        file = await batches.files.save(chunks(requests(200)), 'input.jsonl', 'batch', None)
+        batch = batches.create(file['id'], '/v1/embeddings')
+        await wait_for(batches, batch['id'], lambda b: b['request_counts']['completed'] >= 50)
+        upstream.running.clear()
+        await batches.stop()
+        stopped = batches.load(batch['id'])
+        assert stopped['batch']['status'] == 'in_progress'
+        checkpoint = stopped['checkpoint']
+        done = checkpoint['line'] + len(checkpoint['done'])
+        assert done >= 50
+
+        # A new process: the batch is resumed from its checkpoint.
+        upstream = Upstream()
+        batches = new_batches(tmp_path, upstream)
+        batches.start()
+        batch = await wait_for(batches, batch['id'], lambda b: b['status'] in FINAL_STATUSES)
+        await batches.stop()
+        assert batch['status'] == 'completed'
+        assert batch['request_counts']['completed'] == 200
+        # Only the requests not done before the stop are sent again.
+        assert len(upstream.calls) == 200 - done
+        # Results written after the checkpoint were dropped with the output past it.
+        output = results(batches.files, batch['output_file_id'])
+        assert sorted(r['custom_id'] for r in output) == sorted(f"r{i}" for i in range(200))
+
+    asyncio.run(run())
+
+
+def test_cancel(tmp_path):
+    async def run():
+        upstream = Upstream()
+        upstream.running.clear()
+        batches = new_batches(tmp_path, upstream)
+        file = await batches.files.save(chunks(requests(20)), 'input.jsonl', 'batch', None)
+        batch = batches.create(file['id'], '/v1/embeddings')
+        await wait_for(batches, batch['id'], lambda b: b['status'] == 'in_progress')
+        assert batches.cancel(batch['id'])['status'] == 'cancelling'
+        batch = await wait_for(batches, batch['id'], lambda b: b['status'] in FINAL_STATUSES)
+        assert batch['status'] == 'cancelled'
+        assert batches.load(batch['id'])['batch']['status'] == 'cancelled'
+
+    asyncio.run(run())
@@ -0,0 +1,92 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from llm_fusion_api.batching import CoalescingEmbeddingHandler
+from llm_fusion_api.provider.base import EmbeddingHandler
+from llm_fusion_api.response import APIError
+
+
+class Upstream(EmbeddingHandler):
+    """Embeds each text as [its length], recording the batches it was sent."""
+
+    def __init__(self):
+        self.batches: List[List[str]] = []
+        self.error = None
+
+    async def create_embeddings(self, model: str, inputs: List[str], body: dict) -> dict:
+        self.batches.append(inputs)
+        if self.error is not None:
+            raise self.error
+        tokens = sum(len(input) for input in inputs)
+        return {
+            'data': [{'index': i, 'embedding': [float(len(input))]} for i, input in reversed(list(enumerate(inputs)))],
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        }
+
+
+def embed_all(handler: CoalescingEmbeddingHandler, inputs: List[str], body: dict = None) -> List:
+    async def run():
+        results = await asyncio.gather(
+            *[handler.create_embeddings('m', [input], body or {}) for input in inputs], return_exceptions=True)
+        await handler.aclose()
+        return results
+    return asyncio.run(run())
+
+
+def test_concurrent_inputs_coalesced():
+    upstream = Upstream()
+    handler = CoalescingEmbeddingHandler(upstream, 0.01, 16)
+    results = embed_all(handler, ['a', 'bb', 'ccc'])
+    assert upstream.batches == [['a', 'bb', 'ccc']]
+    assert [result['data'][0]['embedding'] for result in results] == [[1.0], [2.0], [3.0]]
+    assert sum(result['usage']['prompt_tokens'] for result in results) == 6
+    assert handler.stats() == {'batches': 1, 'inputs': 3}
+
+
+def test_flushed_at_max_batch_size():
+    upstream = Upstream()
+    handler = CoalescingEmbeddingHandler(upstream, 0.05, 2)
+    embed_all(handler, ['a', 'b', 'c'])
+    assert upstream.batches == [['a', 'b'], ['c']]
+
+
+def test_dimensions_not_mixed():
+    upstream = Upstream()
+    handler = CoalescingEmbeddingHandler(upstream, 0.01, 16)
+
+    async def run():
+        await asyncio.gather(
+            handler.create_embeddings('m', ['a'], {}),
+            handler.create_embeddings('m', ['b'], {'dimensions': 8}),
+        )
+
+    asyncio.run(run())
+    assert sorted(upstream.batches) == [['a'], ['b']]
+
+
+def test_error_reaches_every_caller():
+    upstream = Upstream()
+    upstream.error = APIError(503, "unavailable")
+    results = embed_all(CoalescingEmbeddingHandler(upstream, 0.01, 16), ['a', 'b'])
+    assert all(isinstance(result, APIError) for result in results)
+
+
+def test_multiple_inputs_sent_as_they_are():
+    upstream = Upstream()
+    handler = CoalescingEmbeddingHandler(upstream, 0.01, 16)
+    result = asyncio.run(handler.create_embeddings('m', ['a', 'bb'], {}))
+    assert upstream.batches == [['a', 'bb']]
+    assert len(result['data']) == 2
+
+
+@pytest.mark.parametrize('body, input', [
+    ({'input': 'a'}, 'a'),
+    ({'input': ['a']}, 'a'),
+    ({'input': ['a', 'b']}, None),
+    ({'input': [1, 2]}, None),
+    ({'input': 'a', 'encoding_format': 'base64'}, None),
+])
+def test_single_input(body, input):
+    assert CoalescingEmbeddingHandler.single_input(body) == input
@@ -0,0 +1,118 @@
+import pytest
+
+from llm_fusion_api import breaker
+from llm_fusion_api.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers
+
+
+@pytest.fixture
+def clock(clock, monkeypatch):
+    """The clock of the breaker."""
+    monkeypatch.setattr(breaker, 'time', clock)
+    return clock
+
+
+def new_breaker(**options) -> CircuitBreaker:
+    options = dict(window=4, min_calls=4, open_seconds=10, half_open_calls=2, **options)
+    return CircuitBreaker('openai/gpt-4', **options)
+
+
+def trip(b: CircuitBreaker):
+    for _ in range(4):
+        assert b.allow()
+        b.record(True)
+    assert b.state == OPEN
+
+
+def test_stays_closed_under_min_calls(clock):
+    b = new_breaker()
+    for _ in range(3):
+        b.record(True)
+    assert b.state == CLOSED and b.allow()
+
+
+def test_opens_at_error_rate(clock):
+    b = new_breaker()
+    for failed in (False, False, True):
+        b.record(failed)
+    assert b.state == CLOSED
+    b.record(True)
+    assert b.state == OPEN
+
+
+def test_window_forgets_old_outcomes(clock):
+    b = new_breaker(error_rate=0.75)
+    for failed in (True, True, False, False, False, False, True, True):
+        b.record(failed)
+        assert b.state == CLOSED
+
+
+def test_slow_calls_are_failures(clock):
+    b = new_breaker(slow_seconds=1)
+    for _ in range(4):
+        b.record(False, latency=2)
+    assert b.state == OPEN
+
+
+def test_open_rejects_until_half_open(clock):
+    b = new_breaker()
+    trip(b)
+    assert not b.allow()
+    assert b.rejected == 1
+    assert b.reject().status_code == 503
+    assert b.reject().headers['Retry-After'] == '11'
+    clock.now += 10
+    assert b.allow()
+    assert b.state == HALF_OPEN
+
+
+def test_half_open_limits_probes_and_closes(clock):
+    b = new_breaker()
+    trip(b)
+    clock.now += 10
+    assert b.allow() and b.allow()
+    assert not b.allow()
+    b.record(False)
+    assert b.state == HALF_OPEN
+    b.record(False)
+    assert b.state == CLOSED
+    # The window starts over.
+    for _ in range(3):
+        b.record(True)
+    assert b.state == CLOSED
+
+
+def test_half_open_failure_opens_again(clock):
+    b = new_breaker()
+    trip(b)
+    clock.now += 10
+    assert b.allow()
+    b.record(True)
+    assert b.state == OPEN
+    assert not b.allow()
+    clock.now += 10
+    assert b.allow()
+
+
+def test_release_frees_a_probe(clock):
+    b = new_breaker()
+    trip(b)
+    clock.now += 10
+    assert b.allow() and b.allow()
+    b.release()
+    assert b.allow()
+
+
+def test_late_outcome_of_open_breaker_is_ignored(clock):
+    b = new_breaker()
+    trip(b)
+    b.record(False)
+    assert b.state == OPEN
+
+
+def test_breakers_per_name():
+    breakers = CircuitBreakers(window=4, min_calls=4)
+    assert breakers.get('a') is breakers.get('a')
+    for _ in range(4):
+        breakers.get('a').record(True)
+    assert breakers.states() == {'a': OPEN}
+    assert breakers.get('b').state == CLOSED
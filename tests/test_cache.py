@@ -0,0 +1,163 @@
+import os
+import time
+import asyncio
+import json
+from typing import List
+
+import pytest
+from starlette.responses import JSONResponse, Response, StreamingResponse
+
+from llm_fusion_api.cache import ResponseCache, assemble_chunks, is_replayable
+from llm_fusion_api.sse import ChunkEncoder, DONE, event_source, iter_data
+
+
+COMPLETION = {
+    'id': "chatcmpl-1",
+    'object': "chat.completion",
+    'created': 1700000000,
+    'model': "gpt-4",
+    'choices': [{'finish_reason': "stop", 'index': 0, 'message': {'role': "assistant", 'content': "Hello there"}}],
+    'usage': {'prompt_tokens': 5, 'completion_tokens': 2, 'total_tokens': 7},
+}
+
+TOOL_CALL = {
+    **COMPLETION,
+    'choices': [{
+        'finish_reason': "tool_calls",
+        'index': 0,
+        'message': {
+            'role': "assistant",
+            'content': None,
+            'tool_calls': [{'id': "call_1", 'type': "function", 'function': {'name': "f", 'arguments': "{}"}}],
+        },
+    }],
+}
+
+
+@pytest.fixture
+def cache(tmp_path) -> ResponseCache:
+    return ResponseCache(16, 60.0, str(tmp_path))
+
+
+async def body(response: Response) -> List:
+    return [item async for item in response.body_iterator]
+
+
+def chunks(items: List) -> List[dict]:
+    return [json.loads(data) for item in items for data in iter_data(item) if data != '[DONE]']
+
+
+async def stream(completion: dict):
+    choice = completion['choices'][0]
+    encoder = ChunkEncoder(completion['id'], completion['created'], completion['model'])
+    yield encoder.role()
+    for word in choice['message']['content'].split(' '):
+        yield encoder.content(word + ' ')
+    yield encoder.finish(choice['finish_reason'], usage=completion['usage'])
+    yield DONE
+
+
+def test_json_completion_replayed_as_stream(cache):
+    async def run():
+        response = await cache.capture('k', JSONResponse(COMPLETION))
+        assert response.headers['X-Cache'] == 'MISS'
+        completion, age = await cache.get('k')
+        assert completion == COMPLETION
+        replayed = cache.replay(completion, True, age)
+        assert replayed.headers['X-Cache'] == 'HIT'
+        assert assemble_chunks(chunks(await body(replayed))) == COMPLETION
+
+    asyncio.run(run())
+
+
+def test_stream_replayed_as_json(cache):
+    async def run():
+        response = await cache.capture('k', event_source(stream(COMPLETION)))
+        await body(response)
+        completion, age = await cache.get('k')
+        replayed = cache.replay(completion, False, age)
+        assert json.loads(replayed.body)['choices'][0]['message']['content'] == "Hello there "
+        assert json.loads(replayed.body)['usage'] == COMPLETION['usage']
+
+    asyncio.run(run())
+
+
+def test_proxied_body(cache):
+    async def run():
+        async def proxied():
+            yield json.dumps(COMPLETION).encode()
+
+        await body(await cache.capture('k', StreamingResponse(proxied(), media_type='application/json')))
+        assert (await cache.get('k'))[0] == COMPLETION
+
+    asyncio.run(run())
+
+
+def test_disk_tier_survives_restart(cache, tmp_path):
+    async def run():
+        await cache.set('k', COMPLETION)
+        restarted = ResponseCache(16, 60.0, str(tmp_path))
+        assert (await restarted.get('k'))[0] == COMPLETION
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('completion', [
+    TOOL_CALL,
+    {**COMPLETION, 'choices': [{
+        'finish_reason': "stop", 'index': 0, 'message': {'role': "assistant", 'content': None},
+    }]},
+    {**COMPLETION, 'choices': [{
+        'finish_reason': "function_call", 'index': 0,
+        'message': {'role': "assistant", 'content': "", 'function_call': {'name': "f", 'arguments': "{}"}},
+    }]},
+])
+def test_tool_calls_not_cached(cache, completion):
+    async def run():
+        assert not is_replayable(completion)
+        await cache.capture('k', JSONResponse(completion))
+        assert await cache.get('k') is None
+
+    asyncio.run(run())
+
+
+def test_errors_and_incomplete_streams_not_cached(cache):
+    async def truncated():
+        encoder = ChunkEncoder("chatcmpl-1", 1700000000, "gpt-4")
+        yield encoder.role()
+        yield encoder.content("Hel")
+
+    async def run():
+        await cache.capture('k', JSONResponse({'error': {'message': "busy"}}, status_code=503))
+        await body(await cache.capture('k', event_source(truncated())))
+        assert await cache.get('k') is None
+
+    asyncio.run(run())
+
+
+def disk_usage(path) -> int:
+    return sum(file.stat().st_size for file in path.rglob('*.json'))
+
+
+def test_disk_tier_capped(tmp_path):
+    size = len(json.dumps({'expires_at': 0.0, 'completion': COMPLETION}))
+    cache = ResponseCache(16, 60.0, str(tmp_path), max_bytes=size * 10)
+
+    async def run():
+        for i in range(50):
+            await cache.set(f'{i:064x}', COMPLETION)
+
+    asyncio.run(run())
+    assert disk_usage(tmp_path) <= size * 10
+    # The newest entries are kept.
+    assert (tmp_path / '00' / f'{49:064x}.json').exists()
+
+
+def test_expired_files_swept_on_startup(cache, tmp_path):
+    asyncio.run(cache.set('a' * 64, COMPLETION))
+    asyncio.run(cache.set('b' * 64, COMPLETION))
+    expired = tmp_path / 'aa' / ('a' * 64 + '.json')
+    os.utime(expired, (time.time() - 120, time.time() - 120))
+    ResponseCache(16, 60.0, str(tmp_path))
+    assert not expired.exists()
+    assert (tmp_path / 'bb' / ('b' * 64 + '.json')).exists()
@@ -0,0 +1,56 @@
+import asyncio
+
+import httpx
+import pytest
+
+from llm_fusion_api.client import ClientPool
+
+
+def handler(request: httpx.Request) -> httpx.Response:
+    if request.url.path == '/down':
+        raise httpx.ConnectError("refused", request=request)
+    return httpx.Response(200)
+
+
+def test_in_flight_after_errors():
+    pool = ClientPool('test')
+
+    async def run():
+        client = pool.client
+        assert pool.stats()['connections'] == 0
+        pool._transport.transport = httpx.MockTransport(handler)
+        await client.get('http://upstream/up')
+        for _ in range(3):
+            with pytest.raises(httpx.ConnectError):
+                await client.get('http://upstream/down')
+        await pool.aclose()
+
+    asyncio.run(run())
+    stats = pool.stats()
+    assert (stats['requests'], stats['responses'], stats['errors'], stats['in_flight']) == (4, 1, 3, 0)
+    # The mock transport has no connection pool to inspect.
+    assert 'connections' not in stats
+
+
+def test_in_flight_while_waiting():
+    pool = ClientPool('test')
+    started = asyncio.Event()
+
+    async def slow(request: httpx.Request) -> httpx.Response:
+        started.set()
+        await asyncio.sleep(10)
+        return httpx.Response(200)
+
+    async def run():
+        client = pool.client
+        pool._transport.transport = httpx.MockTransport(slow)
+        task = asyncio.create_task(client.get('http://upstream/slow'))
+        await started.wait()
+        assert pool.stats()['in_flight'] == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert pool.stats()['in_flight'] == 0
+        await pool.aclose()
+
+    asyncio.run(run())
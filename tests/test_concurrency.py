@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+from starlette.responses import JSONResponse, StreamingResponse
+
+from llm_fusion_api import concurrency
+from llm_fusion_api.concurrency import AdaptiveLimiter, Overloaded
+from llm_fusion_api.response import APIError
+
+
+@pytest.fixture
+def clock(clock, monkeypatch):
+    """The clock of the limiters."""
+    monkeypatch.setattr(concurrency, 'time', clock)
+    return clock
+
+
+def test_overload_backs_off_once_per_burst(clock):
+    limiter = AdaptiveLimiter('m', initial_limit=10, backoff=0.5)
+    start = clock.now
+    clock.now += 1
+    limiter.sample(start, True)
+    assert limiter.limit == 5
+    # Started before the decrease, under the previous limit.
+    limiter.sample(start, True)
+    assert limiter.limit == 5
+    limiter.sample(clock.now, True)
+    assert limiter.limit == 2.5
+
+
+def test_slow_calls_back_off(clock):
+    limiter = AdaptiveLimiter('m', initial_limit=10, backoff=0.5, latency_tolerance=2.0)
+    for _ in range(5):
+        start = clock.now
+        clock.now += 1
+        limiter.sample(start, False)
+    assert limiter.limit == 10
+    start = clock.now
+    clock.now += 3
+    limiter.sample(start, False)
+    assert limiter.limit == 5
+
+
+def test_increase_at_the_limit(clock):
+    limiter = AdaptiveLimiter('m', initial_limit=2, latency_tolerance=0)
+    limiter.in_flight = 2
+    limiter.sample(clock.now, False)
+    assert limiter.limit == 2.5
+    limiter.in_flight = 0
+    limiter.sample(clock.now, False)
+    assert limiter.limit == 2.5
+
+
+def test_queue_by_priority():
+    limiter = AdaptiveLimiter('m', initial_limit=1)
+    order = []
+
+    async def run():
+        assert await limiter.acquire()
+
+        async def wait(priority: int):
+            assert await limiter.acquire(priority)
+            order.append(priority)
+            limiter.release()
+
+        tasks = [asyncio.create_task(wait(priority)) for priority in (0, 5, 1)]
+        await asyncio.sleep(0)
+        assert limiter.stats()['queued'] == 3
+        limiter.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == [5, 1, 0]
+    assert limiter.in_flight == 0
+
+
+def test_full_queue_and_wait_timeout_reject():
+    limiter = AdaptiveLimiter('m', initial_limit=1, queue_size=1, max_wait=0.01)
+
+    async def run():
+        assert await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not await limiter.acquire()
+        assert not await waiter
+
+    asyncio.run(run())
+    assert limiter.stats() == {'limit': 1, 'in_flight': 1, 'queued': 0, 'rejected': 2}
+
+
+def test_wrap_raises_overloaded():
+    limiter = AdaptiveLimiter('m', initial_limit=1, queue_size=0)
+
+    async def call():
+        return JSONResponse({})
+
+    async def run():
+        assert await limiter.acquire()
+        with pytest.raises(Overloaded) as e:
+            await limiter.wrap(call)()
+        assert e.value.response().headers['Retry-After'] == '1'
+
+    asyncio.run(run())
+
+
+def test_wrap_releases_after_the_stream():
+    limiter = AdaptiveLimiter('m')
+
+    async def chunks():
+        yield b'data: {}\n\n'
+        raise APIError(503, "overloaded")
+
+    async def call():
+        return StreamingResponse(chunks())
+
+    async def run():
+        response = await limiter.wrap(call, stream=True)()
+        assert limiter.in_flight == 1
+        with pytest.raises(APIError):
+            async for _ in response.body_iterator:
+                pass
+        assert limiter.in_flight == 0
+
+    asyncio.run(run())
+    # The stream started, a later error is not an overload of the upstream.
+    assert limiter.limit == 16
+
+
+def test_wrap_backs_off_on_overload_status():
+    limiter = AdaptiveLimiter('m', initial_limit=10, backoff=0.5)
+
+    async def call():
+        return JSONResponse({}, status_code=429)
+
+    asyncio.run(limiter.wrap(call)())
+    assert (limiter.limit, limiter.in_flight) == (5, 0)
@@ -0,0 +1,103 @@
+import asyncio
+import hashlib
+from typing import List
+
+import pytest
+
+from llm_fusion_api.embedding_cache import HEADER, EmbeddingCache, EmbeddingStore
+from llm_fusion_api.provider.base import EmbeddingHandler
+
+
+class Upstream(EmbeddingHandler):
+    """Embeds each text as [its length, 1], recording the inputs it was sent."""
+
+    def __init__(self):
+        self.inputs: List[List[str]] = []
+
+    async def create_embeddings(self, model: str, inputs: List[str], body: dict) -> dict:
+        self.inputs.append(inputs)
+        tokens = sum(len(input) for input in inputs)
+        return {
+            'data': [{'index': i, 'embedding': [float(len(input)), 1.0]} for i, input in enumerate(inputs)],
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        }
+
+
+def digest(text: str) -> bytes:
+    return hashlib.sha256(text.encode()).digest()
+
+
+@pytest.fixture(params=['memory', 'disk'])
+def cache(request, tmp_path) -> EmbeddingCache:
+    cache = EmbeddingCache(64, str(tmp_path) if request.param == 'disk' else '')
+    yield cache
+    cache.close()
+
+
+def test_only_missing_inputs_sent(cache):
+    upstream = Upstream()
+
+    async def run():
+        await cache.embed('openai', upstream, 'm', {'input': ['a', 'bb']})
+        return await cache.embed('openai', upstream, 'm', {'input': ['bb', 'ccc', 'ccc', 'a']})
+
+    result, hits = asyncio.run(run())
+    assert upstream.inputs == [['a', 'bb'], ['ccc']]
+    assert hits == 2
+    assert [item['embedding'][0] for item in result['data']] == [2.0, 3.0, 3.0, 1.0]
+    assert [item['index'] for item in result['data']] == [0, 1, 2, 3]
+    assert result['usage']['prompt_tokens'] == 9
+
+
+def test_namespaces_apart(cache):
+    upstream = Upstream()
+
+    async def run():
+        await cache.embed('openai', upstream, 'm', {'input': 'a'})
+        await cache.embed('openai', upstream, 'other', {'input': 'a'})
+        await cache.embed('openai', upstream, 'm', {'input': 'a', 'dimensions': 2})
+
+    asyncio.run(run())
+    assert len(upstream.inputs) == 3
+
+
+def test_disk_store_survives_restart(tmp_path):
+    upstream = Upstream()
+    cache = EmbeddingCache(64, str(tmp_path))
+    asyncio.run(cache.embed('openai', upstream, 'm', {'input': 'abc'}))
+    cache.close()
+    restarted = EmbeddingCache(64, str(tmp_path))
+    _, hits = asyncio.run(restarted.embed('openai', upstream, 'm', {'input': 'abc'}))
+    restarted.close()
+    assert hits == 1 and len(upstream.inputs) == 1
+
+
+def test_store_evicts_oldest_of_a_set():
+    store = EmbeddingStore(2, 2)
+    assert (store.ways, store.sets) == (2, 1)
+    for text in ('a', 'b', 'c'):
+        store.put(digest(text), [1.0, 2.0], 1)
+    assert store.get(digest('a')) is None
+    assert store.get(digest('c')) == ([1.0, 2.0], 1)
+    assert len(store) == 2
+    store.close()
+
+
+def test_store_detects_torn_vectors():
+    store = EmbeddingStore(2, 8)
+    store.put(digest('a'), [1.0, 2.0], 1)
+    slot = next(slot for slot in store._slots(digest('a')) if HEADER.unpack_from(store.mm, slot * store.slot_size)[0])
+    # Last byte of the vector, as if read while another worker rewrites it.
+    store.mm[(slot + 1) * store.slot_size - 1] ^= 0xff
+    assert store.get(digest('a')) is None
+    store.close()
+
+
+@pytest.mark.parametrize('body, cacheable', [
+    ({'input': 'a'}, True),
+    ({'input': ['a', 'b']}, True),
+    ({'input': [[1, 2]]}, False),
+    ({'input': 'a', 'encoding_format': 'base64'}, False),
+])
+def test_is_cacheable(body, cacheable):
+    assert EmbeddingCache.is_cacheable(body) == cacheable
@@ -0,0 +1,37 @@
+import json
+import queue
+import logging
+
+from llm_fusion_api import log
+
+
+def emit(formatter: logging.Formatter) -> str:
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = log.QueueHandler(records)
+    logger = logging.getLogger('test_log')
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("Failed %s with api_key=%s", 'call', 'sk-secret')
+    finally:
+        logger.removeHandler(handler)
+    record = records.get_nowait()
+    assert record.exc_info is None
+    log.RedactFilter().filter(record)
+    return formatter.format(record)
+
+
+def test_json_traceback_apart_from_message():
+    entry = json.loads(emit(log.JSONFormatter()))
+    assert entry['message'] == "Failed call with api_key=***"
+    assert entry['exc_info'].startswith("Traceback")
+    assert "ValueError: boom" in entry['exc_info']
+
+
+def test_text_traceback_after_message():
+    lines = emit(logging.Formatter('%(levelname)s %(message)s')).splitlines()
+    assert lines[0] == "ERROR Failed call with api_key=***"
+    assert lines[-1] == "ValueError: boom"
@@ -0,0 +1,57 @@
+import asyncio
+import hashlib
+from typing import Dict
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from llm_fusion_api.middleware import SecretTokenAuthMiddleware
+from llm_fusion_api.ratelimit import Tenant
+
+
+async def tenant(request: Request) -> PlainTextResponse:
+    return PlainTextResponse(getattr(request.state, 'tenant', '-'))
+
+
+def make_app(**options) -> Starlette:
+    middleware = [Middleware(SecretTokenAuthMiddleware, **options)]
+    return Starlette(routes=[Route('/', endpoint=tenant)], middleware=middleware)
+
+
+def get(app: Starlette, headers: Dict[str, str]) -> httpx.Response:
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app), base_url='http://test') as client:
+            return await client.get('/', headers=headers)
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def app() -> Starlette:
+    return make_app(
+        secret_tokens=['s1', ''],
+        secret_token_hashes=[hashlib.sha256(b's2').hexdigest()],
+        tenants=[Tenant('batch', keys=['kb']), Tenant('web', key_hashes=[hashlib.sha256(b'kw').hexdigest()])],
+    )
+
+
+@pytest.mark.parametrize('token, name', [('s1', 'default'), ('s2', 'default'), ('kb', 'batch'), ('kw', 'web')])
+def test_token_identifies_tenant(app, token, name):
+    response = get(app, {'Authorization': f'Bearer {token}'})
+    assert (response.status_code, response.text) == (200, name)
+
+
+@pytest.mark.parametrize('headers', [{}, {'Authorization': 'Bearer nope'}, {'Authorization': 's1'}])
+def test_unauthorized(app, headers):
+    response = get(app, headers)
+    assert response.status_code == 401
+    assert response.json()['error']['message'] == 'Unauthorized'
+
+
+def test_open_without_tokens():
+    response = get(make_app(), {})
+    assert (response.status_code, response.text) == (200, '-')
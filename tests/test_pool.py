@@ -0,0 +1,161 @@
+import asyncio
+from typing import List
+
+import httpx
+import pytest
+from starlette.responses import JSONResponse, Response, StreamingResponse
+
+from llm_fusion_api.provider.base import ChatHandler, EmbeddingHandler, Provider
+from llm_fusion_api.provider.pool import EmbeddingProviderPool, is_member_failure
+from llm_fusion_api.response import APIError
+from llm_fusion_api.schema import ChatCompletionRequest
+
+
+class Upstream(Provider, ChatHandler, EmbeddingHandler):
+    """Member whose calls raise `error`, or answer `status_code`; streams fail with `stream_error` after a chunk."""
+
+    def __init__(self):
+        super().__init__('fake')
+        self.error = None
+        self.status_code = 200
+        self.stream_error = None
+        self.delay = 0.0
+
+    async def chat_completions(self, request: ChatCompletionRequest, model: str) -> Response:
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        if request.stream:
+            return StreamingResponse(self.chunks(), media_type='text/event-stream')
+        return JSONResponse({'model': model}, status_code=self.status_code)
+
+    async def chunks(self):
+        yield b'data: {}\n\n'
+        if self.stream_error is not None:
+            raise self.stream_error
+        yield b'data: [DONE]\n\n'
+
+    async def create_embeddings(self, model: str, inputs: List[str], body: dict) -> dict:
+        if self.error is not None:
+            raise self.error
+        return {'object': 'list', 'data': [], 'usage': {}}
+
+
+def chat(stream: bool = False) -> ChatCompletionRequest:
+    body = b'{"model": "m", "stream": %s, "messages": [{"role": "user", "content": "hi"}]}' % (
+        b'true' if stream else b'false')
+    return ChatCompletionRequest.from_bytes(body)
+
+
+@pytest.fixture
+def upstreams() -> List[Upstream]:
+    return [Upstream(), Upstream()]
+
+
+@pytest.fixture
+def pool(upstreams) -> EmbeddingProviderPool:
+    return EmbeddingProviderPool('fake', [(upstream, 1) for upstream in upstreams], eject_failures=1)
+
+
+def ejected(pool: EmbeddingProviderPool) -> List[int]:
+    return [stats['ejected'] for stats in pool.stats()]
+
+
+async def consume(response: Response):
+    async for _ in response.body_iterator:
+        pass
+
+
+@pytest.mark.parametrize('error, failure', [
+    (APIError(400, "bad request"), False),
+    (APIError(413, "context length exceeded"), False),
+    (APIError(503, "unavailable"), True),
+    (httpx.ConnectError("refused"), True),
+    (asyncio.CancelledError(), False),
+])
+def test_is_member_failure(error, failure):
+    assert is_member_failure(error) == failure
+
+
+def test_failures_eject_a_member(pool, upstreams):
+    async def run():
+        for upstream in upstreams:
+            upstream.status_code = 503
+        for _ in upstreams:
+            assert (await pool.chat_completions(chat(), 'm')).status_code == 503
+        assert ejected(pool) == [1, 1]
+        assert [stats['outstanding'] for stats in pool.stats()] == [0, 0]
+
+    asyncio.run(run())
+
+
+def test_client_errors_do_not_eject(pool, upstreams):
+    async def run():
+        for upstream in upstreams:
+            upstream.error = APIError(400, "bad request")
+        for _ in range(6):
+            with pytest.raises(APIError):
+                await pool.chat_completions(chat(), 'm')
+            with pytest.raises(APIError):
+                await pool.create_embeddings('m', ["a"], {})
+        assert ejected(pool) == [0, 0]
+        assert [stats['outstanding'] for stats in pool.stats()] == [0, 0]
+
+    asyncio.run(run())
+
+
+def test_cancelled_call_does_not_eject(pool, upstreams):
+    async def run():
+        upstreams[0].delay = upstreams[1].delay = 10
+        task = asyncio.create_task(pool.chat_completions(chat(), 'm'))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert ejected(pool) == [0, 0]
+        assert [stats['outstanding'] for stats in pool.stats()] == [0, 0]
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('error, failure', [
+    (APIError(400, "content filtered"), False),
+    (APIError(500, "upstream error"), True),
+    (httpx.ReadError("reset"), True),
+])
+def test_stream_errors(pool, upstreams, error, failure):
+    async def run():
+        for upstream in upstreams:
+            upstream.stream_error = error
+        response = await pool.chat_completions(chat(stream=True), 'm')
+        assert pool.stats()[0]['outstanding'] + pool.stats()[1]['outstanding'] == 1
+        with pytest.raises(type(error)):
+            await consume(response)
+        assert sum(ejected(pool)) == int(failure)
+
+    asyncio.run(run())
+
+
+def test_stream_closed_by_client_does_not_eject(pool):
+    async def run():
+        response = await pool.chat_completions(chat(stream=True), 'm')
+        await response.body_iterator.__anext__()
+        await response.body_iterator.aclose()
+        assert ejected(pool) == [0, 0]
+        assert [stats['outstanding'] for stats in pool.stats()] == [0, 0]
+
+    asyncio.run(run())
+
+
+def test_ejected_member_gets_no_traffic(pool, upstreams):
+    async def run():
+        upstreams[0].status_code = 503
+        await pool.chat_completions(chat(), 'm')
+        await pool.chat_completions(chat(), 'm')
+        assert ejected(pool) == [1, 0]
+        before = pool.stats()[0]['requests']
+        for _ in range(5):
+            assert (await pool.chat_completions(chat(), 'm')).status_code == 200
+        assert pool.stats()[0]['requests'] == before
+
+    asyncio.run(run())
@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from llm_fusion_api.ratelimit import RateLimited, RateLimiter, Tenant
+from llm_fusion_api.state import MemoryStateStore
+
+
+def tokens_left(store: MemoryStateStore, key: str) -> float:
+    return store.buckets[key][0]
+
+
+def test_admit_takes_each_budget():
+    store = MemoryStateStore()
+    limiter = RateLimiter([Tenant('t', requests_per_second=2, tokens_per_minute=600)], store)
+    lease = asyncio.run(limiter.admit('t', 100))
+    assert lease is not None and lease.tenant.name == 't'
+    assert tokens_left(store, 't:requests') == pytest.approx(1, abs=0.01)
+    assert tokens_left(store, 't:tokens') == pytest.approx(500, abs=1)
+
+
+def test_unknown_tenant_is_not_limited():
+    limiter = RateLimiter([Tenant('t', requests_per_second=1)])
+    assert asyncio.run(limiter.admit(None, 10)) is None
+
+
+def test_rejected_on_tokens_refunds_requests():
+    store = MemoryStateStore()
+    limiter = RateLimiter([Tenant('t', requests_per_second=2, tokens_per_minute=600)], store)
+    asyncio.run(limiter.admit('t', 600))
+    with pytest.raises(RateLimited) as e:
+        asyncio.run(limiter.admit('t', 100))
+    assert e.value.status_code == 429
+    assert limiter.rejected == {'t': 1}
+    # Only the admitted request is counted.
+    assert tokens_left(store, 't:requests') == pytest.approx(1, abs=0.01)
+
+
+def test_rejected_on_streams_refunds_requests_and_tokens():
+    store = MemoryStateStore()
+    limiter = RateLimiter([Tenant('t', requests_per_second=5, tokens_per_minute=600, max_streams=1)], store)
+    lease = asyncio.run(limiter.admit('t', 100, stream=True))
+    with pytest.raises(RateLimited):
+        asyncio.run(limiter.admit('t', 100, stream=True))
+    assert tokens_left(store, 't:requests') == pytest.approx(4, abs=0.01)
+    assert tokens_left(store, 't:tokens') == pytest.approx(500, abs=1)
+    lease.finish({})
+    assert asyncio.run(limiter.admit('t', 100, stream=True)) is not None
@@ -0,0 +1,73 @@
+import asyncio
+
+import httpx
+import pytest
+
+from llm_fusion_api.provider import Model, OpenAI
+from llm_fusion_api.registry import CHAT, EMBEDDING, ModelRegistry, parse_aliases
+from llm_fusion_api.response import APIError
+
+
+@pytest.fixture
+def registry() -> ModelRegistry:
+    registry = ModelRegistry(['openai', 'wenxin', 'fastchat'], parse_aliases(['Fast -> wenxin/ERNIE-Bot-turbo']),
+                             untyped=['fastchat'])
+    registry.update('openai', [Model('openai', 'gpt-4', CHAT), Model('openai', 'text-embedding-ada-002', EMBEDDING)])
+    registry.update('wenxin', [Model('wenxin', 'ernie-bot', CHAT), Model('wenxin', 'ernie-bot-turbo', CHAT)])
+    return registry
+
+
+@pytest.mark.parametrize('name', ['wenxin/ernie-bot', 'wenxin/ERNIE-Bot', 'Wenxin/Ernie-Bot'])
+def test_resolve_in_any_case(registry, name):
+    route = registry.resolve(name, CHAT)
+    assert (route.provider, route.model) == ('wenxin', 'ernie-bot')
+
+
+def test_resolve_openai_without_provider(registry):
+    assert registry.resolve('GPT-4', CHAT).model == 'gpt-4'
+    assert registry.resolve('openai/gpt-4', CHAT).model == 'gpt-4'
+
+
+def test_alias_in_any_case(registry):
+    for name in ('fast', 'FAST', 'Fast'):
+        route = registry.resolve(name, CHAT)
+        assert (route.provider, route.model) == ('wenxin', 'ernie-bot-turbo')
+
+
+def test_unknown_model(registry):
+    with pytest.raises(APIError) as e:
+        registry.resolve('wenxin/nope', CHAT)
+    assert e.value.status_code == 404
+
+
+def test_wrong_capability(registry):
+    with pytest.raises(APIError) as e:
+        registry.resolve('text-embedding-ada-002', CHAT)
+    assert e.value.status_code == 400
+
+
+def test_unlisted_provider_passes_through(registry):
+    route = registry.resolve('FastChat/lmsys/Vicuna-7b', EMBEDDING)
+    assert (route.provider, route.model) == ('fastchat', 'lmsys/Vicuna-7b')
+    registry.update('fastchat', [Model('fastchat', 'lmsys/vicuna-7b', 'chat')])
+    assert registry.resolve('fastchat/lmsys/Vicuna-7B', EMBEDDING).model == 'lmsys/vicuna-7b'
+    with pytest.raises(APIError):
+        registry.resolve('fastchat/other', CHAT)
+
+
+def test_openai_models_routed_whatever_their_prefix(registry):
+    listed = ['gpt-4o', 'o1-mini', 'o3', 'ft:gpt-4o-mini:acme::abc123', 'text-embedding-3-small']
+
+    async def list_models():
+        openai = OpenAI('https://api.openai.com/v1', 'sk-test')
+        openai.pool._client = httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, json={'data': [{'id': id} for id in listed]})))
+        try:
+            return await openai.list_models()
+        finally:
+            await openai.aclose()
+
+    registry.update('openai', asyncio.run(list_models()))
+    for name in ('o1-mini', 'O3', 'ft:gpt-4o-mini:acme::abc123'):
+        assert registry.resolve(name, CHAT).provider == 'openai'
+    assert registry.resolve('text-embedding-3-small', EMBEDDING).model == 'text-embedding-3-small'
@@ -0,0 +1,101 @@
+import json
+import asyncio
+
+import httpx
+import pytest
+from starlette.responses import JSONResponse, StreamingResponse
+
+from llm_fusion_api.breaker import CircuitBreakers
+from llm_fusion_api.resilience import LatencyWindow, Resilience, parse_fallbacks
+from llm_fusion_api.response import APIError
+
+
+def test_parse_fallbacks():
+    fallbacks = parse_fallbacks(['GPT-4 -> wenxin/ERNIE-Bot-4 -> zhipu/chatglm_pro', 'gpt-4 -> other'])
+    assert fallbacks == {
+        'gpt-4': ['wenxin/ERNIE-Bot-4', 'zhipu/chatglm_pro'],
+        'wenxin/ernie-bot-4': ['zhipu/chatglm_pro'],
+    }
+
+
+class Upstream(object):
+    """Call answering the queued results in order, raising the exceptions among them."""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        result = self.results.pop(0)
+        if isinstance(result, float):
+            await asyncio.sleep(result)
+            result = JSONResponse({'slept': result})
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+
+def test_retries_failures_until_success():
+    upstream = Upstream(JSONResponse({}, status_code=503), httpx.ConnectError("refused"), JSONResponse({'ok': 1}))
+    result = asyncio.run(Resilience(retries=2, base_delay=0).call('m', upstream))
+    assert (result.status_code, upstream.calls) == (200, 3)
+
+
+def test_returns_the_last_failure():
+    upstream = Upstream(*[JSONResponse({}, status_code=502)] * 3)
+    result = asyncio.run(Resilience(retries=2, base_delay=0).call('m', upstream))
+    assert (result.status_code, upstream.calls) == (502, 3)
+
+
+def test_client_errors_not_retried():
+    upstream = Upstream(APIError(400, "bad request"), JSONResponse({}))
+    with pytest.raises(APIError):
+        asyncio.run(Resilience(retries=2, base_delay=0).call('m', upstream))
+    assert upstream.calls == 1
+
+
+def test_stream_retried_until_first_chunk():
+    async def broken():
+        raise httpx.ReadError("reset")
+        yield b''
+
+    async def chunks():
+        yield b'data: 1\n\n'
+        yield b'data: 2\n\n'
+
+    upstream = Upstream(StreamingResponse(broken()), StreamingResponse(chunks()))
+
+    async def run():
+        result = await Resilience(retries=1, base_delay=0).call('m', upstream, stream=True)
+        return [chunk async for chunk in result.body_iterator]
+
+    assert asyncio.run(run()) == [b'data: 1\n\n', b'data: 2\n\n']
+    assert upstream.calls == 2
+
+
+def test_slow_call_hedged():
+    resilience = Resilience(hedge_percentile=50, hedge_min_samples=1)
+    resilience.latencies['m'] = LatencyWindow(10)
+    resilience.latencies['m'].add(0.01)
+    upstream = Upstream(1.0, 0.0)
+
+    async def run():
+        return await resilience.call('m', upstream)
+
+    assert json.loads(asyncio.run(run()).body) == {'slept': 0.0}
+    assert resilience.stats() == {'hedges': 1, 'hedge_wins': 1}
+
+
+def test_open_breaker_fails_fast():
+    breakers = CircuitBreakers(window=2, min_calls=2, open_seconds=60)
+    resilience = Resilience(retries=0, base_delay=0, breakers=breakers)
+    upstream = Upstream(*[JSONResponse({}, status_code=500)] * 2)
+
+    async def run():
+        for _ in range(2):
+            await resilience.call('m', upstream)
+        return await resilience.call('m', upstream)
+
+    assert asyncio.run(run()).status_code == 503
+    assert upstream.calls == 2
@@ -0,0 +1,75 @@
+from typing import Iterable, List
+
+import pytest
+
+from llm_fusion_api.sse import Event, SSEDecoder
+
+
+def decode(chunks: Iterable[bytes]) -> List[Event]:
+    decoder = SSEDecoder()
+    events = []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    return events + decoder.close()
+
+
+def split(data: bytes, size: int) -> List[bytes]:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+STREAM = b'event: add\r\ndata: {"a": 1}\r\nid: 7\r\n\r\n: keep-alive\r\n\r\ndata: first\r\ndata: second\r\n\r\n'
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, len(STREAM)])
+def test_split_chunks(size):
+    events = decode(split(STREAM, size))
+    assert [(e.event, e.data, e.id) for e in events] == [
+        ('add', b'{"a": 1}', '7'),
+        ('message', b'first\nsecond', '7'),
+    ]
+    assert events[0].json() == {'a': 1}
+
+
+@pytest.mark.parametrize('eol', [b'\n', b'\r\n', b'\r'])
+def test_line_endings(eol):
+    stream = eol.join([b'data: a', b'', b'data: b', b'data: c', b'', b''])
+    assert [e.data for e in decode([stream])] == [b'a', b'b\nc']
+
+
+def test_crlf_split_across_chunks():
+    assert [e.data for e in decode([b'data: a\r', b'\n\r', b'\ndata: b\r', b'\r'])] == [b'a', b'b']
+
+
+def test_multiline_data():
+    events = decode([b'data: one\ndata:two\ndata\ndata:  four\n\n'])
+    assert events[0].data == b'one\ntwo\n\n four'
+
+
+def test_comments_and_unknown_fields():
+    stream = b': ping\n\n:\nfoo: bar\ndata: x\n: inside\n\n: only a comment\n\n'
+    assert [e.data for e in decode([stream])] == [b'x']
+
+
+def test_event_without_data_is_not_dispatched():
+    events = decode([b'event: finish\n\ndata: x\n\n'])
+    assert [(e.event, e.data) for e in events] == [('message', b'x')]
+
+
+def test_retry_and_id():
+    events = decode([b'retry: 1500\nid: a\ndata: x\n\nretry: soon\nid: b\0\ndata: y\n\n'])
+    assert [(e.id, e.retry) for e in events] == [('a', 1500), ('a', 1500)]
+
+
+def test_byte_order_mark():
+    assert [e.data for e in decode([b'\xef', b'\xbb', b'\xbfdata: x\n\n'])] == [b'x']
+
+
+@pytest.mark.parametrize('ending', [b'', b'\n', b'\r\n'])
+def test_trailing_event_without_blank_line(ending):
+    assert [e.data for e in decode([b'data: a\n\ndata: {"end": true}' + ending])] == [b'a', b'{"end": true}']
+
+
+def test_close_without_pending_event():
+    decoder = SSEDecoder()
+    assert [e.data for e in decoder.feed(b'data: a\n\n: bye')] == [b'a']
+    assert decoder.close() == []
@@ -0,0 +1,67 @@
+import pytest
+
+from llm_fusion_api import state
+from llm_fusion_api.state import MemoryStateStore, SQLiteStateStore
+
+
+@pytest.fixture
+def clock(clock, monkeypatch):
+    """The clock of the state store."""
+    monkeypatch.setattr(state, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryStateStore()
+    return SQLiteStateStore(str(tmp_path / 'state.db'))
+
+
+def test_take_until_empty(clock, store):
+    for _ in range(3):
+        assert store.take('t', 1, 3, 1) == 0
+    assert store.take('t', 1, 3, 1) == pytest.approx(1)
+    assert store.take('t', 2, 3, 1.5) == pytest.approx(0.75)
+
+
+def test_take_refills_with_time(clock, store):
+    assert store.take('t', 2, 10, 10) == 0
+    clock.now += 1
+    assert store.take('t', 2, 10, 3) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert store.take('t', 2, 10, 3) == 0
+    assert store.take('t', 2, 10, 0.5) == pytest.approx(0.25)
+
+
+def test_refill_stops_at_capacity(clock, store):
+    assert store.take('t', 1, 5, 5) == 0
+    clock.now += 100
+    assert store.take('t', 1, 5, 5) == 0
+    assert store.take('t', 1, 5, 1) == pytest.approx(1)
+
+
+def test_cost_over_capacity_waits_for_a_full_bucket(clock, store):
+    assert store.take('t', 1, 5, 2) == 0
+    assert store.take('t', 1, 5, 50) == pytest.approx(2)
+    clock.now += 2
+    # Taken from a full bucket, the rest is a debt.
+    assert store.take('t', 1, 5, 50) == 0
+    assert store.take('t', 1, 5, 1) == pytest.approx(46)
+
+
+def test_charge_debt_and_refund(clock, store):
+    store.charge('t', 1, 10, 15)
+    assert store.take('t', 1, 10, 1) == pytest.approx(6)
+    store.charge('t', 1, 10, -8)
+    assert store.take('t', 1, 10, 3) == 0
+    # Refunds never fill the bucket past its capacity.
+    store.charge('t', 1, 10, -100)
+    assert store.take('t', 1, 10, 10) == 0
+    assert store.take('t', 1, 10, 1) == pytest.approx(1)
+
+
+def test_buckets_are_per_key(clock, store):
+    assert store.take('a', 1, 1, 1) == 0
+    assert store.take('b', 1, 1, 1) == 0
+    assert store.take('a', 1, 1, 1) == pytest.approx(1)